@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  compaction.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Micro-benchmark of the IRI compaction of SPARQL JSON results: the
+previous Prefixes.applyTo (one str.replace pass for each prefix) against the
+IRICompactor. With the default number of prefixes, it fails if the
+IRICompactor is the slower.
+
+    $ python benchmark/compaction.py --bindings 100000 --prefixes 50
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from prefix import IRICompactor  # noqa: E402
+
+DEFAULT_PREFIXES = 30
+
+
+def legacy_apply(prefixes, content):
+    # Prefixes.applyTo before the IRICompactor
+    n_content = content.decode()
+    for prefix, value in prefixes.items():
+        n_content = n_content.replace(value, prefix + ':')
+    return n_content.encode()
+
+
+def sparql_result(bindings, prefixes):
+    namespaces = list(prefixes.values())
+    rows = []
+    for i in range(bindings):
+        namespace = namespaces[i % len(namespaces)]
+        rows.append({
+            "s": {"type": "uri", "value": f"{namespace}sensor{i}"},
+            "p": {"type": "uri", "value": f"{namespaces[(i + 1) % len(namespaces)]}value"},
+            "o": {"type": "literal", "value": str(i),
+                  "datatype": "http://www.w3.org/2001/XMLSchema#integer"}})
+    return json.dumps({"head": {"vars": ["s", "p", "o"]}, "results": {"bindings": rows}}).encode()
+
+
+def main(args):
+    prefixes = {f"ns{i}": f"http://example.org/ontology/{i}/" for i in range(args.prefixes)}
+    prefixes["xsd"] = "http://www.w3.org/2001/XMLSchema#"
+    content = sparql_result(args.bindings, prefixes)
+    compactor = IRICompactor(prefixes)
+    assert json.loads(compactor.apply(content)) == json.loads(legacy_apply(prefixes, content))
+
+    print(f"{args.bindings} bindings, {len(prefixes)} prefixes, {len(content) / 1e6:.1f} MB")
+    times = {}
+    for name, function in [
+            ("str.replace per prefix", lambda: legacy_apply(prefixes, content)),
+            ("IRICompactor", lambda: compactor.apply(content))]:
+        best = times[name] = min(timeit.repeat(function, number=1, repeat=args.repeat))
+        print(f"{name:>24}: {best * 1000:8.1f} ms  ({len(content) / best / 1e6:6.1f} MB/s)")
+    if args.prefixes == DEFAULT_PREFIXES:
+        assert times["IRICompactor"] <= times["str.replace per prefix"], "IRICompactor slower than str.replace"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IRI compaction micro-benchmark")
+    parser.add_argument("--bindings", default=20000, type=int, help="Result bindings (default 20000)")
+    parser.add_argument("--prefixes", default=DEFAULT_PREFIXES, type=int,
+                        help=f"Prefixes (default {DEFAULT_PREFIXES}), plus xsd")
+    parser.add_argument("--repeat", default=5, type=int, help="Repetitions, the best is kept (default 5)")
+    main(parser.parse_args())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fanout.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Benchmark of the subscriptions fan-out: how the notification latency
+grows with the number of subscriptions and of their observers.
+
+For each number of subscriptions N and of observers per subscription M,
+a fresh MUSEPA is started in a new process, over rdflib or over
+Blazegraph or Fuseki emulated by a local server (see localsparql.py), N
+subscriptions are created through /sparql/subscription and observed M
+times each, and updates are sent one at a time: each one waits for all
+its notifications (or --timeout) before the next. A fraction of the
+subscriptions (--affected) depends on the updated triple, the others on
+triples that are never updated.
+
+For each configuration, the table (milliseconds) and the --csv file
+(seconds) give:
+    update      p50 of the update response time
+    notify      p50 and p99 of the delay from an update to a notification
+    fanout      p50 and p99 of the delay from an update to its last notification
+    queries     endpoint queries issued by MUSEPA per update
+    lost        notifications not received within --timeout
+
+    $ python benchmark/fanout.py --subscriptions 10,100,1000 --observers 1,10 --csv fanout.csv
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import defaultdict
+from contextlib import redirect_stdout
+from os.path import abspath, dirname
+from threading import Thread
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import musepa as front  # noqa: E402
+
+from endpoint import BLAZEGRAPH, FUSEKI, RDFLIB  # noqa: E402
+from localsparql import LocalSPARQLServer  # noqa: E402
+from aiocoap import Context, Message, GET, POST  # noqa: E402
+
+EX = "http://example.org/"
+
+# Affected subscriptions read the clock, the others a triple whose
+# predicate is never updated (the subscriptions are indexed by predicate);
+# the constant makes each query, and so each subscription, different
+AFFECTED = "SELECT ?t ?k WHERE {{ <{ex}clock> <{ex}stamp> ?t . BIND({i} AS ?k) }}"
+IDLE = "SELECT ?t ?k WHERE {{ <{ex}idle> <{ex}idle> ?t . BIND({i} AS ?k) }}"
+UPDATE = """DELETE WHERE {{ <{ex}clock> <{ex}stamp> ?t }} ;
+INSERT DATA {{ <{ex}clock> <{ex}stamp> {stamp!r} }}"""
+
+# Observations sharing a client context, and so a socket
+OBSERVATIONS_PER_CONTEXT = 64
+
+COLUMNS = ["subscriptions", "observers", "affected", "updates", "notifications", "update_p50",
+           "notify_p50", "notify_p99", "fanout_p50", "fanout_p99", "queries", "lost"]
+# Columns in seconds, shown in milliseconds in the table
+TIMES = {"update_p50", "notify_p50", "notify_p99", "fanout_p50", "fanout_p99"}
+
+
+def integers(text):
+    return [int(item) for item in text.split(",")]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+
+def endpoint_queries():
+    # Queries issued by MUSEPA to its endpoint so far
+    series = front.metrics.histograms.get(front.ENDPOINT_SECONDS, {})
+    return sum(histogram.count for labels, histogram in series.items() if ("operation", "query") in labels)
+
+
+async def request(context, code, uri, payload, timeout):
+    response = await asyncio.wait_for(context.request(Message(code=code, uri=uri, payload=payload)).response, timeout)
+    if not response.code.is_successful():
+        raise ValueError(f"{uri} answered {response.code}")
+    return response
+
+
+async def observe(context, uri, received):
+    # Appends to received[stamp] the arrival of each notification
+    request = context.request(Message(code=GET, uri=uri, observe=0))
+    try:
+        async for notification in request.observation:
+            arrival = time.perf_counter()
+            for binding in json.loads(notification.payload)["results"]["bindings"]:
+                received[float(binding["t"]["value"])].append(arrival)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        request.observation.cancel()
+
+
+async def fanout(address, subscriptions, observers, args):
+    affected = round(subscriptions * args.affected)
+    contexts = [await Context.create_client_context()
+                for _ in range(max(1, -(-subscriptions * observers // OBSERVATIONS_PER_CONTEXT)))]
+    received = defaultdict(list)
+    tasks = []
+    try:
+        await request(contexts[0], POST, f"{address}/sparql/update",
+                      f"INSERT DATA {{ <{EX}clock> <{EX}stamp> 0.0 . <{EX}idle> <{EX}idle> 0.0 }}".encode(),
+                      args.timeout)
+        for i in range(subscriptions):
+            sparql = (AFFECTED if i < affected else IDLE).format(ex=EX, i=i)
+            alias = (await request(contexts[0], POST, f"{address}/sparql/subscription", sparql.encode(),
+                                   args.timeout)).payload.decode()
+            for j in range(observers):
+                context = contexts[(i * observers + j) // OBSERVATIONS_PER_CONTEXT]
+                tasks.append(asyncio.ensure_future(observe(context, f"{address}/{alias}", received)))
+        # the first responses
+        await asyncio.sleep(1 + subscriptions * observers / 1000)
+
+        expected = affected * observers
+        responses, stamps = [], []
+        queries = endpoint_queries()
+        for _ in range(args.updates):
+            stamp = time.perf_counter()
+            await request(contexts[0], POST, f"{address}/sparql/update",
+                          UPDATE.format(ex=EX, stamp=stamp).encode(), args.timeout)
+            responses.append(time.perf_counter() - stamp)
+            stamps.append(stamp)
+            deadline = stamp + args.timeout
+            while len(received[stamp]) < expected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.001)
+        queries = endpoint_queries() - queries
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks)
+        for context in contexts:
+            await context.shutdown()
+
+    delays = [arrival - stamp for stamp in stamps for arrival in received[stamp]]
+    fanouts = [max(received[stamp]) - stamp for stamp in stamps if received[stamp]]
+    return {
+        "subscriptions": subscriptions,
+        "observers": observers,
+        "affected": affected,
+        "updates": args.updates,
+        "notifications": len(delays),
+        "update_p50": percentile(responses, 0.5),
+        "notify_p50": percentile(delays, 0.5),
+        "notify_p99": percentile(delays, 0.99),
+        "fanout_p50": percentile(fanouts, 0.5),
+        "fanout_p99": percentile(fanouts, 0.99),
+        "queries": queries / args.updates,
+        "lost": expected * args.updates - len(delays)}
+
+
+def measure(subscriptions, observers, args, results):
+    # Body of the process measuring one configuration
+    logging.disable(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    standin = params = None
+    if args.endpoint in (BLAZEGRAPH, FUSEKI):
+        standin = LocalSPARQLServer(latency=args.endpoint_latency).start()
+        params = standin.blazegraph_uri if args.endpoint == BLAZEGRAPH else standin.fuseki_uri
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        server = Thread(target=front.musepa, daemon=True, kwargs=dict(
+            a4="127.0.0.1", a6="::", port=args.port, endpoint=args.endpoint, params=params, event_loop=loop,
+            debounce=args.debounce))
+        server.start()
+        time.sleep(1)
+        try:
+            results.put(asyncio.run(fanout(f"coap://127.0.0.1:{args.port}", subscriptions, observers, args)))
+        except Exception:
+            results.put(None)
+            raise
+        finally:
+            asyncio.run_coroutine_threadsafe(front.shutdown(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            server.join(5)
+            if standin is not None:
+                standin.stop()
+
+
+def cell(column, value):
+    if value is None:
+        return "-"
+    elif column in TIMES:
+        return f"{value * 1000:.2f}"
+    elif isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+def main(args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    rows = []
+    print("".join(f"{column + (' ms' if column in TIMES else ''):>14}" for column in COLUMNS))
+    for subscriptions in args.subscriptions:
+        for observers in args.observers:
+            worker = context.Process(target=measure, args=(subscriptions, observers, args, results))
+            worker.start()
+            row = results.get()
+            worker.join()
+            if row is None:
+                print(f"{subscriptions} subscriptions, {observers} observers each: failed", file=sys.stderr)
+                continue
+            rows.append(row)
+            print("".join(f"{cell(column, row[column]):>14}" for column in COLUMNS), flush=True)
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as output:
+            writer = csv.DictWriter(output, COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subscriptions fan-out benchmark")
+    parser.add_argument("--subscriptions", default=integers("10,100,500"), type=integers,
+                        help="Numbers of subscriptions, comma separated (default 10,100,500)")
+    parser.add_argument("--observers", default=integers("1,10"), type=integers,
+                        help="Numbers of observers of each subscription, comma separated (default 1,10)")
+    parser.add_argument("--affected", default=1.0, type=float,
+                        help="Fraction of the subscriptions changed by the updates (default 1)")
+    parser.add_argument("--updates", default=20, type=int, help="Updates of each configuration (default 20)")
+    parser.add_argument("--timeout", default=10.0, type=float,
+                        help="Seconds waited for the notifications of an update (default 10)")
+    parser.add_argument("--endpoint", default=RDFLIB, choices=[RDFLIB, BLAZEGRAPH, FUSEKI],
+                        help="Endpoint (default rdflib), Blazegraph and Fuseki are emulated locally")
+    parser.add_argument("--endpoint_latency", default=0.0, type=float,
+                        help="Seconds added to each request to the emulated Blazegraph or Fuseki")
+    parser.add_argument("--debounce", default=0.0, type=float, help="Subscriptions coalescing window, in seconds")
+    parser.add_argument("--port", default=5683, type=int, help="CoAP port of the server (default 5683)")
+    parser.add_argument("--csv", default=None, help="CSV file of the results, times in seconds")
+    main(parser.parse_args())
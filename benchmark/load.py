@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  load.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Load generator: starts MUSEPA in this process over the rdflib (or
+compact) endpoint, or over Blazegraph or Fuseki emulated by a local
+server (see localsparql.py, --endpoint_latency), and drives it with
+concurrent CoAP clients, each with its own socket, sending a mix of
+
+    query      GET /sparql/query, the value of a random sensor
+    update     POST /sparql/update, a new value and timestamp of a sensor
+    subscribe  POST /sparql/subscription of a sensor, then observe until
+               the first response, and cancel
+
+for a fixed time, one request after the other. Meanwhile, long-lived
+observers watch some sensors: the delay from each timestamp written by an
+update to its notification is the notification latency. The throughput
+and the latency percentiles (seconds) are written as JSON:
+
+    $ python benchmark/load.py --clients 32 --mix query=8,update=1,subscribe=1 --output load.json
+
+The clients share the interpreter with the server: the figures are meant
+to be compared between versions on the same machine, not as the capacity
+of a deployment.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+
+from contextlib import redirect_stdout
+from os.path import abspath, dirname
+from threading import Thread
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import musepa as front  # noqa: E402
+
+from endpoint import BLAZEGRAPH, FUSEKI  # noqa: E402
+from localsparql import LocalSPARQLServer  # noqa: E402
+from aiocoap import Context, Message, GET, POST  # noqa: E402
+
+OPERATIONS = ["query", "update", "subscribe"]
+EX = "http://example.org/"
+
+QUERY = "SELECT ?v WHERE {{ <{ex}sensor{i}> <{ex}value> ?v }}"
+UPDATE = """DELETE WHERE {{ <{ex}sensor{i}> <{ex}value> ?v ; <{ex}stamp> ?t }} ;
+INSERT DATA {{ <{ex}sensor{i}> <{ex}value> {value} ; <{ex}stamp> {stamp!r} }}"""
+SUBSCRIPTION = "SELECT ?v ?t WHERE {{ <{ex}sensor{i}> <{ex}value> ?v ; <{ex}stamp> ?t }}"
+
+# Sensors inserted by each request of the initial load
+LOAD_CHUNK = 200
+
+
+def mix(text):
+    """Parses 'query=8,update=1,subscribe=1' into weights"""
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name}, choose among {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values, q):
+    """'q' percentile (0 to 1) of the sorted 'values'"""
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summary(latencies, errors, duration):
+    latencies.sort()
+    stats = {"count": len(latencies), "errors": errors, "throughput": len(latencies) / duration}
+    if latencies:
+        stats.update(mean=sum(latencies) / len(latencies), p50=percentile(latencies, 0.5),
+                     p95=percentile(latencies, 0.95), p99=percentile(latencies, 0.99), max=latencies[-1])
+    return stats
+
+
+class Load():
+    """Clients and their measures, between 'start' and 'stop' (perf_counter)"""
+
+    def __init__(self, address, args):
+        self.address = address
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.start = self.stop = None
+        self.latencies = {name: [] for name in OPERATIONS}
+        self.errors = {name: 0 for name in OPERATIONS}
+        self.notifications = []
+
+    def measuring(self, instant):
+        return self.start <= instant < self.stop
+
+    async def request(self, context, code, path, payload=b""):
+        response = await asyncio.wait_for(
+            context.request(Message(code=code, uri=self.address + path, payload=payload)).response,
+            self.args.timeout)
+        if not response.code.is_successful():
+            raise ValueError(f"{path} answered {response.code}")
+        return response
+
+    async def query(self, context):
+        await self.request(context, GET, "/sparql/query",
+                           QUERY.format(ex=EX, i=self.random.randrange(self.args.sensors)).encode())
+
+    async def update(self, context):
+        sparql = UPDATE.format(ex=EX, i=self.random.randrange(self.args.sensors),
+                               value=self.random.randrange(100), stamp=time.perf_counter())
+        await self.request(context, POST, "/sparql/update", sparql.encode())
+
+    async def subscribe(self, context):
+        sparql = SUBSCRIPTION.format(ex=EX, i=self.random.randrange(self.args.sensors))
+        alias = (await self.request(context, POST, "/sparql/subscription", sparql.encode())).payload.decode()
+        request = context.request(Message(code=GET, uri=f"{self.address}/{alias}", observe=0))
+        try:
+            response = await asyncio.wait_for(request.response, self.args.timeout)
+            if not response.code.is_successful():
+                raise ValueError(f"/{alias} answered {response.code}")
+        finally:
+            request.observation.cancel()
+
+    async def client(self, weights):
+        context = await Context.create_client_context()
+        operations = [getattr(self, name) for name in weights]
+        try:
+            while time.perf_counter() < self.stop:
+                operation = self.random.choices(operations, list(weights.values()))[0]
+                started = time.perf_counter()
+                try:
+                    await operation(context)
+                except Exception:
+                    if self.measuring(started):
+                        self.errors[operation.__name__] += 1
+                    continue
+                if self.measuring(started):
+                    self.latencies[operation.__name__].append(time.perf_counter() - started)
+        finally:
+            await context.shutdown()
+
+    async def observer(self, sensor):
+        context = await Context.create_client_context()
+        sparql = SUBSCRIPTION.format(ex=EX, i=sensor)
+        try:
+            alias = (await self.request(context, POST, "/sparql/subscription", sparql.encode())).payload.decode()
+            request = context.request(Message(code=GET, uri=f"{self.address}/{alias}", observe=0))
+            seen = None
+            async for notification in request.observation:
+                received = time.perf_counter()
+                if received >= self.stop:
+                    break
+                for binding in json.loads(notification.payload)["results"]["bindings"]:
+                    stamp = float(binding["t"]["value"])
+                    if stamp != seen and self.measuring(stamp):
+                        self.notifications.append(received - stamp)
+                    seen = stamp
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await context.shutdown()
+
+    async def populate(self):
+        context = await Context.create_client_context()
+        try:
+            for first in range(0, self.args.sensors, LOAD_CHUNK):
+                triples = " ".join(f"<{EX}sensor{i}> <{EX}value> {i % 100} ; <{EX}stamp> 0.0 ."
+                                   for i in range(first, min(first + LOAD_CHUNK, self.args.sensors)))
+                await self.request(context, POST, "/sparql/update", f"INSERT DATA {{ {triples} }}".encode())
+        finally:
+            await context.shutdown()
+
+    async def run(self):
+        await self.populate()
+        weights = {name: weight for name, weight in self.args.mix.items() if weight > 0}
+        self.start = time.perf_counter() + self.args.warmup
+        self.stop = self.start + self.args.duration
+        observers = [asyncio.ensure_future(self.observer(i % self.args.sensors)) for i in range(self.args.observers)]
+        await asyncio.gather(*(self.client(weights) for _ in range(self.args.clients)))
+        for observer in observers:
+            observer.cancel()
+        await asyncio.gather(*observers)
+
+    @property
+    def report(self):
+        duration = self.args.duration
+        operations = {name: summary(self.latencies[name], self.errors[name], duration)
+                      for name in OPERATIONS if name in self.args.mix}
+        return {
+            "config": {key: value for key, value in vars(self.args).items() if key != "output"},
+            "total": {
+                "count": sum(stats["count"] for stats in operations.values()),
+                "errors": sum(stats["errors"] for stats in operations.values()),
+                "throughput": sum(stats["throughput"] for stats in operations.values())},
+            "operations": operations,
+            "notifications": summary(self.notifications, 0, duration)}
+
+
+def main(args):
+    loop = asyncio.new_event_loop()
+    options = {"processes": args.processes} if args.processes else {}
+    standin = params = None
+    if args.endpoint in (BLAZEGRAPH, FUSEKI):
+        standin = LocalSPARQLServer(latency=args.endpoint_latency).start()
+        params = standin.blazegraph_uri if args.endpoint == BLAZEGRAPH else standin.fuseki_uri
+    server = Thread(target=front.musepa, daemon=True, kwargs=dict(
+        a4="127.0.0.1", a6="::", port=args.port, endpoint=args.endpoint, event_loop=loop,
+        params=params, endpoint_options=options, debounce=args.debounce))
+    load = Load(f"coap://127.0.0.1:{args.port}", args)
+    # the standard output is kept for the report
+    with redirect_stdout(sys.stderr):
+        server.start()
+        time.sleep(1)
+        try:
+            asyncio.run(load.run())
+        finally:
+            asyncio.run_coroutine_threadsafe(front.shutdown(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            server.join(5)
+            if standin is not None:
+                standin.stop()
+    report = json.dumps(load.report, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MUSEPA load generator")
+    parser.add_argument("--clients", default=16, type=int, help="Concurrent clients (default 16)")
+    parser.add_argument("--mix", default=mix("query=8,update=1,subscribe=1"), type=mix,
+                        help="Weights of the operations (default query=8,update=1,subscribe=1)")
+    parser.add_argument("--observers", default=10, type=int,
+                        help="Long-lived observers of the sensors, for the notification latency (default 10)")
+    parser.add_argument("--sensors", default=100, type=int, help="Sensors in the store (default 100)")
+    parser.add_argument("--duration", default=10.0, type=float, help="Seconds measured (default 10)")
+    parser.add_argument("--warmup", default=1.0, type=float, help="Seconds run before measuring (default 1)")
+    parser.add_argument("--timeout", default=5.0, type=float, help="Seconds before a request fails (default 5)")
+    parser.add_argument("--endpoint", default="rdflib", choices=["rdflib", "compact", BLAZEGRAPH, FUSEKI],
+                        help="Endpoint (default rdflib), Blazegraph and Fuseki are emulated locally")
+    parser.add_argument("--endpoint_latency", default=0.0, type=float,
+                        help="Seconds added to each request to the emulated Blazegraph or Fuseki")
+    parser.add_argument("--processes", default=None, type=int, help="Query processes of the endpoint")
+    parser.add_argument("--debounce", default=0.0, type=float, help="Subscriptions coalescing window, in seconds")
+    parser.add_argument("--port", default=5683, type=int, help="CoAP port of the server (default 5683)")
+    parser.add_argument("--seed", default=None, type=int, help="Seed of the random operations")
+    parser.add_argument("--output", default=None, help="JSON report file, instead of the standard output")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    main(args)
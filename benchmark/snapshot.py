@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  snapshot.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Benchmark of the binary snapshots against Turtle round trips: time to
+write the store to a file, and to restore it, for the rdflib in-memory
+store and the CompactStore.
+
+    $ python benchmark/snapshot.py --sensors 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from rdflib import Graph  # noqa: E402
+from compactstore import CompactStore  # noqa: E402
+from snapshot import dump, load  # noqa: E402
+from store import sensors  # noqa: E402
+
+STORES = {"rdflib Memory": Graph, "CompactStore": lambda: Graph(store=CompactStore())}
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main(args):
+    directory = tempfile.mkdtemp()
+    turtle, binary = join(directory, "store.ttl"), join(directory, "store.snapshot")
+    for name, store in STORES.items():
+        graph = store()
+        graph.addN((s, p, o, graph) for s, p, o in sensors(args.sensors))
+        print(f"{name}: {len(graph)} triples")
+        results = {
+            "Turtle": (
+                timed(lambda: graph.serialize(turtle, format="turtle")),
+                timed(lambda: store().parse(turtle, format="turtle")),
+                os.path.getsize(turtle)),
+            "snapshot": (
+                timed(lambda: dump(graph, binary)),
+                timed(lambda: load(store(), binary)),
+                os.path.getsize(binary))}
+        for method, (write, read, size) in results.items():
+            print(f"{method:>12}: write {write:7.2f} s, restore {read:7.2f} s "
+                  f"({size / 1e6:.1f} MB, {size / read / 1e6:.1f} MB/s)")
+        os.remove(turtle)
+        os.remove(binary)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snapshot benchmark")
+    parser.add_argument("--sensors", default=20000, type=int, help="Sensors, six triples each (default 20000)")
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  store.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Benchmark of the rdflib in-memory store against the CompactStore: memory
+taken by the triples, loading time, and time of some basic graph patterns.
+
+    $ python benchmark/store.py --sensors 100000
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from rdflib import Graph, Literal, Namespace, RDF  # noqa: E402
+from compactstore import CompactStore  # noqa: E402
+
+EX = Namespace("http://example.org/")
+
+QUERIES = {
+    "lookup": "SELECT ?v WHERE { <http://example.org/sensor42> <http://example.org/value> ?v }",
+    "star": """SELECT ?s ?v ?r WHERE {
+        ?s a <http://example.org/Sensor> ; <http://example.org/room> <http://example.org/room7> ;
+           <http://example.org/value> ?v ; <http://example.org/room> ?r }""",
+    "path join": """SELECT ?s ?f WHERE {
+        ?s <http://example.org/room> ?r . ?r <http://example.org/floor> ?f . ?s <http://example.org/value> 42 }""",
+}
+
+
+def sensors(count):
+    """Six triples a sensor"""
+    for i in range(count):
+        sensor = EX[f"sensor{i}"]
+        room = EX[f"room{i % 1000}"]
+        yield sensor, RDF.type, EX.Sensor
+        yield sensor, EX.room, room
+        yield sensor, EX.value, Literal(i % 100)
+        yield sensor, EX.label, Literal(f"sensor number {i}")
+        yield room, EX.floor, Literal(i % 1000 // 100)
+        yield room, RDF.type, EX.Room
+
+
+def measure(name, graph, count, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    graph.addN((s, p, o, graph) for s, p, o in sensors(count))
+    loaded = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{name}: {len(graph)} triples, {memory / 1e6:.1f} MB "
+          f"({memory / len(graph):.0f} B/triple), loaded in {loaded:.1f} s")
+    for query, text in QUERIES.items():
+        results = len(graph.query(text))
+        best = min(timeit(lambda: len(graph.query(text))) for _ in range(repeat))
+        print(f"{query:>16}: {best * 1000:8.1f} ms  ({results} results)")
+
+
+def timeit(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def main(args):
+    measure("rdflib Memory", Graph(), args.sensors, args.repeat)
+    measure("CompactStore", Graph(store=CompactStore()), args.sensors, args.repeat)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="In-memory stores benchmark")
+    parser.add_argument("--sensors", default=20000, type=int, help="Sensors, six triples each (default 20000)")
+    parser.add_argument("--repeat", default=3, type=int, help="Repetitions, the best is kept (default 3)")
+    main(parser.parse_args())
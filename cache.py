@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  cache.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+
+from collections import OrderedDict
+from canonical import normalize
+
+DEFAULT_CACHE_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache():
+    """Bounded LRU cache of query results.
+
+    Results are cached together with the version of the RDF store they were
+    computed on: a store version is an integer that grows at each update, so
+    that a result is never returned once the store has changed.
+
+    Parameters
+    ----------
+    size : int, optional
+        defaults to DEFAULT_CACHE_SIZE, maximum number of results kept. 0
+        disables the cache
+    """
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {
+            "size": self.size,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations}
+
+    def _check_version(self, version):
+        # entries of older versions can never be hit again
+        if self._version is None or version > self._version:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._version = version
+
+    def get(self, query, version):
+        """Returns the result of 'query' on the store 'version', or None if
+        it is not cached"""
+        if not self.size:
+            return None
+        self._check_version(version)
+        key = normalize(query)
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, query, version, result):
+        """Caches the 'result' of 'query' computed on the store 'version'.
+        'version' should be read before sending the query to the store."""
+        if not self.size:
+            return
+        self._check_version(version)
+        if version < self._version:
+            # the store changed while the query was running
+            return
+        key = normalize(query)
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
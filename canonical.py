@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  canonical.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import re
+
+from hashlib import md5
+from pyparsing import ParseResults
+from rdflib import BNode, Variable
+from rdflib.paths import Path
+from rdflib.term import Identifier
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from endpoint import parse_lock
+
+COMMENT = "comment"
+STRING = "string"
+IRI = "iri"
+VAR = "var"
+SPACE = "space"
+OTHER = "other"
+
+# Lexer of the SPARQL text: just enough to tell which characters belong to
+# strings, IRIs, variables and comments, that must not be normalized as the
+# rest of the text
+_TOKEN_REGEX = re.compile("|".join([
+    r"(?P<{}>#[^\n]*)".format(COMMENT),
+    r"(?P<{}>'''(?:[^'\\]|\\.|'(?!''))*'''|\"\"\"(?:[^\"\\]|\\.|\"(?!\"\"))*\"\"\"|'(?:[^'\\\n]|\\.)*'|\"(?:[^\"\\\n]|\\.)*\")".format(STRING),
+    r"(?P<{}><[^<>\"{{}}|^`\\\x00-\x20]*>)".format(IRI),
+    r"(?P<{}>[?$]\w+)".format(VAR),
+    r"(?P<{}>\s+)".format(SPACE),
+    r"(?P<{}>[^\s#'\"<?$]+|.)".format(OTHER)]), re.DOTALL)
+
+# Prefix of the names given to the renamed variables
+CANONICAL_VAR = "_v"
+
+logger = logging.getLogger(__name__)
+
+
+def tokens(text):
+    """Splits a SPARQL text in (kind, value) tokens, where kind is one of
+    COMMENT, STRING, IRI, VAR, SPACE, OTHER"""
+    for match in _TOKEN_REGEX.finditer(text):
+        yield match.lastgroup, match.group()
+
+
+def normalize(text):
+    """Removes comments and collapses whitespace of a SPARQL text, leaving
+    strings and IRIs untouched. Two texts that differ only in layout are
+    normalized to the same text."""
+    result = []
+    for kind, value in tokens(text):
+        if kind == COMMENT or kind == SPACE:
+            if result and result[-1] != " ":
+                result.append(" ")
+        else:
+            result.append(value)
+    return "".join(result).strip()
+
+
+def _variables(node):
+    # (container, key, variable) of each variable of a parse tree, in
+    # order of appearance
+    if isinstance(node, dict):
+        children = node.items()
+    elif isinstance(node, (list, ParseResults)):
+        children = enumerate(node)
+    else:
+        return
+    for key, child in list(children):
+        if isinstance(child, Variable):
+            yield node, key, child
+        else:
+            yield from _variables(child)
+
+
+def _rename(parsed, kept):
+    # Renames in place the variables of a parse tree that are not in
+    # 'kept', in order of appearance. The tree is renamed, not the text:
+    # the text cannot always be split correctly without parsing it, e.g.
+    # '?y<3&&?z>5' reads as an IRI
+    found = list(_variables(parsed))
+    names = {str(variable) for _, _, variable in found}
+    prefix = CANONICAL_VAR
+    while any(name.startswith(prefix) for name in names):
+        prefix = "_" + prefix
+    mapping = {}
+    for container, key, variable in found:
+        if str(variable) not in kept:
+            container[key] = Variable(mapping.setdefault(str(variable), "{}{}".format(prefix, len(mapping))))
+
+
+class _BlankNodeFound(Exception):
+    pass
+
+
+def _dump(node):
+    # Deterministic text of an algebra expression. Keys starting with '_' are
+    # caches of rdflib (e.g. in-scope variables), and can be skipped
+    if isinstance(node, CompValue):
+        # projections are dumped as sets: the order of the variables of
+        # 'SELECT *' is not deterministic, and only the one of the outermost
+        # explicit projection matters (see canonical_alias)
+        return "{}({})".format(node.name, ",".join(
+            "{}={}".format(k, _dump(set(v) if k == "PV" else v))
+            for k, v in node.items() if not k.startswith("_")))
+    elif isinstance(node, BNode):
+        # blank node labels are random: the algebra is not deterministic
+        raise _BlankNodeFound()
+    elif isinstance(node, (Identifier, Path)):
+        return node.n3()
+    elif isinstance(node, dict):
+        return "{{{}}}".format(",".join(sorted(
+            "{}:{}".format(_dump(k), _dump(v)) for k, v in node.items())))
+    elif isinstance(node, (set, frozenset)):
+        return "{{{}}}".format(",".join(sorted(_dump(item) for item in node)))
+    elif isinstance(node, (list, tuple)):
+        return "[{}]".format(",".join(_dump(item) for item in node))
+    return repr(node)
+
+
+def canonical_alias(sparql, initNs=None):
+    """Alias of a subscription query, shared by all the queries that are
+    the same but for layout, comments, prefix declarations, keyword case,
+    syntactic shortcuts and the names of the variables that are not
+    projected (the projected ones name the results, so they are kept).
+
+    Parameters
+    ----------
+    sparql : str
+        the query
+
+    initNs : dict, optional
+        prefixes that are not declared in the query
+
+    Returns
+    -------
+    str
+        md5 hex digest of the canonical form of the query. If the query
+        cannot be parsed, the digest of its text
+    """
+    initNs = initNs if initNs else {}
+    try:
+        with parse_lock:
+            parsed = parseQuery(sparql)
+            algebra = translateQuery(parsed, initNs=initNs).algebra
+        kept, projection = set(), []
+        if algebra.name == "SelectQuery":
+            kept = {str(v) for v in algebra["PV"]}
+            if "projection" in parsed[1]:
+                # explicit projections also fix the order of the variables
+                projection = [str(v) for v in algebra["PV"]]
+        try:
+            with parse_lock:
+                # translated again, since the order of the patterns in the
+                # algebra depends on the names of the variables
+                renamed = parseQuery(sparql)
+                _rename(renamed, kept)
+                algebra = translateQuery(renamed, initNs=initNs).algebra
+            canonical = _dump(algebra)
+            canonical += "|" + ",".join(projection)
+        except _BlankNodeFound:
+            canonical = normalize(sparql)
+    except Exception as e:
+        logger.warning(f"Unable to build the canonical form of the query: {e}")
+        canonical = sparql
+    return md5(canonical.encode()).hexdigest()
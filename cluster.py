@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  cluster.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import musepa as front
+
+from collections import defaultdict
+from multiprocessing.connection import wait
+from aiocoap.defaults import has_reuse_port
+from endpoint import BLAZEGRAPH, FUSEKI
+
+# Messages between the MUSEPA processes of a cluster:
+#   (UPDATED, updates)  the store was changed, see musepa.updated
+#   (SUBSCRIBED, alias, sparql)  a subscription was created
+#   (ATTACHED, alias, sparql, pid)  process 'pid' has its first client of it
+#   (DETACHED, alias, pid)  the last client of it there left
+UPDATED = "updated"
+SUBSCRIBED = "subscribed"
+ATTACHED = "attached"
+DETACHED = "detached"
+
+# Endpoints shared by the processes: the rdflib ones live in a process
+CLUSTER_ENDPOINTS = [BLAZEGRAPH, FUSEKI]
+
+# Updates longer than this, in characters, are announced without their
+# content: the other processes re-evaluate all their subscriptions
+MAX_ANNOUNCED_CONTENT = 1 << 16
+
+# Seconds given to the processes to stop by themselves
+STOP_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterLink():
+    """Link of a MUSEPA process to the others of its cluster, through the
+    parent process: it announces the updates and the subscriptions made
+    here, and applies the ones made elsewhere.
+
+    Each process keeps the subscriptions of the whole cluster, since the
+    kernel sends each client to one of them, but evaluates only the ones
+    observed there (see musepa.SubscriptionResource.rescheduleNow). A
+    subscription is removed once no process has clients of it anymore.
+
+    Parameters
+    ----------
+    connection : multiprocessing.connection.Connection
+        to the parent process
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.loop = None
+        self.pid = os.getpid()
+        # alias -> pids of the other processes having clients of it
+        self.holders = defaultdict(set)
+
+    def attach(self, loop):
+        """Applies the announcements of the other processes on 'loop'"""
+        self.loop = loop
+        loop.add_reader(self.connection.fileno(), self._receive)
+
+    def _send(self, message):
+        try:
+            self.connection.send(message)
+        except OSError as e:
+            logger.error(f"Unable to reach the cluster: {e}")
+
+    def updated(self, updates):
+        if updates is not None and sum(len(content) for content, _ in updates) > MAX_ANNOUNCED_CONTENT:
+            updates = None
+        self._send((UPDATED, updates))
+
+    def subscribed(self, alias, content):
+        self._send((SUBSCRIBED, alias, content))
+
+    def attached(self, alias, content):
+        self._send((ATTACHED, alias, content, self.pid))
+
+    def detached(self, alias):
+        self._send((DETACHED, alias, self.pid))
+
+    def held(self, alias):
+        """True if other processes have clients of the subscription"""
+        return bool(self.holders.get(alias))
+
+    def _receive(self):
+        try:
+            message = self.connection.recv()
+        except (EOFError, OSError):
+            logger.critical("Lost the link to the cluster: stopping")
+            self.loop.remove_reader(self.connection.fileno())
+            self.loop.stop()
+            return
+        kind = message[0]
+        if kind == UPDATED:
+            front.updated(message[1], publish=False)
+        elif kind == SUBSCRIBED:
+            front.mirror(message[1], message[2])
+        elif kind == ATTACHED:
+            _, alias, content, pid = message
+            self.holders[alias].add(pid)
+            # the subscription may have been given up here meanwhile
+            front.mirror(alias, content)
+        elif kind == DETACHED:
+            _, alias, pid = message
+            self.holders[alias].discard(pid)
+            if not self.holders[alias]:
+                del self.holders[alias]
+            front.unmirror(alias)
+
+
+def relay(connections):
+    """Sends each message received on one of the 'connections' to all the
+    others, until they are all closed. Run by the parent process."""
+    live = list(connections)
+    while live:
+        for connection in wait(live):
+            try:
+                message = connection.recv_bytes()
+            except (EOFError, OSError):
+                live.remove(connection)
+                continue
+            for other in live:
+                if other is not connection:
+                    try:
+                        other.send_bytes(message)
+                    except OSError as e:
+                        logger.error(f"Unable to relay to a cluster process: {e}")
+
+
+def _work(connection, options):
+    # Body of the cluster processes
+    front.cluster_link = ClusterLink(connection)
+    front.musepa(event_loop=asyncio.new_event_loop(), **options)
+
+
+def cluster(processes, endpoint=BLAZEGRAPH, **options):
+    """Runs 'processes' MUSEPA servers on the same port (SO_REUSEPORT),
+    over the same Blazegraph or Fuseki endpoint. Blocks until they stop.
+
+    Parameters
+    ----------
+    processes : int
+        number of MUSEPA processes
+
+    endpoint : str, optional
+        defaults to 'blazegraph', or 'fuseki'
+
+    options : keyword arguments, optional
+        forwarded to musepa.musepa, e.g. 'port', 'params', 'endpoint_options'
+
+    Raises
+    ------
+    ValueError
+        if the endpoint keeps the store in the MUSEPA process (rdflib and
+        compact): each process would have its own
+
+    OSError
+        if the platform does not have SO_REUSEPORT
+    """
+    if endpoint.lower() not in CLUSTER_ENDPOINTS:
+        errorMsg = f"Cluster mode needs a shared endpoint ({', '.join(CLUSTER_ENDPOINTS)}), not {endpoint}"
+        logger.critical(errorMsg)
+        raise ValueError(errorMsg)
+    if not has_reuse_port():
+        raise OSError("Cluster mode needs SO_REUSEPORT")
+
+    context = multiprocessing.get_context("spawn")
+    connections, workers = [], []
+    for i in range(processes):
+        connection, child = context.Pipe()
+        worker = context.Process(
+            target=_work, args=(child, dict(options, endpoint=endpoint)), name=f"MUSEPA-{i}")
+        worker.start()
+        child.close()
+        connections.append(connection)
+        workers.append(worker)
+    logger.info(f"Cluster of {processes} MUSEPA processes started")
+    try:
+        relay(connections)
+    except KeyboardInterrupt:
+        logger.info("Received keyboard interrupt: shutting down the cluster!")
+    finally:
+        for worker in workers:
+            worker.join(STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  encoding.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import json
+import csv
+import io
+import struct
+import tracing
+
+from hashlib import sha1
+
+# CoAP Content-Format numbers of the result encodings. CSV and TSV have no
+# registered number: they use the experimental range.
+JSON = 50   # application/json, SPARQL 1.1 Query Results JSON
+CBOR = 60   # application/cbor, see encode_cbor
+CSV = 65000  # text/csv, SPARQL 1.1 Query Results CSV
+TSV = 65001  # text/tab-separated-values, SPARQL 1.1 Query Results TSV
+
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+XSD_BOOLEAN = "http://www.w3.org/2001/XMLSchema#boolean"
+
+logger = logging.getLogger(__name__)
+
+
+def etag(payload):
+    """ETag of a result payload: the first 8 bytes of its sha1 digest"""
+    return sha1(payload).digest()[:8]
+
+
+def _cbor_head(major, value):
+    if value < 24:
+        return bytes([major << 5 | value])
+    elif value < 0x100:
+        return bytes([major << 5 | 24, value])
+    elif value < 0x10000:
+        return bytes([major << 5 | 25]) + struct.pack(">H", value)
+    elif value < 0x100000000:
+        return bytes([major << 5 | 26]) + struct.pack(">I", value)
+    return bytes([major << 5 | 27]) + struct.pack(">Q", value)
+
+
+def cbor_dumps(item):
+    """Minimal CBOR (RFC 8949) encoder of None, bool, int, float, str,
+    bytes, list, tuple and dict"""
+    out = []
+
+    def dump(item):
+        if item is None:
+            out.append(b"\xf6")
+        elif item is True:
+            out.append(b"\xf5")
+        elif item is False:
+            out.append(b"\xf4")
+        elif isinstance(item, int):
+            if not -2 ** 64 <= item < 2 ** 64:
+                raise ValueError(f"Integer out of CBOR range: {item}")
+            out.append(_cbor_head(0, item) if item >= 0 else _cbor_head(1, -1 - item))
+        elif isinstance(item, float):
+            out.append(b"\xfb" + struct.pack(">d", item))
+        elif isinstance(item, str):
+            data = item.encode()
+            out.append(_cbor_head(3, len(data)))
+            out.append(data)
+        elif isinstance(item, bytes):
+            out.append(_cbor_head(2, len(item)))
+            out.append(item)
+        elif isinstance(item, (list, tuple)):
+            out.append(_cbor_head(4, len(item)))
+            for element in item:
+                dump(element)
+        elif isinstance(item, dict):
+            out.append(_cbor_head(5, len(item)))
+            for key, value in item.items():
+                dump(key)
+                dump(value)
+        else:
+            raise TypeError(f"Unable to encode {type(item)} in CBOR")
+
+    dump(item)
+    return b"".join(out)
+
+
+def _boolean(result):
+    # ASK result
+    return isinstance(result, dict) and "boolean" in result
+
+
+def _table(result):
+    # Variables and bindings of a SELECT result, checked since the encoders
+    # also get other JSON results, e.g. the JSON-LD of CONSTRUCT queries
+    try:
+        variables, bindings = result["head"]["vars"], result["results"]["bindings"]
+    except (TypeError, KeyError):
+        raise ValueError("Not a SPARQL JSON result: only JSON is available")
+    if not isinstance(variables, list) or not isinstance(bindings, list):
+        raise ValueError("Not a SPARQL JSON result: only JSON is available")
+    return variables, bindings
+
+
+def encode_cbor(result, compact=str):
+    """Encodes a SPARQL JSON result in CBOR. IRIs, datatypes included, are
+    written once in the 'iris' list, and referenced by their index:
+
+        {"vars": [names], "iris": [IRIs], "bindings": [[term, ...], ...]}
+
+    Each binding has one term for each variable, in the order of 'vars':
+    - unbound variable: null
+    - IRI: its index in 'iris'
+    - blank node: [label]
+    - xsd:integer and xsd:boolean literals: CBOR integer and boolean
+    - literals with datatype: [value, index of the datatype in 'iris']
+    - literals with language: [value, language]
+    - other literals: text
+
+    ASK results are encoded as {"boolean": true/false}.
+
+    Parameters
+    ----------
+    result : dict
+        the SPARQL JSON result
+
+    compact : function, optional
+        applied to each IRI, e.g. to replace namespaces with prefixes
+
+    Raises
+    ------
+    ValueError
+        if 'result' is not a SPARQL JSON result
+    """
+    if _boolean(result):
+        return cbor_dumps({"boolean": result["boolean"]})
+    variables, rows = _table(result)
+    iris = {}
+
+    def iri(value):
+        return iris.setdefault(compact(value), len(iris))
+
+    def term(node):
+        if node is None:
+            return None
+        kind, value = node["type"], node["value"]
+        if kind == "uri":
+            return iri(value)
+        elif kind == "bnode":
+            return [value]
+        datatype = node.get("datatype")
+        if datatype == XSD_INTEGER and value.lstrip("-").isdigit() and str(int(value)) == value:
+            return int(value)
+        elif datatype == XSD_BOOLEAN and value in ("true", "false"):
+            return value == "true"
+        elif datatype is not None:
+            return [value, iri(datatype)]
+        elif "xml:lang" in node:
+            return [value, node["xml:lang"]]
+        return value
+
+    bindings = [[term(b.get(v)) for v in variables] for b in rows]
+    return cbor_dumps({"vars": variables, "iris": list(iris), "bindings": bindings})
+
+
+def _tsv_term(node, compact):
+    kind, value = node["type"], node["value"]
+    if kind == "uri":
+        compacted = compact(value)
+        return compacted if compacted != value else f"<{value}>"
+    elif kind == "bnode":
+        return f"_:{value}"
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+    if "xml:lang" in node:
+        return f'"{escaped}"@{node["xml:lang"]}'
+    elif "datatype" in node:
+        datatype = compact(node["datatype"])
+        if datatype == node["datatype"]:
+            datatype = f"<{datatype}>"
+        return f'"{escaped}"^^{datatype}'
+    return f'"{escaped}"'
+
+
+def encode_tsv(result, compact=str):
+    """Encodes a SPARQL JSON result in TSV: terms are written as in Turtle,
+    IRIs with a prefix without angle brackets"""
+    if _boolean(result):
+        raise ValueError("Boolean results have no TSV encoding")
+    variables, rows = _table(result)
+    lines = ["\t".join(f"?{v}" for v in variables)]
+    for b in rows:
+        lines.append("\t".join(
+            _tsv_term(b[v], compact) if v in b else "" for v in variables))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def encode_csv(result, compact=str):
+    """Encodes a SPARQL JSON result in CSV: only the values of the terms are
+    written, without types and languages"""
+    if _boolean(result):
+        raise ValueError("Boolean results have no CSV encoding")
+    variables, rows = _table(result)
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\r\n")
+    writer.writerow(variables)
+    for b in rows:
+        row = []
+        for v in variables:
+            node = b.get(v)
+            if node is None:
+                row.append("")
+            elif node["type"] == "uri":
+                row.append(compact(node["value"]))
+            elif node["type"] == "bnode":
+                row.append(f"_:{node['value']}")
+            else:
+                row.append(node["value"])
+        writer.writerow(row)
+    return text.getvalue().encode()
+
+
+ENCODERS = {CBOR: encode_cbor, TSV: encode_tsv, CSV: encode_csv}
+CONTENT_FORMATS = [JSON] + list(ENCODERS)
+
+
+class EncodedResult():
+    """A query result and its encodings, each one produced once and shared
+    by all the clients that ask for it.
+
+    Parameters
+    ----------
+    result : bytes
+        the SPARQL JSON result, as given by the endpoint
+
+    prefixes : prefix.Prefixes
+        prefixes applied to the IRIs of every encoding
+    """
+    def __init__(self, result, prefixes):
+        self.result = result
+        self._prefixes = prefixes
+        self._parsed = None
+        self._encodings = {}
+
+    def get(self, content_format=JSON):
+        """Returns the result encoded as 'content_format', and its ETag.
+
+        Raises
+        ------
+        ValueError
+            if the result cannot be encoded in 'content_format'
+        """
+        encoding = self._encodings.get(content_format)
+        if encoding is None:
+            if content_format == JSON:
+                with tracing.span("prefixes"):
+                    payload = self._prefixes.applyTo(self.result)
+            elif content_format in ENCODERS:
+                with tracing.span("encode", content_format=content_format):
+                    if self._parsed is None:
+                        self._parsed = json.loads(self.result)
+                    compactor = self._prefixes.compactor
+                    payload = ENCODERS[content_format](
+                        self._parsed, compact=lambda iri: compactor.compact(iri.encode()).decode())
+            else:
+                raise ValueError(f"Unavailable content format {content_format}")
+            encoding = self._encodings[content_format] = (payload, etag(payload))
+        return encoding
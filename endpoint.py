@@ -10,9 +10,29 @@
 
 import requests
 import logging
+import asyncio
+import threading
+import time
+import re
+import os
+import tempfile
+import tracing
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from functools import partial
+from requests.adapters import HTTPAdapter
 from rdflib import Graph
+from rdflib.plugins.stores.auditable import AuditableStore
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+from ingest import parse_batches, DEFAULT_BATCH_SIZE
+from compactstore import CompactStore
+from sqlitestore import SQLiteStore
+from snapshot import dump, load
+from procpool import JournalStore, ReplicaPool
 
 CONTENT_TYPE = "Content-Type"
 SPARQL = "sparql"
@@ -21,15 +41,42 @@ BLAZEGRAPH_CONST = "http://localhost:9999/bigdata/sparql"
 RDFLIB = "rdflib"
 BLAZEGRAPH = "blazegraph"
 FUSEKI = "fuseki"
+COMPACT = "compact"
+
+# Defaults for the HTTP endpoints connection pool. The pool size is also the
+# number of worker threads that can talk to the endpoint at the same time,
+# i.e. how many subscriptions can be re-evaluated concurrently after an update
+DEFAULT_POOL_SIZE = 32
+DEFAULT_TIMEOUT = 30.0
+
+# Number of parsed queries kept by the rdflib endpoint
+DEFAULT_PREPARED_SIZE = 128
+
+# The rdflib SPARQL parser is not thread safe: all the parsing in the process
+# is done holding this lock
+parse_lock = threading.Lock()
 
 logger = logging.getLogger("endpoint")
 logFormat = "%(levelname)s   %(asctime)-15s %(filename)s[%(lineno)d] : %(message)s"
 logging.basicConfig(level=logging.INFO, format=logFormat)
 
-AVAILABLE_ENDPOINTS = [RDFLIB, BLAZEGRAPH, FUSEKI]
+AVAILABLE_ENDPOINTS = [RDFLIB, BLAZEGRAPH, FUSEKI, COMPACT]
+
+# Keyword options accepted by get_endpoint, for each endpoint
+ENDPOINT_OPTIONS = {
+    RDFLIB: ("workers", "prepared_size", "processes"),
+    COMPACT: ("workers", "prepared_size", "processes"),
+    BLAZEGRAPH: ("pool_size", "timeout", "keep_alive"),
+    FUSEKI: ("pool_size", "timeout", "keep_alive")}
+
 
+def in_context(function, *args, **kwargs):
+    """'function' bound to its arguments, to be run in an executor with the
+    context variables of the caller, e.g. the running trace"""
+    return partial(copy_context().run, function, *args, **kwargs)
 
-def get_endpoint(id, params=None):
+
+def get_endpoint(id, params=None, **options):
     """Invokes the correct RDF store endpoint constructor.
 
     Parameters
@@ -39,7 +86,14 @@ def get_endpoint(id, params=None):
         variable
 
     params : depends on the endpoint, optional
-        default to None, for 'blazegraph' is a string that contains its uri
+        default to None, for 'blazegraph' is a string that contains its uri,
+        for 'rdflib' the path of a SQLite file where the triples are kept
+        (see sqlitestore.SQLiteStore), instead of memory
+
+    options : keyword arguments, optional
+        forwarded to the endpoint constructor, e.g. 'pool_size', 'timeout'
+        and 'keep_alive' for 'blazegraph' and 'fuseki', 'workers' and
+        'processes' for 'rdflib' and 'compact'
 
     Raises
     ------
@@ -61,28 +115,36 @@ def get_endpoint(id, params=None):
     if id.lower() == BLAZEGRAPH:
         # raising exception if blazegraph is requested, but no running
         # instance is available
-        blazegraph_ip = params if params else BLAZEGRAPH_CONST
-        if requests.get(blazegraph_ip).status_code != requests.codes.ok:
-            errorMsg = "Blazegraph is not reachable at {}".format(blazegraph_ip)
+        blazegraph = Blazegraph(params, **options)
+        if not blazegraph.reachable():
+            errorMsg = "Blazegraph is not reachable at {}".format(blazegraph.endpoint_uri)
             logger.critical(errorMsg)
             raise ConnectionError(errorMsg)
         logger.info("Ready to work with Blazegraph!")
-        return Blazegraph(blazegraph_ip)
+        return blazegraph
     elif id.lower() == FUSEKI:
         if params is None:
             # params will contain something like http://localhost:3030/{dataset}
             errorMsg = "For Fuseki endpoint, the endpoint parameter is compulsory"
             logger.critical(errorMsg)
             raise ValueError(errorMsg)
-        if requests.get(params).status_code != requests.codes.ok:
+        fuseki = Fuseki(params, **options)
+        if not fuseki.reachable():
             errorMsg = "Fuseki is not reachable at {}".format(params)
             logger.critical(errorMsg)
             raise ConnectionError(errorMsg)
         logger.info("Ready to work with Fuseki!")
-        return Fuseki(params)
+        return fuseki
     elif id.lower() == RDFLIB:
+        if params:
+            logger.info(f"Ready to work with RDFLib, on {params}!")
+            return RDFLibEndpoint(store=SQLiteStore(params), **options)
         logger.info("Ready to work with RDFLib!")
-        return RDFLibEndpoint()
+        return RDFLibEndpoint(**options)
+    elif id.lower() == COMPACT:
+        # rdflib, on the dictionary encoded store
+        logger.info("Ready to work with RDFLib on the compact store!")
+        return RDFLibEndpoint(store=CompactStore(), **options)
     else:
         error = "'{}' not found in the available RDF endpoints list".format(id)
         logger.error(error)
@@ -100,7 +162,46 @@ class RDFEndpoint(ABC):
 
     update(content)
         Makes the update available in 'content' to the RDF endpoint.
+
+    async_query(sparql)
+        Awaitable version of query, that does not block the event loop.
+
+    async_update(content, format)
+        Awaitable version of update, that does not block the event loop.
+
+    update_many(updates)
+        Makes many updates at once, atomically.
+
+    async_update_many(updates)
+        Awaitable version of update_many.
+
+    ingest(chunks, format)
+        Loads a ttl or n3 content while it is being received.
+
+    async_ingest(chunks, format)
+        Awaitable version of ingest.
+
+    bind_prefixes(prefixes)
+        Declares the prefixes that SPARQL queries and updates can use.
     """
+    # Executor in which the blocking calls are run by the async methods.
+    # None means the default executor of the running event loop.
+    executor = None
+    # PREFIX declarations added to the SPARQL sent to the endpoint
+    prefix_header = ""
+
+    def bind_prefixes(self, prefixes):
+        """Declares the prefixes that SPARQL queries and updates can use
+        without declaring them.
+
+        Parameters
+        ----------
+        prefixes : dict
+            namespaces by tag, e.g. {"rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#"}
+        """
+        self.prefix_header = "".join(
+            f"PREFIX {tag}: <{namespace}>\n" for tag, namespace in prefixes.items())
+
     @abstractmethod
     def query(self, sparql):
         """Queries the RDF endpoint.
@@ -135,26 +236,205 @@ class RDFEndpoint(ABC):
         """
         pass
 
+    async def async_query(self, sparql):
+        """Queries the RDF endpoint without blocking the event loop: the
+        blocking call is run in the endpoint executor.
+
+        Parameters
+        ----------
+        sparql : str
+            The SPARQL query to be done
+
+        Returns
+        -------
+        tuple (str, requests.status_code)
+            same as query
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, in_context(self.query, sparql))
+
+    async def async_update(self, content, format=SPARQL):
+        """Makes the update available in 'content' to the RDF endpoint
+        without blocking the event loop: the blocking call is run in the
+        endpoint executor.
+
+        Parameters
+        ----------
+        content : str
+            The update to be done: may be SPARQL Update, .ttl, .n3
+
+        format : str, optional
+            defaults to 'sparql', this parameter tells the code how to
+            interpret the content string
+
+        Returns
+        -------
+        tuple (response, requests.status_code)
+            same as update
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, in_context(self.update, content, format=format))
+
+    def update_many(self, updates):
+        """Makes many updates at once, atomically: either all of them or
+        none are applied. By default, they are sent as a single SPARQL
+        Update request, in which ttl and n3 contents become INSERT DATA
+        operations.
+
+        Parameters
+        ----------
+        updates : list of tuples (content, format)
+            the updates, in order of application. See update
+
+        Returns
+        -------
+        tuple (response, requests.status_code)
+            same as update
+        """
+        try:
+            update = " ;\n".join(
+                content if format.lower() == SPARQL else insert_data(content, format)
+                for content, format in updates)
+        except Exception as e:
+            logger.error(e)
+            return None, False
+        return self.update(update)
+
+    async def async_update_many(self, updates):
+        """Awaitable version of update_many, that does not block the event
+        loop: the blocking call is run in the endpoint executor."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, in_context(self.update_many, updates))
+
+    def ingest(self, chunks, format):
+        """Loads a ttl or n3 content given in pieces, that may still be
+        being received: the call blocks until the pieces end. By default,
+        the content is gathered and given to update.
+
+        Parameters
+        ----------
+        chunks : iterable of bytes
+            the content
+
+        format : str
+            'ttl' or 'n3'
+
+        Returns
+        -------
+        tuple (int, bool)
+            number of triples loaded, or None if unknown, and success
+        """
+        try:
+            _, code = self.update(b"".join(chunks).decode(), format=format)
+        except Exception as e:
+            logger.error(e)
+            return None, False
+        return None, code
+
+    async def async_ingest(self, chunks, format):
+        """Awaitable version of ingest, run in the endpoint executor: it
+        waits for the chunks in there, so never on the event loop."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, in_context(self.ingest, chunks, format))
+
+
+def insert_data(content, format):
+    """Translates a ttl or n3 content to a SPARQL INSERT DATA operation"""
+    graph = Graph()
+    graph.parse(data=content, format=format)
+    return "INSERT DATA {{\n{}}}".format(graph.serialize(format="nt"))
 
-class Blazegraph(RDFEndpoint):
-    def __init__(self, params):
+
+class HTTPEndpoint(RDFEndpoint):
+    """
+    Base class for the endpoints reached through HTTP. Each instance owns a
+    requests.Session, whose pooled connections are kept alive between calls,
+    and a thread pool of the same size to run the blocking calls.
+    """
+    def __init__(self, endpoint_uri, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, keep_alive=True):
+        """
+        Parameters
+        ----------
+        endpoint_uri : str
+            uri of the endpoint
+
+        pool_size : int, optional
+            defaults to DEFAULT_POOL_SIZE, maximum number of connections kept
+            open towards the endpoint, and of concurrent calls
+
+        timeout : float or tuple (float, float), optional
+            defaults to DEFAULT_TIMEOUT, seconds to wait for the endpoint on
+            each call. See requests to know about (connect, read) tuples
+
+        keep_alive : bool, optional
+            defaults to True, if False connections are closed after each call
+        """
+        self.endpoint_uri = endpoint_uri
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+        self.executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix=type(self).__name__)
+
+    def reachable(self):
+        """Health probe: True if the endpoint answers with status ok"""
+        try:
+            r = self.session.get(self.endpoint_uri, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.error(e)
+            return False
+        return r.status_code == requests.codes.ok
+
+    def ingest(self, chunks, format):
+        """The content is streamed to the endpoint while it is received,
+        in a chunked HTTP request"""
+        try:
+            r, code = self.update(chunks, format=format)
+        except Exception as e:
+            logger.error(e)
+            return None, False
+        return (self._triples(r) if code else None), code
+
+    def _triples(self, response):
+        # Number of triples loaded, from the response to an ingestion
+        return None
+
+    def close(self):
+        """Releases the pooled connections and the worker threads"""
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class Blazegraph(HTTPEndpoint):
+    def __init__(self, params, **options):
         """
         Parameters
         ----------
         params : str
             if None, defines the standard uri for blazegraph 'http://localhost:9999/bigdata/sparql'
             else it contains the appropriate uri
+
+        options : keyword arguments, optional
+            see HTTPEndpoint
         """
-        self.endpoint_uri = params if params else BLAZEGRAPH_CONST
+        super().__init__(params if params else BLAZEGRAPH_CONST, **options)
 
     def query(self, sparql):
         logger.debug("Sparql query to blazegraph at {}".format(self.endpoint_uri))
-        r = requests.get(
-            self.endpoint_uri,
-            headers={"Accept": "application/sparql-results+json"},
-            params={"query": sparql})
+        with tracing.span("http", method="GET"):
+            r = self.session.get(
+                self.endpoint_uri,
+                headers={"Accept": "application/sparql-results+json"},
+                params={"query": self.prefix_header + sparql}, timeout=self.timeout)
         logger.info("Query request got status {}".format(r.status_code))
-        return r.text.encode(), (r.status_code == requests.codes.ok)
+        with tracing.span("decode", status=r.status_code):
+            return r.text.encode(), (r.status_code == requests.codes.ok)
 
     def update(self, content, format=SPARQL):
         """Makes the update available in 'content' to the RDF endpoint.
@@ -180,33 +460,45 @@ class Blazegraph(RDFEndpoint):
         """
         # content may be sparql or .ttl or .n3
         l_format = format.lower()
-        if l_format == SPARQL:
-            r = requests.post(self.endpoint_uri, params={"update": content})
-        elif l_format == "ttl":
-            r = requests.post(
-                self.endpoint_uri,
-                headers={CONTENT_TYPE: "application/x-turtle"},
-                data=content)
-        elif l_format == "n3":
-            r = requests.post(
-                self.endpoint_uri,
-                headers={CONTENT_TYPE: "text/rdf+n3"}, data=content)
-        else:
-            error = "Format '{}' is unavailable".format(format)
-            logger.error(error)
-            raise NotImplementedError(error)
+        with tracing.span("http", method="POST", format=l_format):
+            if l_format == SPARQL:
+                r = self.session.post(
+                    self.endpoint_uri, params={"update": self.prefix_header + content},
+                    timeout=self.timeout)
+            elif l_format == "ttl":
+                r = self.session.post(
+                    self.endpoint_uri,
+                    headers={CONTENT_TYPE: "application/x-turtle"},
+                    data=content, timeout=self.timeout)
+            elif l_format == "n3":
+                r = self.session.post(
+                    self.endpoint_uri,
+                    headers={CONTENT_TYPE: "text/rdf+n3"}, data=content,
+                    timeout=self.timeout)
+            else:
+                error = "Format '{}' is unavailable".format(format)
+                logger.error(error)
+                raise NotImplementedError(error)
         logger.info("Update request got status {}".format(r.status_code))
         return r, (r.status_code == requests.codes.ok)
 
+    def _triples(self, response):
+        # e.g. <?xml version="1.0"?><data modified="3" milliseconds="12"/>
+        modified = re.search(r'modified="(\d+)"', response.text)
+        return int(modified.group(1)) if modified else None
+
 
-class Fuseki(RDFEndpoint):
-    def __init__(self, params):
+class Fuseki(HTTPEndpoint):
+    def __init__(self, params, **options):
         """
         Parameters
         ----------
         params : defines the uri for fuseki 'http://localhost:3030/{dataset}'
             must not be None
 
+        options : keyword arguments, optional
+            see HTTPEndpoint
+
         Raises
         ------
         ValueError
@@ -214,16 +506,18 @@ class Fuseki(RDFEndpoint):
         """
         if params is None:
             raise ValueError("Fuseki initialization params must not be None")
-        self.endpoint_uri = params
+        super().__init__(params, **options)
 
     def query(self, sparql):
         logger.debug("Sparql query to fuseki at {}".format(self.endpoint_uri))
-        r = requests.post(
-            self.endpoint_uri + "/query",
-            headers={CONTENT_TYPE: "application/sparql-query"},
-            data=sparql)
+        with tracing.span("http", method="POST"):
+            r = self.session.post(
+                self.endpoint_uri + "/query",
+                headers={CONTENT_TYPE: "application/sparql-query"},
+                data=self.prefix_header + sparql, timeout=self.timeout)
         logger.info("Query request got status {}".format(r.status_code))
-        return r.text.encode(), (r.status_code == requests.codes.ok)
+        with tracing.span("decode", status=r.status_code):
+            return r.text.encode(), (r.status_code == requests.codes.ok)
 
     def update(self, content, format=SPARQL):
         """Makes the update available in 'content' to the RDF endpoint.
@@ -249,20 +543,21 @@ class Fuseki(RDFEndpoint):
         """
         # content may be sparql or .ttl or .n3
         l_format = format.lower()
-        if l_format == SPARQL:
-            r = requests.post(
-                self.endpoint_uri + "/update",
-                headers={CONTENT_TYPE: "application/sparql-update"},
-                data=content)
-        elif l_format == "ttl" or l_format == "n3":
-            r = requests.post(
-                self.endpoint_uri + "/data",
-                headers={CONTENT_TYPE: "text/n3; charset=utf-8"},
-                data=content)
-        else:
-            error = "Format '{}' is unavailable".format(format)
-            logger.error(error)
-            raise NotImplementedError(error)
+        with tracing.span("http", method="POST", format=l_format):
+            if l_format == SPARQL:
+                r = self.session.post(
+                    self.endpoint_uri + "/update",
+                    headers={CONTENT_TYPE: "application/sparql-update"},
+                    data=self.prefix_header + content, timeout=self.timeout)
+            elif l_format == "ttl" or l_format == "n3":
+                r = self.session.post(
+                    self.endpoint_uri + "/data",
+                    headers={CONTENT_TYPE: "text/n3; charset=utf-8"},
+                    data=content, timeout=self.timeout)
+            else:
+                error = "Format '{}' is unavailable".format(format)
+                logger.error(error)
+                raise NotImplementedError(error)
         logger.info("Update request got status {}".format(r.status_code))
         fail = True
         try:
@@ -271,17 +566,122 @@ class Fuseki(RDFEndpoint):
             logger.error(e)
         return r, (fail is None)
 
+    def _triples(self, response):
+        # e.g. {"count": 3, "tripleCount": 3, "quadCount": 0}
+        try:
+            return int(response.json()["tripleCount"])
+        except Exception:
+            return None
+
+
+class ReadWriteLock():
+    """
+    Lock that is held either by many readers or by a single writer. Writers
+    waiting for the lock have priority over new readers, so that a stream of
+    queries cannot starve the updates.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
 
 class RDFLibEndpoint(RDFEndpoint):
-    def __init__(self, format="json"):
+    def __init__(self, format="json", workers=None, prepared_size=DEFAULT_PREPARED_SIZE, store=None,
+                 processes=None):
         """Parameters
         ----------
         format : str, optional
             Default to 'json', represents the serialize format of outputs
             See rdflib to know all available formats
+
+        workers : int, optional
+            Default to None, i.e. the async methods run rdflib on the event
+            loop thread. Otherwise, it is the number of threads on which they
+            run it: queries run concurrently, updates alone.
+
+        prepared_size : int, optional
+            Default to DEFAULT_PREPARED_SIZE, number of parsed queries kept,
+            so that repeated queries are not parsed again. 0 disables it.
+
+        store : rdflib.store.Store, optional
+            Default to None, i.e. rdflib's default in-memory store. See
+            compactstore.CompactStore and sqlitestore.SQLiteStore. The
+            transactions of the store are committed after each update.
+
+        processes : int, optional
+            Default to None, i.e. the queries are evaluated in this process.
+            Otherwise, it is the number of processes holding a replica of
+            the graph, on which the queries run in parallel (see
+            procpool.ReplicaPool). The changes of each update are sent to
+            the replicas before it returns.
         """
-        self.graph = Graph()
+        self.graph = Graph() if store is None else Graph(store=store)
+        self._pool = None
+        if processes:
+            self._pool = ReplicaPool(
+                processes, compact=isinstance(self.graph.store, CompactStore),
+                prepared_size=prepared_size)
+            if len(self.graph):
+                # persistent store: the replicas start from its contents
+                directory = tempfile.mkdtemp()
+                path = os.path.join(directory, "replica.snapshot")
+                dump(self.graph, path)
+                self._pool.load(path)
+                os.remove(path)
+                os.rmdir(directory)
+            self.graph = Graph(store=JournalStore(self.graph.store), identifier=self.graph.identifier)
+            self._replicate()
         self._query_format = format
+        self._lock = ReadWriteLock()
+        # (tag, namespace) pairs of bind_prefixes, the only ones given to
+        # the parser: the graph also has rdflib's and the uploaded ones
+        self._prefixes = ()
+        self._prepared = OrderedDict()
+        self._prepared_size = prepared_size
+        self._prepared_hits = 0
+        self._prepared_misses = 0
+        if workers:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="RDFLibEndpoint")
+        self._stats_lock = threading.Lock()
+        # snapshots being written by async_snapshot
+        self._snapshots = 0
+        self._queued = 0
+        self._max_queued = 0
+        self._tasks = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
 
     @property
     def queryFormat(self):
@@ -297,22 +697,244 @@ class RDFLibEndpoint(RDFEndpoint):
         """
         self._query_format = newformat
 
+    @property
+    def stats(self):
+        """Counters about the worker threads, when available. 'queued' is
+        the number of calls waiting for a thread or for the lock, 'wait_time'
+        the total seconds they waited: if they grow, the pool is saturated.
+        'prepared_hits' and 'prepared_misses' count the queries found, or
+        not, among the parsed ones. With replica processes, 'processes'
+        lists their counters, see procpool.ReplicaPool.stats.
+        """
+        with self._stats_lock:
+            stats = {
+                "queued": self._queued,
+                "max_queued": self._max_queued,
+                "tasks": self._tasks,
+                "wait_time": self._wait_time,
+                "max_wait_time": self._max_wait_time,
+                "prepared_hits": self._prepared_hits,
+                "prepared_misses": self._prepared_misses}
+        if self._pool is not None:
+            stats["processes"] = self._pool.stats
+        return stats
+
+    def _replicate(self):
+        # Sends the changes recorded since the last call to the replicas.
+        # Called holding the write lock, so that they are sent in order
+        if self._pool is not None:
+            changes = self.graph.store.take()
+            if changes:
+                self._pool.replicate(changes)
+
+    def _unjournaled(self):
+        # The graph, on the store out of the journal of the changes sent to
+        # the replicas
+        if self._pool is None:
+            return self.graph
+        return Graph(store=self.graph.store.store, identifier=self.graph.identifier)
+
+    def bind_prefixes(self, prefixes):
+        """Gives the prefixes to the parser instead of being declared in the
+        query text, and binds them as namespaces of the graph"""
+        with parse_lock:
+            self._prefixes = tuple(sorted(prefixes.items()))
+            for tag, namespace in prefixes.items():
+                self.graph.bind(tag, namespace, override=True, replace=True)
+            self.graph.commit()
+            self._replicate()
+
+    def _prepare(self, sparql):
+        # Parsed queries are kept in a LRU dictionary, by text and prefixes
+        with parse_lock:
+            key = (sparql, self._prefixes)
+            prepared = self._prepared.get(key)
+            if prepared is not None:
+                self._prepared.move_to_end(key)
+                self._prepared_hits += 1
+                return prepared
+            self._prepared_misses += 1
+            prepared = prepareQuery(sparql, initNs=dict(self._prefixes))
+            if self._prepared_size:
+                self._prepared[key] = prepared
+                if len(self._prepared) > self._prepared_size:
+                    self._prepared.popitem(last=False)
+            return prepared
+
     def query(self, sparql):
+        if self._pool is not None:
+            try:
+                with tracing.span("replica"):
+                    return self._pool.submit(sparql, self.queryFormat, self._prefixes).result()
+            except ConnectionError as e:
+                logger.error(e)
+        with self._lock.read():
+            return self._query(sparql)
+
+    def update(self, content, format=SPARQL):
+        with self._lock.write():
+            return self._update(content, format=format)
+
+    def _query(self, sparql):
         query = None
         try:
-            query = self.graph.query(sparql).serialize(format=self.queryFormat)
+            # concurrent readers share the evaluation, but not the parsing
+            with tracing.span("parse"):
+                prepared = self._prepare(sparql)
+            # the results are computed while they are serialized
+            with tracing.span("evaluate"):
+                query = self.graph.query(prepared).serialize(format=self.queryFormat)
         except Exception as e:
             logging.error(e)
             return None, False
         return query, True
 
-    def update(self, content, format=SPARQL):
+    def update_many(self, updates):
+        with self._lock.write():
+            return self._update_many(updates)
+
+    def _apply(self, graph, content, format):
+        if format == SPARQL:
+            with tracing.span("parse"), parse_lock:
+                update = prepareUpdate(content, initNs=dict(self._prefixes))
+            with tracing.span("apply"):
+                return graph.update(update)
+        with tracing.span("apply", format=format):
+            return graph.parse(data=content, format=format)
+
+    def _update(self, content, format=SPARQL):
         try:
-            if format == SPARQL:
-                update = self.graph.update(content)
-            else:
-                update = self.graph.parse(data=content, format=format)
+            update = self._apply(self.graph, content, format)
         except Exception as e:
             logging.error(e)
+            self.graph.rollback()
+            self._replicate()
             return None, False
+        self.graph.commit()
+        self._replicate()
         return update, True
+
+    def _update_many(self, updates):
+        # The updates go through a journal of the changes made to the store,
+        # that are undone if one of them fails
+        audited = Graph(
+            store=AuditableStore(self.graph.store), identifier=self.graph.identifier,
+            namespace_manager=self.graph.namespace_manager)
+        try:
+            for content, format in updates:
+                self._apply(audited, content, format)
+        except Exception as e:
+            logging.error(e)
+            audited.store.rollback()
+            self.graph.rollback()
+            self._replicate()
+            return None, False
+        audited.store.commit()
+        self.graph.commit()
+        self._replicate()
+        return None, True
+
+    def ingest(self, chunks, format, batch_size=DEFAULT_BATCH_SIZE):
+        """The content is parsed in batches of about 'batch_size'
+        characters, out of the lock, and each batch is added to the graph
+        holding the lock just for the time of the addition: queries run
+        between the batches. The ingestion is not atomic: if a batch cannot
+        be parsed, the previous ones stay in the graph."""
+        triples = 0
+        try:
+            for batch in parse_batches(chunks, format.lower(), batch_size=batch_size):
+                with self._lock.write():
+                    self.graph.addN((s, p, o, self.graph) for s, p, o in batch)
+                    self.graph.commit()
+                    self._replicate()
+                triples += len(batch)
+        except Exception as e:
+            logging.error(e)
+            return triples, False
+        return triples, True
+
+    def snapshot(self, path):
+        """Writes a binary snapshot of the graph to 'path', see
+        snapshot.dump. Updates wait for its end, and queries too with a
+        CompactStore, whose pending changes are merged first."""
+        graph = self._unjournaled()
+        lock = self._lock.write if isinstance(graph.store, CompactStore) else self._lock.read
+        with lock():
+            return dump(graph, path)
+
+    def restore(self, path):
+        """Adds to the graph the triples of the snapshot in 'path', see
+        snapshot.load"""
+        with self._lock.write():
+            report = load(self._unjournaled(), path)
+            self.graph.commit()
+            if self._pool is not None:
+                # the replicas read the file themselves
+                self._pool.load(path)
+        return report
+
+    async def async_snapshot(self, path):
+        """Awaitable version of snapshot, that does not block the event
+        loop. Without workers, the queries and updates made meanwhile run in
+        the default executor too, where they wait for the lock."""
+        loop = asyncio.get_event_loop()
+        self._snapshots += 1
+        try:
+            return await loop.run_in_executor(self.executor, in_context(self.snapshot, path))
+        finally:
+            self._snapshots -= 1
+
+    def close(self):
+        """Closes the store, writing what is pending"""
+        with self._lock.write():
+            self.graph.close(commit_pending_transaction=True)
+        if self._pool is not None:
+            self._pool.close()
+
+    def _run_locked(self, submitted, lock, function, *args, **kwargs):
+        # Runs in a worker thread: the waiting time is accounted once the
+        # lock is acquired
+        with lock():
+            waited = time.monotonic() - submitted
+            with self._stats_lock:
+                self._queued -= 1
+                self._tasks += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+            tracing.annotate(lock_wait=waited)
+            return function(*args, **kwargs)
+
+    def _inline(self):
+        # Without workers, the calls run on the loop thread, unless the lock
+        # may be held for long by a snapshot
+        return self.executor is None and not self._snapshots
+
+    async def _submit(self, lock, function, *args, **kwargs):
+        with self._stats_lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, in_context(
+            self._run_locked, time.monotonic(), lock, function, *args, **kwargs))
+
+    async def async_query(self, sparql):
+        if self._pool is not None:
+            try:
+                with tracing.span("replica"):
+                    return await asyncio.wrap_future(self._pool.submit(sparql, self.queryFormat, self._prefixes))
+            except ConnectionError as e:
+                logger.error(e)
+        if self._inline():
+            # rdflib is run on the loop thread, as the synchronous query
+            return self.query(sparql)
+        return await self._submit(self._lock.read, self._query, sparql)
+
+    async def async_update(self, content, format=SPARQL):
+        if self._inline():
+            return self.update(content, format=format)
+        return await self._submit(self._lock.write, self._update, content, format=format)
+
+    async def async_update_many(self, updates):
+        if self._inline():
+            return self.update_many(updates)
+        return await self._submit(self._lock.write, self._update_many, updates)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ingest.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import asyncio
+import codecs
+import queue
+import re
+import time
+import uuid
+
+from rdflib import Graph, BNode, URIRef
+
+# Formats whose uploads are streamed to the endpoint while they are received
+STREAMED_FORMATS = ["ttl", "n3"]
+
+# Characters of statements parsed at once by the rdflib endpoint
+DEFAULT_BATCH_SIZE = 1 << 20
+
+# Blank node labels are replaced by IRIs starting with this namespace while
+# parsing, so that the same label is the same blank node in all the batches
+SKOLEM_NAMESPACE = "urn:musepa:bnode:"
+
+_TOKEN_REGEX = re.compile(r'''
+    (?P<string>"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^'\\]|\\.|'(?!\'\'))*\'\'\'
+        |"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    |(?P<iri><[^<>"{}|^`\\\x00-\x20]*>)
+    |(?P<comment>\#[^\n]*\n)
+    |(?P<bnode>_:[^\W.](?:[\w.-]*[\w-])?)
+    |(?P<open>[\[({])
+    |(?P<close>[\])}])
+    |(?P<end>\.(?=[\s\#]))
+    |(?P<partial>"""|\'\'\'|["'<\#]|_:)
+    ''', re.VERBOSE | re.DOTALL)
+
+# Directives, with '@' (ended by '.') or SPARQL style (ended by the IRI)
+_DIRECTIVE_REGEX = re.compile(r"\s*(?:\#[^\n]*\n\s*)*(?:@prefix|@base)\b")
+_SPARQL_DIRECTIVE_REGEX = re.compile(
+    r"\s*(?:\#[^\n]*\n\s*)*(?:[Pp][Rr][Ee][Ff][Ii][Xx]|[Bb][Aa][Ss][Ee])\s[^<]*<[^>]*>")
+_SPARQL_DIRECTIVE_START = re.compile(
+    r"\s*(?:\#[^\n]*\n\s*)*(?:[Pp][Rr][Ee][Ff][Ii][Xx]|[Bb][Aa][Ss][Ee])\s")
+
+logger = logging.getLogger(__name__)
+
+
+class TurtleChunker():
+    """Splits a Turtle (or n3) text, received in pieces, in complete
+    statements, that can be parsed on their own once preceded by the
+    directives (prefixes and base) met so far.
+
+    Parameters
+    ----------
+    skolem : str, optional
+        if given, blank node labels '_:x' are replaced by the IRI <skolem + x>
+    """
+    def __init__(self, skolem=None):
+        self.header = ""
+        self._skolem = skolem
+        self._buffer = ""
+
+    def _rewrite(self, start, end, bnodes):
+        if not bnodes:
+            return self._buffer[start:end]
+        parts, position = [], start
+        for (label_start, label_end) in bnodes:
+            parts.append(self._buffer[position:label_start])
+            parts.append("<{}{}>".format(self._skolem, self._buffer[label_start + 2:label_end]))
+            position = label_end
+        parts.append(self._buffer[position:end])
+        return "".join(parts)
+
+    def feed(self, text):
+        """Adds 'text', and yields the statements it completed. The
+        directives are yielded too, and added to 'header' when yielded."""
+        self._buffer += text
+        start = position = depth = 0
+        bnodes = []
+        while True:
+            if position == start:
+                sparql_directive = _SPARQL_DIRECTIVE_REGEX.match(self._buffer, start)
+                if sparql_directive is not None:
+                    statement = sparql_directive.group() + "\n"
+                    start = position = sparql_directive.end()
+                    self.header += statement
+                    yield statement
+                    continue
+                elif _SPARQL_DIRECTIVE_START.match(self._buffer, start):
+                    # the IRI is not complete yet
+                    break
+            match = _TOKEN_REGEX.search(self._buffer, position)
+            if match is None or match.lastgroup == "partial":
+                break
+            position = match.end()
+            kind = match.lastgroup
+            if kind == "bnode" and self._skolem is not None:
+                if position == len(self._buffer):
+                    # the label may continue in the next piece
+                    break
+                bnodes.append(match.span())
+            elif kind == "open":
+                depth += 1
+            elif kind == "close":
+                depth -= 1
+            elif kind == "end" and depth == 0:
+                statement = self._rewrite(start, position, bnodes)
+                if _DIRECTIVE_REGEX.match(statement):
+                    self.header += statement + "\n"
+                start, bnodes = position, []
+                yield statement
+        self._buffer = self._buffer[start:]
+
+    def close(self):
+        """Returns what is left, i.e. the last statement if it is not
+        followed by any character"""
+        start, self._buffer = self._buffer, ""
+        if not start.strip():
+            return ""
+        chunker = TurtleChunker(self._skolem)
+        # the last '.' needs a following blank to be recognized
+        return "".join(chunker.feed(start + "\n")) + chunker._buffer
+
+
+def parse_batches(chunks, format, batch_size=DEFAULT_BATCH_SIZE):
+    """Parses a Turtle (or n3) content given as bytes pieces, in graphs of
+    about 'batch_size' characters of statements each. Blank node labels refer
+    to the same blank nodes in all the graphs.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+        the content
+
+    format : str
+        'ttl' or 'n3'
+
+    batch_size : int, optional
+        defaults to DEFAULT_BATCH_SIZE
+
+    Returns
+    -------
+    generator of rdflib.Graph
+    """
+    skolem = "{}{}:".format(SKOLEM_NAMESPACE, uuid.uuid4().hex)
+    chunker = TurtleChunker(skolem)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    bnodes = {}
+
+    def parse(header, statements):
+        graph = Graph()
+        graph.parse(data=header + "".join(statements), format=format)
+        skolemized = [t for t in graph if any(
+            isinstance(term, URIRef) and term.startswith(skolem) for term in t)]
+        for triple in skolemized:
+            graph.remove(triple)
+            graph.add(tuple(
+                bnodes.setdefault(term, BNode())
+                if isinstance(term, URIRef) and term.startswith(skolem) else term
+                for term in triple))
+        return graph
+
+    header, statements, size = "", [], 0
+    for chunk in chunks:
+        for statement in chunker.feed(decoder.decode(chunk)):
+            statements.append(statement)
+            size += len(statement)
+            if size >= batch_size:
+                yield parse(header, statements)
+                header, statements, size = chunker.header, [], 0
+    statements.append(chunker.close() + decoder.decode(b"", final=True))
+    yield parse(header, statements)
+
+
+class IngestionAborted(Exception):
+    pass
+
+
+class Upload():
+    """A content received in blocks, that is streamed to the endpoint
+    ingestion while it is received: the event loop puts the blocks, a worker
+    thread consumes them.
+
+    Parameters
+    ----------
+    ingest : coroutine function
+        called with the blocks and the format to load the content, e.g. the
+        'async_ingest' method of an endpoint.RDFEndpoint
+
+    format : str
+        one of STREAMED_FORMATS
+
+    header : bytes, optional
+        sent before the content, e.g. the prefixes
+    """
+    def __init__(self, ingest, format, header=b""):
+        self.format = format
+        self.expected = 0
+        self.size = 0
+        self.started = time.monotonic()
+        self.seconds = None
+        self.last = self.started
+        self._queue = queue.Queue()
+        if header:
+            self._queue.put(header)
+        self.future = asyncio.ensure_future(ingest(self._chunks(), format))
+
+    def _chunks(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            elif chunk is IngestionAborted:
+                raise IngestionAborted("Upload aborted")
+            yield chunk
+
+    @property
+    def pending(self):
+        """Blocks received, and not yet consumed by the ingestion"""
+        return self._queue.qsize()
+
+    def put(self, chunk):
+        self.expected += 1
+        self.size += len(chunk)
+        self.last = time.monotonic()
+        self._queue.put(chunk)
+
+    def abort(self):
+        self._queue.put(IngestionAborted)
+
+    async def finish(self):
+        """Waits for the end of the ingestion.
+
+        Returns
+        -------
+        tuple (int, bool)
+            triples loaded (None if unknown), success
+        """
+        self._queue.put(None)
+        triples, code = await self.future
+        self.seconds = time.monotonic() - self.started
+        return triples, code
+
+    def report(self, triples):
+        """Statistics of a finished upload"""
+        return {
+            "bytes": self.size,
+            "seconds": round(self.seconds, 3),
+            "triples": triples,
+            "triples_per_second": round(triples / self.seconds) if triples is not None and self.seconds else None}
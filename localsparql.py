@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  localsparql.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Local SPARQL HTTP server, backed by an rdflib graph, that answers the
+requests of the Blazegraph and Fuseki endpoints (see endpoint.py) as the
+real servers do, so that their code paths can be run on one machine:
+
+    Blazegraph, at /bigdata/sparql
+        GET ?query=...                 results, application/sparql-results+json
+        POST ?update=...               <data modified="N" milliseconds="M"/>
+        POST application/x-turtle      the same, for the loaded triples
+        POST text/rdf+n3
+
+    Fuseki, at /{dataset}
+        POST /query, application/sparql-query
+        POST /update, application/sparql-update
+        POST /data, text/n3 or text/turtle   {"count", "tripleCount", "quadCount"}
+
+GET on /bigdata/sparql and /{dataset} answers 200, as the reachability
+probe of get_endpoint expects. Each request can be delayed by a fixed
+latency plus a random jitter, to stand for the network and the server:
+
+    $ python localsparql.py --port 9999 --latency 0.002
+    $ python musepa.py --endpoint blazegraph
+
+It is meant for tests and benchmarks: the graph is in memory and nothing
+is authenticated.
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from rdflib import Graph
+from endpoint import ReadWriteLock
+
+BLAZEGRAPH_PATH = "/bigdata/sparql"
+DEFAULT_DATASET = "musepa"
+
+# Content types of the loaded data, and their rdflib formats
+DATA_FORMATS = {
+    "application/x-turtle": "turtle",
+    "text/turtle": "turtle",
+    "text/rdf+n3": "n3",
+    "text/n3": "n3"}
+
+SPARQL_RESULTS_JSON = "application/sparql-results+json"
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, as the endpoints pool their connections; headers and body
+    # are written apart, so without TCP_NODELAY each response would wait
+    # for a delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.standin.connections += 1
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            # streamed ingestions
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(self, status, body=b"", content_type="text/plain; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method):
+        server = self.server.standin
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self._body() if method == "POST" else b""
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if content_type == "application/x-www-form-urlencoded":
+            params.update((key, values[0]) for key, values in parse_qs(body.decode()).items())
+        time.sleep(server.delay())
+        try:
+            if url.path == BLAZEGRAPH_PATH:
+                self._blazegraph(server, method, params, body, content_type)
+            elif url.path == f"/{server.dataset}" and method == "GET":
+                server.requests["fuseki", "probe"] += 1
+                self._send(200)
+            elif url.path.startswith(f"/{server.dataset}/"):
+                self._fuseki(server, url.path[len(server.dataset) + 2:], method, params, body, content_type)
+            else:
+                self._send(404, f"No service at {url.path}".encode())
+        except BadRequest as e:
+            self._send(400, str(e).encode())
+
+    def _blazegraph(self, server, method, params, body, content_type):
+        started = time.perf_counter()
+        if "query" in params:
+            server.requests["blazegraph", "query"] += 1
+            self._send(200, *server.query(params["query"]))
+            return
+        elif method == "GET":
+            server.requests["blazegraph", "probe"] += 1
+            self._send(200)
+            return
+        elif "update" in params:
+            server.requests["blazegraph", "update"] += 1
+            modified = server.update(params["update"])
+        elif content_type in DATA_FORMATS:
+            server.requests["blazegraph", "data"] += 1
+            modified = server.load(body, DATA_FORMATS[content_type])
+        else:
+            raise BadRequest(f"Unsupported content type {content_type}")
+        milliseconds = round((time.perf_counter() - started) * 1000)
+        self._send(200, f'<?xml version="1.0"?><data modified="{modified}" milliseconds="{milliseconds}"/>'.encode(),
+                   "application/xml")
+
+    def _fuseki(self, server, service, method, params, body, content_type):
+        if service == "query":
+            server.requests["fuseki", "query"] += 1
+            sparql = body.decode() if content_type == "application/sparql-query" else params.get("query")
+            if sparql is None:
+                raise BadRequest("No query")
+            self._send(200, *server.query(sparql))
+        elif service == "update" and method == "POST":
+            server.requests["fuseki", "update"] += 1
+            sparql = body.decode() if content_type == "application/sparql-update" else params.get("update")
+            if sparql is None:
+                raise BadRequest("No update")
+            server.update(sparql)
+            self._send(204)
+        elif service == "data" and method == "POST":
+            server.requests["fuseki", "data"] += 1
+            if content_type not in DATA_FORMATS:
+                raise BadRequest(f"Unsupported content type {content_type}")
+            count = server.load(body, DATA_FORMATS[content_type])
+            self._send(200, json.dumps({"count": count, "tripleCount": count, "quadCount": 0}).encode(),
+                       "application/json")
+        else:
+            self._send(404, f"No service {service}".encode())
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # e.g. a client that timed out and closed the connection
+        logger.debug(f"Connection from {client_address} failed", exc_info=True)
+
+
+class LocalSPARQLServer():
+    """SPARQL HTTP server speaking the Blazegraph and Fuseki conventions of
+    endpoint.py, see the module documentation. E.g.
+
+        with LocalSPARQLServer(latency=0.001) as server:
+            endpoint = get_endpoint("fuseki", server.fuseki_uri)
+
+    Parameters
+    ----------
+    host : str, optional
+        defaults to '127.0.0.1'
+
+    port : int, optional
+        defaults to 0, a free port
+
+    dataset : str, optional
+        defaults to DEFAULT_DATASET, name of the Fuseki dataset
+
+    latency : float, optional
+        defaults to 0, seconds each request is delayed. Can be changed
+        while the server runs
+
+    jitter : float, optional
+        defaults to 0, up to these seconds are randomly added to 'latency'
+
+    graph : rdflib.Graph, optional
+        defaults to a new in-memory graph
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, dataset=DEFAULT_DATASET, latency=0.0, jitter=0.0, graph=None):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.graph = Graph() if graph is None else graph
+        # requests served, by (convention, operation)
+        self.requests = Counter()
+        # connections accepted
+        self.connections = 0
+        self._lock = ReadWriteLock()
+        self._httpd = _HTTPServer((host, port), _Handler)
+        self._httpd.standin = self
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def blazegraph_uri(self):
+        return self.address + BLAZEGRAPH_PATH
+
+    @property
+    def fuseki_uri(self):
+        return f"{self.address}/{self.dataset}"
+
+    def delay(self):
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def query(self, sparql):
+        """Evaluates 'sparql', returning the payload and its content type"""
+        try:
+            with self._lock.read():
+                result = self.graph.query(sparql)
+                if result.type in ("CONSTRUCT", "DESCRIBE"):
+                    return result.graph.serialize(format="turtle").encode(), "text/turtle"
+                return result.serialize(format="json"), SPARQL_RESULTS_JSON
+        except Exception as e:
+            raise BadRequest(f"Query failed: {e}")
+
+    def update(self, sparql):
+        """Applies 'sparql', returning the number of triples added or removed"""
+        try:
+            with self._lock.write():
+                before = len(self.graph)
+                self.graph.update(sparql)
+                return abs(len(self.graph) - before)
+        except Exception as e:
+            raise BadRequest(f"Update failed: {e}")
+
+    def load(self, data, format):
+        """Adds the triples of 'data', returning how many they are"""
+        parsed = Graph()
+        try:
+            parsed.parse(data=data.decode(), format=format)
+        except Exception as e:
+            raise BadRequest(f"Unable to parse the {format} data: {e}")
+        with self._lock.write():
+            self.graph += parsed
+        return len(parsed)
+
+    def start(self):
+        """Serves in a background thread, returning the server itself"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="LocalSPARQLServer", daemon=True)
+        self._thread.start()
+        logger.info(f"Local SPARQL server at {self.blazegraph_uri} and {self.fuseki_uri}")
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local SPARQL server, with the Blazegraph and Fuseki conventions")
+    parser.add_argument("--host", default="localhost", help="Host to listen on (default localhost)")
+    parser.add_argument("--port", default=9999, type=int,
+                        help="Port (default 9999, the Blazegraph one: musepa --endpoint blazegraph finds it)")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help=f"Fuseki dataset name (default {DEFAULT_DATASET})")
+    parser.add_argument("--latency", default=0.0, type=float, help="Seconds each request is delayed")
+    parser.add_argument("--jitter", default=0.0, type=float, help="Random seconds added to --latency, at most")
+    parser.add_argument("--data", default=None, help="Turtle file loaded at start")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s   %(asctime)-15s %(filename)s[%(lineno)d] : %(message)s")
+
+    server = LocalSPARQLServer(args.host, args.port, args.dataset, args.latency, args.jitter)
+    if args.data is not None:
+        server.graph.parse(args.data, format="turtle")
+    logger.info(f"Blazegraph: {server.blazegraph_uri}, Fuseki: {server.fuseki_uri}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the local SPARQL server")
+    finally:
+        server._httpd.server_close()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prefix of the metric names in the Prometheus text format
+PROMETHEUS_PREFIX = "musepa_"
+
+
+class Histogram():
+    """Distribution of values in fixed buckets, as Prometheus histograms:
+    observing a value is a bisection and an increment.
+
+    Parameters
+    ----------
+    bounds : tuple of float, optional
+        defaults to DEFAULT_BUCKETS, upper bounds of the buckets, sorted.
+        Larger values fall in a last, unbounded, bucket
+    """
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the 'q' quantile (0 to 1),
+        None if there are no values or if it is in the last bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def cumulative(self):
+        """(upper bound, values up to it) pairs, the last bound being inf"""
+        seen = 0
+        pairs = []
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            pairs.append((bound, seen))
+        return pairs
+
+    @property
+    def state(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": {_number(bound): seen for bound, seen in self.cumulative()}}
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _series(name, labels):
+    # Prometheus series name, with its labels escaped
+    if not labels:
+        return name
+    return name + "{" + ",".join('{}="{}"'.format(
+        label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels) + "}"
+
+
+class Metrics():
+    """Counters and latency histograms, by name and labels, e.g.
+        metrics.count("requests", resource="SparqlQuery", code="2.05")
+        with metrics.timed("endpoint_seconds", backend="Fuseki"):
+            ...
+
+    The values are kept in the process, and written on request as JSON
+    (state) or as Prometheus text (prometheus), together with gauges
+    computed by the caller.
+
+    Parameters
+    ----------
+    buckets : tuple of float, optional
+        defaults to DEFAULT_BUCKETS, see Histogram
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # name -> {sorted (label, value) tuple -> value}
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observes in the 'name' histogram the seconds spent in the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def forget(self, **labels):
+        """Drops the series that have all these labels, e.g. the ones of a
+        deleted subscription"""
+        wanted = set(labels.items())
+        for family in (self.counters, self.histograms):
+            for series in family.values():
+                for key in [key for key in series if wanted <= set(key)]:
+                    del series[key]
+
+    def state(self, gauges=None):
+        """JSON-friendly view of the metrics: per name, a list of series
+        with their labels, and their value (counters and gauges) or their
+        histogram (see Histogram.state).
+
+        Parameters
+        ----------
+        gauges : dict, optional
+            current values, {name: [(labels dict, value), ...]}
+        """
+        state = {}
+        for name, series in self.counters.items():
+            state[name] = [dict(labels=dict(key), value=value) for key, value in series.items()]
+        for name, series in self.histograms.items():
+            state[name] = [dict(labels=dict(key), **histogram.state) for key, histogram in series.items()]
+        for name, values in (gauges or {}).items():
+            state[name] = [dict(labels=labels, value=value) for labels, value in values]
+        return state
+
+    def prometheus(self, gauges=None):
+        """The metrics in the Prometheus text exposition format, see state"""
+        lines = []
+        for name, series in self.counters.items():
+            name = PROMETHEUS_PREFIX + name + "_total"
+            lines.append(f"# TYPE {name} counter")
+            for key, value in series.items():
+                lines.append(f"{_series(name, key)} {value}")
+        for name, series in self.histograms.items():
+            name = PROMETHEUS_PREFIX + name
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                for bound, seen in histogram.cumulative():
+                    lines.append(f"{_series(name + '_bucket', key + (('le', _number(bound)),))} {seen}")
+                lines.append(f"{_series(name + '_sum', key)} {histogram.sum!r}")
+                lines.append(f"{_series(name + '_count', key)} {histogram.count}")
+        for name, values in (gauges or {}).items():
+            name = PROMETHEUS_PREFIX + name
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{_series(name, sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class FanOut():
+    """Time taken by the re-evaluations of the subscriptions that follow an
+    update: it is observed in the 'name' histogram of 'metrics' when the
+    last of the 'pending' ones calls done.
+    """
+    __slots__ = ("metrics", "name", "pending", "started")
+
+    def __init__(self, metrics, name, pending):
+        self.metrics = metrics
+        self.name = name
+        self.pending = pending
+        self.started = time.perf_counter()
+
+    def done(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.metrics.observe(self.name, time.perf_counter() - self.started)
@@ -13,16 +13,27 @@ import logging
 import argparse
 import asyncio
 import json
+import time
+import tracing
 
+from collections import Counter, deque
+from functools import partial
+from weakref import WeakKeyDictionary
 from aiocoap import resource as coap
 from aiocoap import Context, Message, NOT_FOUND, DELETED, BAD_REQUEST
-from aiocoap import BAD_OPTION, CHANGED, CREATED, FORBIDDEN
-from aiocoap.optiontypes import StringOption
+from aiocoap import BAD_OPTION, CHANGED, CREATED, FORBIDDEN, VALID, NOT_ACCEPTABLE
+from aiocoap import CONTINUE, REQUEST_ENTITY_INCOMPLETE, INTERNAL_SERVER_ERROR
 from os.path import exists, dirname
 from ipaddress import ip_address, IPv4Address
-from endpoint import get_endpoint
-from hashlib import md5
+from endpoint import get_endpoint, RDFLibEndpoint, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT, ENDPOINT_OPTIONS
 from prefix import Prefixes
+from subscription import SubscriptionIndex, result_bindings, bindings_delta, delta_bindings
+from canonical import canonical_alias
+from cache import ResultCache, DEFAULT_CACHE_SIZE
+from encoding import EncodedResult, JSON
+from ingest import Upload, STREAMED_FORMATS
+from metrics import Metrics, FanOut
+from tracing import SamplingTracer, JSONLinesExporter, DEFAULT_SAMPLE_RATE
 
 
 SPARQL = "sparql"
@@ -30,6 +41,33 @@ CLIENTS = "clients"
 RESOURCE = "resource"
 DEFAULT = "default"
 
+# Uri query option with which an observer asks for added/removed bindings
+# notifications instead of the whole result
+DELTA_MODE = "mode=delta"
+# Number of past deltas kept, to merge them for observers that missed some
+DELTA_HISTORY = 16
+
+# Max-Age of the query results, and of the subscription results when they
+# are not observed: they can be changed by any update, so clients and proxies
+# have to revalidate them (with their ETag) instead of using the CoAP default
+# of 60 seconds
+MAX_AGE = 0
+
+# Streamed uploads (see SparqlUpdate) that do not receive their next block
+# for this time are dropped
+UPLOAD_TIMEOUT = 60.0
+# Blocks of a streamed upload that can wait for the endpoint: the next block
+# is acknowledged only when the endpoint catches up
+MAX_PENDING_BLOCKS = 64
+
+# Seconds between the notifications of the /metrics observers
+METRICS_PERIOD = 10.0
+# Metric names, see metrics.Metrics
+REQUESTS = "requests"
+REQUEST_SECONDS = "request_seconds"
+ENDPOINT_SECONDS = "endpoint_seconds"
+FANOUT_SECONDS = "fanout_seconds"
+
 logger = logging.getLogger(__name__)
 
 rdf_endpoint = None
@@ -44,6 +82,151 @@ prefix_container = Prefixes(silent=True)
 # }
 subscription_store = {}
 
+# Triple patterns read by the running subscriptions, to know which ones have
+# to be re-evaluated after an update
+subscription_index = SubscriptionIndex()
+
+# Version of the RDF store contents, increased by each successful update, and
+# cache of the query results computed on it
+store_version = 0
+query_cache = ResultCache()
+
+# Task creating the CoAP server context, see shutdown
+server = None
+
+# In cluster mode, link to the other MUSEPA processes, see cluster.ClusterLink
+cluster_link = None
+
+# Request counts and latencies, see musepaMetrics
+metrics = Metrics()
+
+
+def updated(updates=None, publish=True):
+    """Makes the cached results stale after a change of the store, and
+    re-evaluates the subscriptions reading the touched patterns. 'updates'
+    is the list of the (content, format) applied, None if they may have
+    touched anything. In cluster mode, the other processes are told too,
+    unless 'publish' is False."""
+    global store_version
+    store_version += 1
+    if updates is None:
+        affected = set(subscription_store)
+    else:
+        affected = set()
+        with tracing.span("index"):
+            for content, update_format in updates:
+                affected |= subscription_index.affected(
+                    content, format=update_format, initNs=prefix_container.dictionary)
+    logger.debug(f"{len(affected)}/{len(subscription_store)} subscriptions affected")
+    tracing.annotate(affected=len(affected))
+    fanout = FanOut(metrics, FANOUT_SECONDS, len(affected)) if affected else None
+    for k in affected:
+        subscription_store[k][RESOURCE].rescheduleNow(fanout)
+    if publish and cluster_link is not None:
+        cluster_link.updated(updates)
+
+
+def register(alias, content, resource):
+    """Adds a subscription resource to the server"""
+    subscription_store[alias] = {
+        SPARQL: content,
+        RESOURCE: resource,
+        CLIENTS: []}
+    subscription_index.add(alias, content, initNs=prefix_container.dictionary)
+    root.add_resource((alias,), resource)
+
+
+def unregister(alias):
+    """Removes a subscription resource from the server"""
+    subscription_store[alias][RESOURCE].close()
+    root.remove_resource((alias,))
+    del subscription_store[alias]
+    subscription_index.remove(alias)
+    metrics.forget(subscription=alias)
+
+
+def mirror(alias, content):
+    """Cluster mode: adds a subscription created by another process, so
+    that its clients can observe it here too. It is evaluated only when
+    observed."""
+    if alias not in subscription_store:
+        register(alias, content, SubscriptionResource(alias, content))
+
+
+def unmirror(alias):
+    """Cluster mode: removes a subscription that another process gave up,
+    if no process has clients of it anymore"""
+    if alias in subscription_store and not subscription_store[alias][CLIENTS] \
+            and not cluster_link.held(alias):
+        unregister(alias)
+
+
+async def call_endpoint(operation, *args, **kwargs):
+    """Calls the 'async_' + 'operation' method of the endpoint, e.g.
+    call_endpoint("query", sparql), timing its round trip"""
+    backend = type(rdf_endpoint).__name__
+    with metrics.timed(ENDPOINT_SECONDS, backend=backend, operation=operation), \
+            tracing.span("endpoint", backend=backend, operation=operation):
+        return await getattr(rdf_endpoint, "async_" + operation)(*args, **kwargs)
+
+
+def subscription_gauges():
+    """Observers and size of the last result of each subscription, as
+    gauges of Metrics.state"""
+    observers, sizes = [], []
+    for alias, entry in subscription_store.items():
+        resource = entry[RESOURCE]
+        observers.append(({"subscription": alias}, resource.observers))
+        sizes.append(({"subscription": alias}, len(resource.lastRes or b"")))
+    return {
+        "subscriptions": [({}, len(subscription_store))],
+        "subscription_observers": observers,
+        "subscription_result_bytes": sizes}
+
+
+class Measured():
+    """Mixin of the resources whose requests are counted, by response code,
+    and timed in 'metrics'. They are also traced, see tracing."""
+    def metricsLabels(self):
+        return {"resource": type(self).__name__}
+
+    async def render(self, request):
+        started = time.perf_counter()
+        code = "error"
+        labels = self.metricsLabels()
+        attributes = {name: value for name, value in labels.items() if name != "resource"}
+        try:
+            with tracing.trace(labels["resource"], method=request.code.name, **attributes) as span:
+                response = await super().render(request)
+                code = response.code.dotted
+                span.set(code=code, bytes=len(response.payload))
+            return response
+        finally:
+            metrics.observe(REQUEST_SECONDS, time.perf_counter() - started, **labels)
+            metrics.count(REQUESTS, code=code, **labels)
+
+
+def validated(request, result, max_age=None):
+    """Builds the response to a GET request for 'result', an EncodedResult,
+    in the Content-Format asked with the Accept option (SPARQL JSON if
+    missing). If the client already has it, as told by the ETag option, a
+    2.03 Valid without payload"""
+    content_format = JSON if request.opt.accept is None else request.opt.accept
+    try:
+        payload, tag = result.get(content_format)
+    except ValueError as e:
+        logger.warning(e)
+        return Message(code=NOT_ACCEPTABLE)
+    if tag in (request.opt.etags or ()):
+        response = Message(code=VALID)
+    else:
+        response = Message(payload=payload)
+    response.opt.etag = tag
+    response.opt.content_format = content_format
+    if max_age is not None:
+        response.opt.max_age = max_age
+    return response
+
 
 class musepaInfo(coap.Resource):
     """Global info resource about MUSEPA"""
@@ -56,7 +239,42 @@ class musepaInfo(coap.Resource):
         return Message(payload=info)
 
 
-class SparqlQuery(coap.Resource):
+class musepaMetrics(coap.ObservableResource):
+    """Resource giving the request counts and latencies of the resources,
+    the round trip times of the endpoint, the time taken to re-evaluate the
+    subscriptions after an update, and the observers and result size of
+    each subscription, e.g.
+        GET coap://HERE_THE_URI/metrics
+        GET coap://HERE_THE_URI/metrics?format=prometheus
+    in JSON (see metrics.Metrics.state) or in the Prometheus text format.
+    Observers are notified every METRICS_PERIOD seconds.
+    """
+    def __init__(self):
+        super().__init__()
+        self._timer = None
+
+    def update_observation_count(self, newcount):
+        if newcount and self._timer is None:
+            self._tick()
+        elif not newcount and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        self._timer = asyncio.get_event_loop().call_later(METRICS_PERIOD, self._notify)
+
+    def _notify(self):
+        self.updated_state()
+        self._tick()
+
+    async def render_get(self, request):
+        gauges = subscription_gauges()
+        if "format=prometheus" in request.opt.uri_query:
+            return Message(payload=metrics.prometheus(gauges).encode(), content_format=0)
+        return Message(payload=json.dumps(metrics.state(gauges)).encode(), content_format=JSON)
+
+
+class SparqlQuery(Measured, coap.Resource):
     """Resource that can be contacted to query the contents of the RDF store"""
     # This is the coap resource that deals with queries.
     # To make a query here you setup a CoAP GET request with
@@ -67,19 +285,139 @@ class SparqlQuery(coap.Resource):
         if request.payload == b'':
             return Message(code=BAD_OPTION)
         else:
-            prefixed_query = prefix_container.sparql + request.payload.decode()
-            res, code = rdf_endpoint.query(prefixed_query)
+            # the prefixes are bound to the endpoint
+            with tracing.span("decode"):
+                query = request.payload.decode()
+            version = store_version
+            with tracing.span("cache") as span:
+                cached = query_cache.get(query, version)
+                span.set(hit=cached is not None)
+            if cached is not None:
+                return validated(request, cached, max_age=MAX_AGE)
+            res, code = await call_endpoint("query", query)
             if code:
-                return Message(payload=prefix_container.applyTo(res))
+                # encoded once for all the clients asking for this result
+                result = EncodedResult(res, prefix_container)
+                query_cache.put(query, version, result)
+                return validated(request, result, max_age=MAX_AGE)
             else:
                 return Message(code=BAD_REQUEST)
 
 
-class SparqlUpdate(coap.Resource):
-    """Resource that can be contacted to update the contents of the RDF store"""
+class SparqlBatchQuery(Measured, coap.Resource):
+    """Resource that can be contacted to make many queries at once, e.g.
+        GET coap://HERE_THE_URI/sparql/query/batch
+        ["SELECT ...", "ASK ..."]
+    The queries run concurrently, and the response is the list of their
+    SPARQL JSON results, in the same order (null for the failed ones).
+    Large responses are sent with blockwise transfer.
+    """
+    async def render_get(self, request):
+        logger.debug(f"Request from {request.remote.hostinfo}\nRequest payload: {request.payload}")
+        if request.payload == b'':
+            return Message(code=BAD_OPTION)
+        if request.opt.accept not in (None, JSON):
+            return Message(code=NOT_ACCEPTABLE)
+        try:
+            queries = json.loads(request.payload.decode())
+            if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+                raise ValueError("a list of queries is expected")
+        except ValueError as e:
+            logger.warning(f"Bad batch query: {e}")
+            return Message(code=BAD_REQUEST)
+
+        version = store_version
+        results = await asyncio.gather(*[self._query(query, version) for query in queries])
+        # the prefixes are applied once, to the whole response
+        response = b"[" + b",".join(b"null" if r is None else r for r in results) + b"]"
+        return validated(request, EncodedResult(response, prefix_container), max_age=MAX_AGE)
+
+    async def _query(self, query, version):
+        # raw result of 'query', shared with the query cache
+        cached = query_cache.get(query, version)
+        if cached is not None:
+            return cached.result
+        res, code = await call_endpoint("query", query)
+        if not code:
+            return None
+        query_cache.put(query, version, EncodedResult(res, prefix_container))
+        return res
+
+
+class SparqlQueryCache(coap.Resource):
+    """Resource giving the statistics of the query results cache"""
+    async def render_get(self, request):
+        logger.debug(f"Request from {request.remote.hostinfo}")
+        return Message(payload=json.dumps(query_cache.stats).encode())
+
+
+class SparqlQueryStats(coap.Resource):
+    """Resource giving the statistics of the rdflib endpoint: its threads,
+    and the utilization of each replica process when there are"""
+    async def render_get(self, request):
+        logger.debug(f"Request from {request.remote.hostinfo}")
+        stats = getattr(rdf_endpoint, "stats", None)
+        if stats is None:
+            return Message(code=NOT_FOUND, payload=b"No statistics for this endpoint")
+        return Message(payload=json.dumps(stats).encode())
+
+
+class AdminSnapshot(coap.Resource):
+    """Resource that writes a binary snapshot of the RDF store to the file
+    given at startup, e.g.
+        POST coap://HERE_THE_URI/admin/snapshot
+    The store is restored from that file when MUSEPA starts. GET gives the
+    report of the last snapshot written.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.last = None
+
+    async def render_get(self, request):
+        if self.last is None:
+            return Message(code=NOT_FOUND)
+        return Message(payload=json.dumps(self.last).encode(), content_format=JSON)
+
+    async def render_post(self, request):
+        logger.debug(f"Snapshot requested by {request.remote.hostinfo}")
+        try:
+            self.last = await rdf_endpoint.async_snapshot(self.path)
+        except Exception as e:
+            logger.error(f"Unable to write the snapshot: {e}")
+            return Message(code=INTERNAL_SERVER_ERROR)
+        return Message(code=CHANGED, payload=json.dumps(self.last).encode(), content_format=JSON)
+
+
+def request_format(request):
+    """Format of an update, from the 'format' uri query option, e.g.
+        POST coap://HERE_THE_URI/sparql/update?format=ttl
+    """
+    for option in request.opt.uri_query:
+        parse_option = option.split("=")
+        if len(parse_option) > 1 and "format" == parse_option[0]:
+            return parse_option[1]
+    return SPARQL
+
+
+class SparqlUpdate(Measured, coap.Resource):
+    """Resource that can be contacted to update the contents of the RDF store.
+
+    ttl and n3 contents sent in blocks (Block1) are streamed to the endpoint
+    while they are received, instead of being assembled first: each block is
+    acknowledged once the endpoint is ready for it, and the response to the
+    last block reports what was loaded.
+    """
     # https://stackoverflow.com/questions/107390/whats-the-difference-between-a-post-and-a-put-http-request
     # TODO render_delete to include possibility of deleting from
     # ttl or n3 format
+    def __init__(self):
+        super().__init__()
+        self.uploads = {}
+
+    async def needs_blockwise_assembly(self, request):
+        return request_format(request).lower() not in STREAMED_FORMATS
+
     async def render_post(self, request):
         global rdf_endpoint
         logger.debug(f"Request from {request.remote.hostinfo}\nRequest payload: {request.payload}")
@@ -90,41 +428,143 @@ class SparqlUpdate(coap.Resource):
             # Here the update logic, e.g., query rdflib or query fuseki or
             # Blazegraph. For return codes, have a look to
             # https://tools.ietf.org/html/rfc7252#section-5.9
-            coap_request_options = list(request.opt.option_list())
             code = True
-
-            # Here we need to check if there are more than one StringOption
-            # among the coap_request_options (i.e.: the format parameter)
-            stringOptionLen = sum(isinstance(i, StringOption) for i in coap_request_options)
-            if stringOptionLen > 1:
-                logger.warning("stringOptionLen > 1")
+            update_format = request_format(request)
+            if request.opt.block1 is not None and update_format.lower() in STREAMED_FORMATS:
+                return await self.renderBlock(request, update_format.lower())
+            if update_format != SPARQL:
                 # dealing with file upload, like .ttl
                 # e.g. POST coap://HERE_THE_URI/sparql/update?format=ttl
-                for option in coap_request_options:
-                    parse_option = str(option).split("=")
-                    if len(parse_option) > 1 and "format" == parse_option[0]:
-                        logger.info(f"Requested option {parse_option[1]} file")
-                        if hasattr(prefix_container, parse_option[1]):
-                            prefixed_update = getattr(prefix_container, parse_option[1]) + request.payload.decode()
-                        else:
-                            logger.warning(f"Unable to find {parse_option[1]} format...")
-                            prefixed_update = request.payload.decode()
-                        res, code = rdf_endpoint.update(prefixed_update, format=parse_option[1])
-                        logger.debug(f"Result: {res}; code: {code}")
-                        break
+                logger.info(f"Requested option {update_format} file")
+                with tracing.span("decode", format=update_format):
+                    if hasattr(prefix_container, update_format):
+                        prefixed_update = getattr(prefix_container, update_format) + request.payload.decode()
+                    else:
+                        logger.warning(f"Unable to find {update_format} format...")
+                        prefixed_update = request.payload.decode()
+                res, code = await call_endpoint("update", prefixed_update, format=update_format)
+                logger.debug(f"Result: {res}; code: {code}")
             else:
-                prefixed_update = prefix_container.sparql + request.payload.decode()
-                res, code = rdf_endpoint.update(prefixed_update)
+                # the prefixes are bound to the endpoint
+                with tracing.span("decode"):
+                    prefixed_update = request.payload.decode()
+                res, code = await call_endpoint("update", prefixed_update)
                 logger.debug(f"Result: {res}; code: {code}")
             if code:
-                for k in subscription_store.keys():
-                    subscription_store[k][RESOURCE].rescheduleNow()
+                # only the subscriptions reading the touched patterns
+                with tracing.span("fanout"):
+                    updated([(prefixed_update, update_format)])
                 return Message(code=CHANGED)
             else:
                 return Message(code=BAD_REQUEST)
 
+    def abandon(self, key):
+        """Stops the upload of 'key'. What was loaded of it stays in the
+        store: the subscriptions are re-evaluated once the ingestion stops."""
+        upload = self.uploads.pop(key)
+        upload.abort()
+        upload.future.add_done_callback(lambda future: updated())
+
+    def dropStaleUploads(self):
+        now = time.monotonic()
+        for key, upload in list(self.uploads.items()):
+            if now - upload.last > UPLOAD_TIMEOUT:
+                logger.warning(f"Upload from {key[0]} timed out")
+                self.abandon(key)
+
+    async def renderBlock(self, request, update_format):
+        """Streams a block of a ttl or n3 upload to the endpoint. Uploads are
+        told apart by client, format and Request-Tag option (RFC 9175), the
+        same in all the blocks of a content, unlike the token: a new block 0
+        restarts the upload."""
+        block1 = request.opt.block1
+        key = (request.remote.hostinfo, update_format, tuple(request.opt.request_tag))
+        self.dropStaleUploads()
+        upload = self.uploads.get(key)
+        if block1.block_number == 0:
+            if upload is not None:
+                self.abandon(key)
+            upload = self.uploads[key] = Upload(
+                partial(call_endpoint, "ingest"), update_format,
+                header=getattr(prefix_container, update_format, "").encode())
+            # the store changes while the content is loaded
+            updated([])
+        elif upload is not None and block1.block_number == upload.expected - 1 and block1.more:
+            # the acknowledgement of the previous block was lost
+            return Message(code=CONTINUE, block1=(block1.block_number, True, block1.size_exponent))
+        elif upload is None or block1.block_number != upload.expected:
+            logger.warning(f"Unexpected block {block1.block_number} from {key[0]}")
+            return Message(code=REQUEST_ENTITY_INCOMPLETE)
+
+        upload.put(request.payload)
+        if block1.more:
+            while upload.pending > MAX_PENDING_BLOCKS and not upload.future.done():
+                await asyncio.sleep(0.005)
+            if upload.future.done():
+                # the ingestion failed before the end of the content, that
+                # may be loaded in part
+                del self.uploads[key]
+                await upload.finish()
+                updated()
+                return Message(code=BAD_REQUEST)
+            return Message(code=CONTINUE, block1=(block1.block_number, True, block1.size_exponent))
+
+        del self.uploads[key]
+        triples, code = await upload.finish()
+        # the subscriptions may read any of the loaded triples
+        updated()
+        if not code:
+            return Message(code=BAD_REQUEST, block1=(block1.block_number, False, block1.size_exponent))
+        report = upload.report(triples)
+        logger.info(f"Loaded {triples} triples in {report['seconds']} s")
+        return Message(
+            code=CHANGED, payload=json.dumps(report).encode(), content_format=JSON,
+            block1=(block1.block_number, False, block1.size_exponent))
+
+
+class SparqlBatchUpdate(Measured, coap.Resource):
+    """Resource that can be contacted to make many updates at once, e.g.
+        POST coap://HERE_THE_URI/sparql/update/batch
+        ["INSERT DATA {...}", {"format": "ttl", "content": "..."}]
+    The updates are applied atomically (all or none), and the subscriptions
+    are re-evaluated once for the whole batch.
+    """
+    async def render_post(self, request):
+        logger.debug(f"Request from {request.remote.hostinfo}\nRequest payload: {request.payload}")
+        if request.payload == b'':
+            return Message(code=BAD_OPTION)
+        try:
+            items = json.loads(request.payload.decode())
+            if not isinstance(items, list):
+                raise ValueError("a list of updates is expected")
+            updates = []
+            for item in items:
+                if isinstance(item, str):
+                    item = {"content": item}
+                update_format = item.get("format", SPARQL)
+                content = item["content"]
+                if not isinstance(content, str) or not isinstance(update_format, str):
+                    raise TypeError("content and format must be strings")
+                update_format = update_format.lower()
+                if update_format != SPARQL and hasattr(prefix_container, update_format):
+                    content = getattr(prefix_container, update_format) + content
+                updates.append((content, update_format))
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Bad batch update: {e}")
+            return Message(code=BAD_REQUEST)
+        if not updates:
+            return Message(code=BAD_OPTION)
+
+        res, code = await call_endpoint("update_many", updates)
+        logger.debug(f"Result: {res}; code: {code}")
+        if not code:
+            return Message(code=BAD_REQUEST)
+        with tracing.span("fanout"):
+            updated(updates)
+        return Message(code=CHANGED)
 
-class SparqlSubscription(coap.Resource):
+
+class SparqlSubscription(Measured, coap.Resource):
     """Resource that should be contacted to
     - request new subscriptions
     - get some informations about running subscriptions
@@ -137,17 +577,18 @@ class SparqlSubscription(coap.Resource):
         if request.payload == b'':
             return Message(code=BAD_OPTION)
         else:
-            hash_alias = md5(request.payload).hexdigest()
+            decoded_payload = request.payload.decode()
+            # Equivalent queries share the same alias, and so the same
+            # resource and evaluation
+            hash_alias = canonical_alias(decoded_payload, initNs=prefix_container.dictionary)
             if hash_alias not in subscription_store.keys():
                 # Only if the subscription does not exist we create a new resource
-                decoded_payload = request.payload.decode()
                 new_res = SubscriptionResource(hash_alias, decoded_payload)
-                subscription_store[hash_alias] = {
-                    SPARQL: decoded_payload,
-                    RESOURCE: new_res,
-                    CLIENTS: []}
-                root.add_resource((hash_alias,), new_res)
+                await new_res.notify()
+                register(hash_alias, decoded_payload, new_res)
                 logging.warning(root.get_resources_as_linkheader())
+                if cluster_link is not None:
+                    cluster_link.subscribed(hash_alias, decoded_payload)
             return Message(payload=hash_alias.encode(), code=CREATED)
 
     async def render_get(self, request):
@@ -163,9 +604,12 @@ class SparqlSubscription(coap.Resource):
         if decoded_payload == '':
             return Message(code=NOT_FOUND)
         elif decoded_payload in subscription_store.keys():
+            resource = subscription_store[decoded_payload][RESOURCE]
             informations = {
                 SPARQL: subscription_store[decoded_payload][SPARQL],
-                CLIENTS: len(subscription_store[decoded_payload][CLIENTS])}
+                CLIENTS: len(subscription_store[decoded_payload][CLIENTS]),
+                "evaluations": resource.evaluations,
+                "saved": resource.saved}
             logger.debug(f"Subscription {decoded_payload} information: {informations}")
             return Message(payload=json.dumps(informations).encode())
         else:
@@ -176,26 +620,179 @@ class SparqlSubscription(coap.Resource):
         return Message(code=BAD_REQUEST, payload=b'Use GET request to subscription resource with observe flag =1')
 
 
-class SubscriptionResource(coap.ObservableResource):
+class SubscriptionResource(Measured, coap.ObservableResource):
     """ObservableResource class that deals with notifications to subscribers"""
+    # Coalescing window of the re-evaluations, in seconds: a re-evaluation
+    # waits 'debounce' seconds without further requests, but no more than
+    # 'maxLatency' seconds since the first pending one.
+    debounce = 0.0
+    maxLatency = 0.0
+
     def __init__(self, alias, content):
         super().__init__()
         self.alias = alias
-        self.content = prefix_container.sparql + content
-        self.lastRes, _ = rdf_endpoint.query(content)
-        self.notify()
+        self.content = content
+        self.lastRes = None
+        # lastRes encodings, shared by the observers
+        self.encoded = None
+        self.handle = None
+        self._rerun = False
+        self._timer = None
+        self._firstRequest = None
+        # re-evaluations done, and requests merged into a pending one
+        self.evaluations = 0
+        self.saved = 0
+        # Sequence number of lastRes, and the last added/removed bindings as
+        # (sequence, delta) (only if someone asked for them)
+        self.sequence = 0
+        self._deltas = deque(maxlen=DELTA_HISTORY)
+        self._deltaPayload = None
+        self._lastBindings = None
+        # delta mode observations: request -> last sequence number sent
+        self._deltaObservers = WeakKeyDictionary()
+        self.observers = 0
+        # updates waiting for the next evaluation, see metrics.FanOut
+        self._fanouts = []
+
+    def metricsLabels(self):
+        return {"resource": type(self).__name__, "subscription": self.alias}
+
+    def update_observation_count(self, newcount):
+        self.observers = newcount
 
-    def notify(self):
-        new, code = rdf_endpoint.query(self.content)
+    def _forget(self):
+        # The result is stale, and computed again when asked
+        self.lastRes = None
+        self.encoded = None
+        self._lastBindings = None
+        self._deltas.clear()
+        self._deltaPayload = None
+
+    async def notify(self):
+        with tracing.trace("SubscriptionResource.notify", subscription=self.alias):
+            await self._notify()
+
+    async def _notify(self):
+        new, code = await call_endpoint("query", self.content)
         logger.info("{} notify method called!".format(self.alias))
-        if new != self.lastRes:
+        if code and new != self.lastRes:
             # only if old results differs from the new ones
+            with tracing.span("delta"):
+                delta = self._computeDelta(new) if len(self._deltaObservers) else None
             self.lastRes = new
+            self.encoded = EncodedResult(new, prefix_container)
+            self.sequence += 1
+            self._deltaPayload = None
+            if delta is None:
+                self._lastBindings = None
+                self._deltas.clear()
+            else:
+                self._deltas.append((self.sequence, delta))
             self.updated_state()
 
-    def rescheduleNow(self):
-        # TODO verify if this method is necessary, or if we can directly call self.notify instead
-        self.handle = asyncio.get_event_loop().call_soon_threadsafe(self.notify)
+    def _computeDelta(self, new):
+        # computed once for all the delta mode observers
+        old = self._lastBindings if self._lastBindings is not None else result_bindings(self.lastRes)
+        self._lastBindings = result_bindings(new)
+        if old is None or self._lastBindings is None:
+            return None
+        return bindings_delta(old, self._lastBindings)
+
+    def _encodeDelta(self, delta):
+        added, removed = delta_bindings(delta)
+        return prefix_container.applyTo(json.dumps({
+            "sequence": self.sequence,
+            "added": added,
+            "removed": removed}).encode())
+
+    def _renderDelta(self, request):
+        # Added/removed bindings are sent only to the observers that received
+        # one of the previous sequence numbers still in the history: in any
+        # other case, e.g. first observe response or explicit resync through a
+        # plain GET, a full snapshot
+        last = self._deltaObservers.get(request) if request.opt.observe == 0 else None
+        steps = [delta for sequence, delta in self._deltas if last is not None and sequence > last]
+        if last is None or not steps or len(steps) != self.sequence - last:
+            payload = prefix_container.applyTo(json.dumps({
+                "sequence": self.sequence,
+                "snapshot": json.loads(self.lastRes)}).encode())
+        elif len(steps) == 1:
+            # the common case is encoded once for all the observers
+            if self._deltaPayload is None:
+                self._deltaPayload = self._encodeDelta(steps[0])
+            payload = self._deltaPayload
+        else:
+            # some notifications were merged: so are the deltas
+            merged = Counter()
+            for delta in steps:
+                merged.update(delta)
+            payload = self._encodeDelta(merged)
+        if request.opt.observe == 0:
+            self._deltaObservers[request] = self.sequence
+        return payload
+
+    def rescheduleNow(self, fanout=None):
+        if cluster_link is not None and not self.observers:
+            # In cluster mode, a subscription is evaluated by the processes
+            # where it is observed, the others wait for a request
+            self._forget()
+            if fanout is not None:
+                fanout.done()
+            return
+        if fanout is not None:
+            self._fanouts.append(fanout)
+        if self._timer is not None:
+            # A re-evaluation is already pending: it absorbs this request,
+            # and it is postponed within the window
+            self.saved += 1
+            if self.debounce:
+                self._timer.cancel()
+                self._schedule()
+        elif self.handle is not None and not self.handle.done():
+            # An evaluation is already running, and its result may not
+            # include the last update: it will be run once more, for all
+            # the requests made meanwhile.
+            if self._rerun:
+                self.saved += 1
+            self._rerun = True
+        else:
+            self._firstRequest = asyncio.get_event_loop().time()
+            self._schedule()
+
+    def close(self):
+        """Cancels the pending re-evaluation, once the resource is removed"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._rerun = False
+        fanouts, self._fanouts = self._fanouts, []
+        for fanout in fanouts:
+            fanout.done()
+
+    def _schedule(self):
+        loop = asyncio.get_event_loop()
+        deadline = self._firstRequest + max(self.debounce, self.maxLatency)
+        self._timer = loop.call_at(min(loop.time() + self.debounce, deadline), self._evaluate)
+
+    def _evaluate(self):
+        self._timer = None
+        self.handle = asyncio.ensure_future(self._reevaluate())
+
+    async def _reevaluate(self):
+        # Evaluations of the same subscription never overlap, so that
+        # an older result cannot overwrite a newer one
+        self._rerun = False
+        self.evaluations += 1
+        fanouts, self._fanouts = self._fanouts, []
+        try:
+            await self.notify()
+        finally:
+            for fanout in fanouts:
+                fanout.done()
+            if self._rerun:
+                self._rerun = False
+                self._firstRequest = asyncio.get_event_loop().time()
+                self._schedule()
 
     async def render_get(self, request):
         global root
@@ -208,8 +805,13 @@ class SubscriptionResource(coap.ObservableResource):
                 logger.warning(f"{client} stopped observing {self.alias} resource")
                 if len(subscription_store[self.alias][CLIENTS]) == 0:
                     # if it's the only client observing
-                    root.remove_resource((self.alias,))
-                    del subscription_store[self.alias]
+                    if cluster_link is not None:
+                        cluster_link.detached(self.alias)
+                        if cluster_link.held(self.alias):
+                            # observed through other processes: it stays
+                            # here, as their mirrors, for the next clients
+                            return Message(code=CHANGED)
+                    unregister(self.alias)
                     return Message(code=DELETED)
                     #return Message(code=DELETED, payload=b'Resource deleted')
                 else:
@@ -222,14 +824,32 @@ class SubscriptionResource(coap.ObservableResource):
         else:
             if client not in subscription_store[self.alias][CLIENTS]:
                 subscription_store[self.alias][CLIENTS].append(client)
+                if cluster_link is not None and len(subscription_store[self.alias][CLIENTS]) == 1:
+                    cluster_link.attached(self.alias, self.content)
             logger.debug(subscription_store)
-            return Message(payload=prefix_container.applyTo(self.lastRes))
+            if self.encoded is None:
+                await self.notify()
+                if self.encoded is None:
+                    return Message(code=INTERNAL_SERVER_ERROR)
+            if DELTA_MODE in request.opt.uri_query:
+                if request.opt.accept not in (None, JSON):
+                    return Message(code=NOT_ACCEPTABLE)
+                return Message(payload=self._renderDelta(request), content_format=JSON)
+            # notifications are fresh until the next one
+            return validated(request, self.encoded,
+                             max_age=None if request.opt.observe == 0 else MAX_AGE)
 
 
 def musepa(a4=DEFAULT, a6=DEFAULT, port=5683,  # custom ip:port address for musepa
            endpoint="blazegraph",  # endpoint type: choose between rdflib and Blazegraph
            event_loop=asyncio.new_event_loop(),  # event loop: only if you know what you are doing
-           params=None):  # additional params to be used to parametrize the endpoint
+           params=None,  # additional params to be used to parametrize the endpoint
+           endpoint_options=None,  # keyword options for the endpoint constructor
+           debounce=0.0, max_latency=0.0,  # subscriptions coalescing window
+           cache_size=DEFAULT_CACHE_SIZE,  # query results cache
+           snapshot=None,  # snapshot file of the rdflib store
+           prefixes=None,  # prefixes file
+           trace=None, trace_rate=DEFAULT_SAMPLE_RATE):  # spans file, and fraction of requests traced
     """Invokes musepa in a programmatic way (no CLI)
 
     Parameters
@@ -256,54 +876,140 @@ def musepa(a4=DEFAULT, a6=DEFAULT, port=5683,  # custom ip:port address for muse
     params = str, optional
         defaults to None, it is useful to give programmatically params to the
         endpoint instance that should be created
+
+    endpoint_options = dict, optional
+        defaults to None, keyword options given to the endpoint constructor,
+        e.g. {"pool_size": 64, "timeout": 5} for blazegraph and fuseki,
+        {"workers": 4} or {"processes": 8} for rdflib
+
+    debounce = float, optional
+        defaults to 0, seconds without updates that a subscription waits
+        before being re-evaluated
+
+    max_latency = float, optional
+        defaults to 0, maximum seconds a subscription re-evaluation can be
+        postponed by the debounce
+
+    cache_size = int, optional
+        defaults to DEFAULT_CACHE_SIZE, number of query results kept in cache.
+        0 disables the cache
+
+    snapshot = str, optional
+        defaults to None, rdflib and compact endpoints only: file from which
+        the store is restored at startup, and where /admin/snapshot writes
+
+    prefixes = str, optional
+        defaults to None, path of a file containing prefixes in ttl format
+
+    trace = str, optional
+        defaults to None, file where the timings of the stages of the
+        requests are written, see tracing.JSONLinesExporter
+
+    trace_rate = float, optional
+        defaults to DEFAULT_SAMPLE_RATE, fraction of the requests traced
     """
     global subscription_store
+    global subscription_index
     global prefix_container
+    global store_version
+    global query_cache
+    global server
+    global metrics
+    server = None
+    metrics = Metrics()
     subscription_store = {}
-    prefix_container = Prefixes()
+    subscription_index = SubscriptionIndex()
+    store_version = 0
+    query_cache = ResultCache(cache_size)
+    prefix_container = Prefixes(prefixes) if prefixes else Prefixes()
     logFormat = "%(levelname)s   %(asctime)-15s %(filename)s[%(lineno)d] : %(message)s"
     logging.basicConfig(level=logging.INFO, format=logFormat, filename="./musepa_log.log")
     logging.warning(subscription_store)
     asyncio.set_event_loop(event_loop)
-    main(a4, a6, port, endpoint=get_endpoint(endpoint, params), loop=event_loop)
+    options = endpoint_options if endpoint_options else {}
+    main(a4, a6, port, endpoint=get_endpoint(endpoint, params, **options), loop=event_loop,
+         debounce=debounce, max_latency=max_latency, snapshot=snapshot, trace=trace, trace_rate=trace_rate)
 
 
-def main(addressV4, addressV6, port, endpoint, loop=asyncio.get_event_loop()):
+async def shutdown():
+    """Closes the CoAP server context, releasing its port"""
+    if server is not None:
+        await (await server).shutdown()
+
+
+def main(addressV4, addressV6, port, endpoint, loop=asyncio.get_event_loop(),
+         debounce=0.0, max_latency=0.0, snapshot=None, trace=None, trace_rate=DEFAULT_SAMPLE_RATE):
     # setup endpoint
     global rdf_endpoint
     rdf_endpoint = endpoint
+    if snapshot is not None:
+        if not isinstance(rdf_endpoint, RDFLibEndpoint):
+            errorMsg = "Snapshots are available for the rdflib and compact endpoints only"
+            logger.critical(errorMsg)
+            raise ValueError(errorMsg)
+        if exists(snapshot):
+            rdf_endpoint.restore(snapshot)
+    rdf_endpoint.bind_prefixes(prefix_container.dictionary)
+    if trace is not None:
+        tracing.set_tracer(SamplingTracer(JSONLinesExporter(trace), rate=trace_rate))
+
+    # setup subscriptions coalescing window
+    SubscriptionResource.debounce = debounce
+    SubscriptionResource.maxLatency = max_latency
 
     global root
+    global server
     root = coap.Site()
     root.add_resource((".well-known", "core"), coap.WKCResource(root.get_resources_as_linkheader))
     root.add_resource(('info',), musepaInfo())
+    root.add_resource(('metrics',), musepaMetrics())
     root.add_resource((SPARQL, 'query',), SparqlQuery()) 
+    root.add_resource((SPARQL, 'query', 'cache'), SparqlQueryCache())
+    root.add_resource((SPARQL, 'query', 'stats'), SparqlQueryStats())
+    root.add_resource((SPARQL, 'query', 'batch'), SparqlBatchQuery())
     root.add_resource((SPARQL, 'update',), SparqlUpdate())
+    root.add_resource((SPARQL, 'update', 'batch'), SparqlBatchUpdate())
     root.add_resource((SPARQL,'subscription',),SparqlSubscription())
+    if snapshot is not None:
+        root.add_resource(('admin', 'snapshot'), AdminSnapshot(snapshot))
     # TODO accept ttl file to make delete
     # print(root.get_resources_as_linkheader())
 
     musepaAddress = ""
     if addressV4 == DEFAULT:
-        asyncio.Task(Context.create_server_context(root))
+        server = asyncio.Task(Context.create_server_context(root))
         print("This CoAP server is running on default params")
         musepaAddress = "coap://localhost"
     else:
-        asyncio.Task(Context.create_server_context(root, bind=(addressV6, port)))
+        server = asyncio.Task(Context.create_server_context(root, bind=(addressV6, port)))
         print(f"This CoAP server is running on {addressV4}:{port}")
         musepaAddress = f"coap://{addressV4}:{port}"
     print(f"""\n/-------------------------------------------------------\\
 | Information: \t{musepaAddress}/info
+| Metrics: \t{musepaAddress}/metrics
 | Query: \t{musepaAddress}/sparql/query
+| Query cache: \t{musepaAddress}/sparql/query/cache
+| Query stats: \t{musepaAddress}/sparql/query/stats
+| Batch query: \t{musepaAddress}/sparql/query/batch
 | Update: \t{musepaAddress}/sparql/update
+| Batch update: \t{musepaAddress}/sparql/update/batch
 | Subscribe: \t{musepaAddress}/sparql/subscription
 \\-------------------------------------------------------/""")
+    if snapshot is not None:
+        print(f"Snapshot: \t{musepaAddress}/admin/snapshot -> {snapshot}")
+    if cluster_link is not None:
+        cluster_link.attach(loop)
 
     logger.info("waiting for client action...")
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         logger.info("Received keyboard interrupt: shutting down!")
+    if snapshot is not None:
+        # the next start is restored from here
+        rdf_endpoint.snapshot(snapshot)
+    if trace is not None:
+        tracing.set_tracer(tracing.Tracer()).close()
     logger.info("MUSEPA was stopped")
 
 
@@ -318,11 +1024,55 @@ if __name__ == '__main__':
         default=5683, type=int, help="MUSEPA server port")
     parser.add_argument(
         "--endpoint", metavar=("ENDPOINT_NAME"),
-        default="rdflib", choices=["blazegraph", "fuseki", "rdflib"],
+        default="rdflib", choices=["blazegraph", "fuseki", "rdflib", "compact"],
         help="Choose the RDF endpoint to be used")
     parser.add_argument(
         "--endpoint_param", metavar=("ENDPOINT_PARAMETER"),
-        default=None, help="Add here a parameter for the endpoint. In case of Fuseki, for instance, provide here the uri like http://127.0.0.1:3030/_dataset_")
+        default=None, help="Add here a parameter for the endpoint. In case of Fuseki, for instance, provide here the uri like http://127.0.0.1:3030/_dataset_. In case of rdflib, the path of a SQLite file where the triples are kept across restarts")
+    parser.add_argument(
+        "--pool_size", metavar=("POOL_SIZE"),
+        default=None, type=int,
+        help="Blazegraph and Fuseki only: connections kept open to the endpoint, and concurrent calls (default {})".format(DEFAULT_POOL_SIZE))
+    parser.add_argument(
+        "--timeout", metavar=("SECONDS"),
+        default=None, type=float,
+        help="Blazegraph and Fuseki only: timeout of each call to the endpoint (default {})".format(DEFAULT_TIMEOUT))
+    parser.add_argument(
+        "--workers", metavar=("WORKERS"),
+        default=None, type=int,
+        help="rdflib and compact only: run queries and updates on this number of threads, instead of the event loop one")
+    parser.add_argument(
+        "--processes", metavar=("PROCESSES"),
+        default=None, type=int,
+        help="rdflib and compact only: run queries on this number of processes, holding replicas of the store")
+    parser.add_argument(
+        "--cluster", metavar=("PROCESSES"),
+        default=None, type=int,
+        help="Blazegraph and Fuseki only: run this number of MUSEPA processes on the same port")
+    parser.add_argument(
+        "--debounce", metavar=("SECONDS"),
+        default=0.0, type=float,
+        help="Subscriptions are re-evaluated once there are no updates for this time (default 0)")
+    parser.add_argument(
+        "--max_latency", metavar=("SECONDS"),
+        default=0.0, type=float,
+        help="Maximum time a subscription re-evaluation can be postponed by --debounce (default 0)")
+    parser.add_argument(
+        "--cache_size", metavar=("RESULTS"),
+        default=DEFAULT_CACHE_SIZE, type=int,
+        help="Number of query results kept in cache, 0 to disable it (default {})".format(DEFAULT_CACHE_SIZE))
+    parser.add_argument(
+        "--snapshot", metavar=("PATH"),
+        default=None,
+        help="rdflib and compact only: restore the store from this binary snapshot at startup, write it at shutdown and on POST /admin/snapshot")
+    parser.add_argument(
+        "--trace", metavar=("PATH"),
+        default=None,
+        help="Append the timings of the stages of the requests to this file, one JSON span per line (see tracing.py)")
+    parser.add_argument(
+        "--trace_rate", metavar=("RATE"),
+        default=DEFAULT_SAMPLE_RATE, type=float,
+        help="Fraction of the requests traced with --trace (default {})".format(DEFAULT_SAMPLE_RATE))
     parser.add_argument(
         "--prefixes", metavar=("PATH_TO_PREFIX_FILE"),
         default=None, help="If needed, add here the path to a file containing prefixes in a ttl format")
@@ -336,6 +1086,15 @@ if __name__ == '__main__':
         help="Destination of the logging messages (default is 'stdout')")
     parser.add_argument("-v", "--verbose", action="store_true", help="Include imported logs")
     args = parser.parse_args()
+
+    endpoint_options = {}
+    for option in ("pool_size", "timeout", "workers", "processes"):
+        value = getattr(args, option)
+        if value is None:
+            continue
+        if option not in ENDPOINT_OPTIONS.get(args.endpoint.lower(), ()):
+            parser.error(f"--{option} is not available for the {args.endpoint} endpoint")
+        endpoint_options[option] = value
     logging.debug(args)
 
     print("""Welcome to
@@ -383,6 +1142,18 @@ if __name__ == '__main__':
         prefix_container = Prefixes(args.prefixes)
     logger.info("MUSEPA configuration complete!")
 
+    query_cache = ResultCache(args.cache_size)
+
+    if args.cluster:
+        from cluster import cluster
+        cluster(args.cluster, a4=addressV4, a6=addressV6, port=args.port,
+                endpoint=args.endpoint, params=args.endpoint_param, endpoint_options=endpoint_options,
+                debounce=args.debounce, max_latency=args.max_latency, cache_size=args.cache_size,
+                prefixes=args.prefixes, trace=args.trace, trace_rate=args.trace_rate)
+        sys.exit(0)
+
     main(addressV4, addressV6, args.port,
-         get_endpoint(args.endpoint, params=args.endpoint_param))
+         get_endpoint(args.endpoint, params=args.endpoint_param, **endpoint_options),
+         debounce=args.debounce, max_latency=args.max_latency, snapshot=args.snapshot,
+         trace=args.trace, trace_rate=args.trace_rate)
     sys.exit(0)
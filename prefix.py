@@ -9,6 +9,7 @@
 #
 
 import logging
+import json
 import re
 
 from os.path import isfile
@@ -16,15 +17,137 @@ from os.path import isfile
 TAG = "tag"
 NAMESPACE = "namespace"
 
+# IRI positions in a SPARQL JSON result: values of the bindings whose type is
+# 'uri' (whatever the order of the keys) and datatypes of the literals. Each
+# alternative captures the key and the IRI. A JSON string cannot contain an
+# unescaped quote, so the keys cannot be matched within a literal value.
+_JSON_STRING = rb'([^"\\]*(?:\\.[^"\\]*)*)(?=")'
+_JSON_IRI_REGEX = re.compile(
+    rb'("(?:type"\s*:\s*"uri"\s*,\s*"value|datatype)"\s*:\s*")' + _JSON_STRING +
+    rb'|("value"\s*:\s*")' + _JSON_STRING + rb'(?="\s*,\s*"type"\s*:\s*"uri")')
+# Type of the literal bindings, and what precedes their value when it
+# follows the type
+_LITERAL = b'literal"'
+_LITERAL_VALUE_REGEX = re.compile(rb'literal"\s*,\s*"value"\s*:\s*"')
+
+# Up to these prefixes, the namespaces are replaced one after the other, as
+# bytes.replace does it faster than a regex; beyond, in one regex pass
+FEW_PREFIXES = 8
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(levelname)s   %(asctime)-15s %(filename)s[%(lineno)d] : %(message)s")
 
+class IRICompactor():
+    """Replaces the namespaces of the IRIs with their prefix.
+
+    In SPARQL JSON results, the strings beginning with a namespace are
+    replaced, as the IRIs are, unless a literal begins with one: then only
+    the IRIs of the bindings and the literal datatypes are, one by one.
+    Other payloads, e.g. XML results or JSON-LD, have every occurrence of the
+    namespaces replaced.
+
+    Parameters
+    ----------
+    prefixes : dict
+        namespaces by tag, e.g. {"rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#"}
+    """
+    def __init__(self, prefixes):
+        self._tags = {}
+        for tag, namespace in prefixes.items():
+            self._tags[namespace.encode()] = tag.encode() + b":"
+        # the longest namespace matches first: the candidates are the IRI
+        # beginnings as long as one of the namespaces
+        self._lengths = sorted({len(namespace) for namespace in self._tags}, reverse=True)
+        longest = sorted(self._tags, key=len, reverse=True)
+        self._replacements = [(namespace, self._tags[namespace]) for namespace in longest]
+        self._quoted_tags = {b'"' + namespace: b'"' + tag for namespace, tag in self._replacements}
+        self._quoted_replacements = list(self._quoted_tags.items())
+        # the beginnings (schemes) a literal shares with the IRIs to compact
+        self._schemes = {namespace.partition(b":")[0] + b":" for namespace in self._tags}
+        self._namespace_regex = self._quoted_regex = None
+        if self._tags:
+            alternatives = b"|".join(re.escape(namespace) for namespace in longest)
+            self._namespace_regex = re.compile(b"(" + alternatives + b")")
+            self._quoted_regex = re.compile(b'("(?:' + alternatives + b"))")
+
+    def compact(self, iri):
+        """Compacts a single IRI, given as bytes"""
+        for length in self._lengths:
+            tag = self._tags.get(iri[:length])
+            if tag is not None:
+                return tag + iri[length:]
+        return iri
+
+    def _compact_json_string(self, iri):
+        if b"\\" in iri:
+            # escaped characters, e.g. '\/', have to be decoded first
+            return json.dumps(self.compact(json.loads(b'"' + iri + b'"').encode()).decode())[1:-1].encode()
+        return self.compact(iri)
+
+    def _replace(self, content, replacements, regex, tags):
+        # Replaces the keys of 'tags', longest first
+        if len(replacements) <= FEW_PREFIXES:
+            for namespace, tag in replacements:
+                content = content.replace(namespace, tag)
+            return content
+        # the split gives the text between the matches, each one followed by
+        # the namespace it matched
+        parts = regex.split(content)
+        parts[1::2] = map(tags.__getitem__, parts[1::2])
+        return b"".join(parts)
+
+    def _literals_apart(self, content):
+        # True if no literal of the SPARQL JSON 'content' begins with a
+        # namespace, and no IRI has escaped characters hiding its namespace
+        if b"\\" in content and b"\\/" in content:
+            return False
+        first = content.find(_LITERAL)
+        if first < 0:
+            return True
+        layout = _LITERAL_VALUE_REGEX.match(content, first)
+        # every literal has its value just after its type, as the first
+        # one: their beginning is next to the same text
+        if layout is None or content.count(layout.group()) != content.count(_LITERAL):
+            return False
+        return not any(layout.group() + scheme in content for scheme in self._schemes)
+
+    def _compact_iris(self, content):
+        # The split gives the text between the matches, each one followed by
+        # the 4 groups of the regex: key and IRI of the alternative that
+        # matched, None for the other one
+        parts = _JSON_IRI_REGEX.split(content)
+        compacted = {}
+        for i in range(2, len(parts), 5):
+            if parts[i] is None:
+                i += 2
+            iri = parts[i]
+            short = compacted.get(iri)
+            if short is None:
+                short = compacted[iri] = self._compact_json_string(iri)
+            parts[i] = short
+        return b"".join(filter(None, parts))
+
+    def apply(self, content):
+        """Compacts the IRIs of 'content' (bytes). If it is a SPARQL JSON
+        result (or a list of them), the literals are kept as they are.
+        Otherwise, every occurrence of a namespace is compacted."""
+        if not self._tags or not content:
+            return content
+        if content.lstrip()[:1] not in (b"{", b"[") or b'"type"' not in content:
+            # not made of SPARQL JSON terms, e.g. JSON-LD
+            return self._replace(content, self._replacements, self._namespace_regex, self._tags)
+        if self._literals_apart(content):
+            # the strings beginning with a namespace are IRIs
+            return self._replace(content, self._quoted_replacements, self._quoted_regex, self._quoted_tags)
+        return self._compact_iris(content)
+
 class Prefixes():
     """This class includes the utilities needed when the MUSEPA --prefixes option is called"""
     def __init__(self, path_to_file="", silent=False):
         self._prefix_dict = {}
         self._ttl = ""
         self._sparql = ""
+        self._compactor = None
         
         if path_to_file:
             if isfile(path_to_file):
@@ -60,23 +183,26 @@ class Prefixes():
     def dictionary(self):
         return self._prefix_dict
 
+    @property
+    def compactor(self):
+        """IRICompactor of these prefixes"""
+        if self._compactor is None:
+            self._compactor = IRICompactor(self._prefix_dict)
+        return self._compactor
+
     def addPrefix(self, tag, namespace):
         if tag in self._prefix_dict:
             raise ValueError("Duplicate prefix request")
         else:
             self._prefix_dict[tag] = namespace
-            self._sparql += f"PREFIX {group[TAG]}: <{group[NAMESPACE]}> \n"
-            self._ttl += f"@prefix {group[TAG]}: <{group[NAMESPACE]}> .\n"
+            self._sparql += f"PREFIX {tag}: <{namespace}>\n"
+            self._ttl += f"@prefix {tag}: <{namespace}> .\n"
+            self._compactor = None
 
     def applyTo(self, content):
         """
         This function applies the prefixes to the 'content' variable. That is, if the content is 
         'http://francesco#test' and there is a prefix 'ns: <http://francesco#>', the returned value 
-        will be 'ns:test'
+        will be 'ns:test'. In SPARQL JSON results, only the IRIs are changed, not the literals.
         """
-        #if content:
-        n_content = content.decode()
-        for prefix, value in self._prefix_dict.items():
-            n_content = n_content.replace(value, prefix+':')
-        return n_content.encode()
-        #return ""
\ No newline at end of file
+        return self.compactor.apply(content)
\ No newline at end of file
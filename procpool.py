@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  procpool.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import multiprocessing
+import threading
+import time
+
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from rdflib import Graph
+from rdflib.store import Store
+from rdflib.plugins.sparql import prepareQuery
+from compactstore import CompactStore
+from snapshot import load
+
+# Messages to the replicas, first element of the tuples sent on their pipe:
+#   (QUERY, sparql, format, prefixes)  answered with (result, ok, busy seconds)
+#   (CHANGES, [(op, args), ...])  ops of JournalStore, not answered
+#   (LOAD, path)  answered with (report, ok, busy seconds)
+#   (STOP,)
+QUERY = "query"
+CHANGES = "changes"
+LOAD = "load"
+STOP = "stop"
+
+ADD = "add"
+REMOVE = "remove"
+BIND = "bind"
+
+# Parsed queries kept by each replica
+DEFAULT_PREPARED_SIZE = 128
+
+# Seconds given to the replicas to stop by themselves
+STOP_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class JournalStore(Store):
+    """Store wrapper that keeps, in order, the changes made to the wrapped
+    store, so that they can be replayed on its replicas. The changes are
+    kept as they are asked, patterns included: replayed on a replica in
+    the same state, they have the same effect.
+
+    On rollback, the changes since the last commit are forgotten if the
+    wrapped store undoes them, and kept otherwise.
+
+    Parameters
+    ----------
+    store : rdflib.store.Store
+        the wrapped store
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.context_aware = store.context_aware
+        self.formula_aware = store.formula_aware
+        self.transaction_aware = store.transaction_aware
+        self.graph_aware = store.graph_aware
+        self._changes = []
+        self._committed = 0
+        super().__init__()
+
+    def take(self):
+        """Returns the changes recorded so far, and forgets them"""
+        changes, self._changes, self._committed = self._changes, [], 0
+        return changes
+
+    def add(self, triple, context=None, quoted=False):
+        self._changes.append((ADD, tuple(triple)))
+        self.store.add(triple, context, quoted)
+
+    def addN(self, quads):
+        quads = list(quads)
+        self._changes.extend((ADD, (s, p, o)) for s, p, o, _ in quads)
+        self.store.addN(quads)
+
+    def remove(self, triple, context=None):
+        self._changes.append((REMOVE, tuple(triple)))
+        self.store.remove(triple, context)
+
+    def triples(self, triple_pattern, context=None):
+        return self.store.triples(triple_pattern, context)
+
+    def __len__(self, context=None):
+        return self.store.__len__(context)
+
+    def contexts(self, triple=None):
+        return self.store.contexts(triple)
+
+    def bind(self, prefix, namespace, override=True):
+        self._changes.append((BIND, (prefix, namespace, override)))
+        self.store.bind(prefix, namespace, override=override)
+
+    def namespace(self, prefix):
+        return self.store.namespace(prefix)
+
+    def prefix(self, namespace):
+        return self.store.prefix(namespace)
+
+    def namespaces(self):
+        return self.store.namespaces()
+
+    def commit(self):
+        self.store.commit()
+        self._committed = len(self._changes)
+
+    def rollback(self):
+        self.store.rollback()
+        if self.transaction_aware:
+            del self._changes[self._committed:]
+
+    def close(self, commit_pending_transaction=False):
+        self.store.close(commit_pending_transaction=commit_pending_transaction)
+
+
+def _apply(graph, changes):
+    # Replays JournalStore changes
+    for op, args in changes:
+        if op == ADD:
+            graph.store.add(args, graph)
+        elif op == REMOVE:
+            graph.store.remove(args, graph)
+        elif op == BIND:
+            prefix, namespace, override = args
+            graph.store.bind(prefix, namespace, override=override)
+
+
+def _serve(connection, compact, prepared_size):
+    # Body of the replica processes: the messages are handled in the order
+    # they are sent, so a query sees all the changes sent before it
+    graph = Graph(store=CompactStore()) if compact else Graph()
+    prepared = OrderedDict()
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        kind = message[0]
+        if kind == STOP:
+            return
+        elif kind == CHANGES:
+            _apply(graph, message[1])
+            continue
+        started = time.perf_counter()
+        try:
+            if kind == QUERY:
+                _, sparql, format, prefixes = message
+                query = prepared.get((sparql, prefixes))
+                if query is None:
+                    query = prepareQuery(sparql, initNs=dict(prefixes))
+                    if prepared_size:
+                        prepared[sparql, prefixes] = query
+                        if len(prepared) > prepared_size:
+                            prepared.popitem(last=False)
+                else:
+                    prepared.move_to_end((sparql, prefixes))
+                result, ok = graph.query(query).serialize(format=format), True
+            else:
+                result, ok = load(graph, message[1]), True
+        except Exception as e:
+            logger.error(e)
+            result, ok = None, False
+        connection.send((result, ok, time.perf_counter() - started))
+
+
+class _Replica():
+    # Handle of a replica process: its pipe, and the futures of the
+    # answers it owes, resolved in order by a reader thread
+    def __init__(self, context, index, compact, prepared_size):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child, compact, prepared_size),
+            name=f"RDFLibReplica-{index}", daemon=True)
+        self.process.start()
+        child.close()
+        self.started = time.monotonic()
+        self.alive = True
+        self.queries = 0
+        self.busy = 0.0
+        self.pending = deque()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read, name=f"RDFLibReplica-{index}-reader", daemon=True)
+        self._reader.start()
+
+    def send(self, message, future=None):
+        with self._lock:
+            if not self.alive:
+                raise ConnectionError(f"{self.process.name} is not running")
+            if future is not None:
+                self.pending.append((message[0], future))
+            self.connection.send(message)
+
+    def _read(self):
+        while True:
+            try:
+                result, ok, busy = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            kind, future = self.pending.popleft()
+            if kind == QUERY:
+                self.queries += 1
+            self.busy += busy
+            future.set_result((result, ok))
+        with self._lock:
+            self.alive = False
+            if self.pending:
+                logger.error(f"{self.process.name} ended with {len(self.pending)} answers pending")
+            while self.pending:
+                self.pending.popleft()[1].set_exception(
+                    ConnectionError(f"{self.process.name} ended"))
+
+    @property
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "pid": self.process.pid,
+            "alive": self.alive,
+            "queries": self.queries,
+            "busy_time": self.busy,
+            "utilization": self.busy / elapsed if elapsed else 0.0,
+            "outstanding": len(self.pending)}
+
+
+class ReplicaPool():
+    """Processes holding replicas of a graph, on which the queries are
+    evaluated in parallel, out of the GIL of the server.
+
+    The replicas start empty: see 'load', and 'replicate' to send them the
+    changes recorded by a JournalStore. Each query goes to the replica with
+    the fewest pending answers, after the changes sent before it.
+
+    Parameters
+    ----------
+    processes : int
+        number of replicas
+
+    compact : bool, optional
+        default to False, i.e. the replicas use rdflib's in-memory store,
+        otherwise compactstore.CompactStore
+
+    prepared_size : int, optional
+        default to DEFAULT_PREPARED_SIZE, parsed queries kept by each replica
+    """
+
+    def __init__(self, processes, compact=False, prepared_size=DEFAULT_PREPARED_SIZE):
+        # 'spawn': the replicas must not inherit the threads and locks of
+        # the server
+        context = multiprocessing.get_context("spawn")
+        self.replicas = [_Replica(context, i, compact, prepared_size) for i in range(processes)]
+        logger.info(f"{processes} replica processes started")
+
+    @property
+    def alive(self):
+        return [replica for replica in self.replicas if replica.alive]
+
+    def submit(self, sparql, format, prefixes=()):
+        """Sends a query to the least loaded replica, parsed with the
+        (tag, namespace) pairs of 'prefixes'.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            of the (result, ok) tuple
+
+        Raises
+        ------
+        ConnectionError
+            if no replica is running
+        """
+        alive = self.alive
+        if not alive:
+            raise ConnectionError("No replica process is running")
+        replica = min(alive, key=lambda replica: len(replica.pending))
+        future = Future()
+        replica.send((QUERY, sparql, format, tuple(prefixes)), future)
+        return future
+
+    def replicate(self, changes):
+        """Sends the changes to all the replicas, see JournalStore"""
+        for replica in self.alive:
+            try:
+                replica.send((CHANGES, changes))
+            except (ConnectionError, OSError) as e:
+                logger.error(e)
+
+    def load(self, path):
+        """Adds the snapshot in 'path' to all the replicas, and waits for
+        them, see snapshot.load"""
+        futures = []
+        for replica in self.alive:
+            future = Future()
+            replica.send((LOAD, path), future)
+            futures.append(future)
+        for future in futures:
+            report, ok = future.result()
+            if not ok:
+                raise ValueError(f"Replicas unable to load {path}")
+
+    def close(self):
+        for replica in self.alive:
+            try:
+                replica.send((STOP,))
+            except (ConnectionError, OSError):
+                pass
+        for replica in self.replicas:
+            replica.process.join(STOP_TIMEOUT)
+            if replica.process.is_alive():
+                replica.process.terminate()
+            replica.connection.close()
+
+    @property
+    def stats(self):
+        """Per replica: pid, alive, queries answered, busy_time (seconds
+        spent evaluating), utilization (busy_time over the time since it
+        started) and outstanding queries"""
+        return [replica.stats for replica in self.replicas]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  snapshot.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import json
+import os
+import struct
+import sys
+import time
+
+from array import array
+from itertools import accumulate
+from rdflib import URIRef, BNode, Literal
+from compactstore import CompactStore
+
+# A snapshot is MAGIC, the byte order of the arrays, then sections made of
+# a 4 bytes tag, the payload length (8 bytes, little endian) and the payload:
+#   NSPC  namespaces, JSON {prefix: namespace}
+#   TERM  term dictionary: number of terms (8 bytes), their kinds (1 byte
+#         each, see below), the lengths in characters of their values and
+#         extras (datatype or language) as an array of uint32, and all the
+#         values and extras as UTF-8 text
+#   TRPL  triples, array of uint32: subject, predicate and object ids
+#   ISPO  CompactStore indexes, instead of TRPL: keys (uint64) then thirds
+#   IPOS  (uint32) arrays of each index, as they are in memory
+#   IOSP
+MAGIC = b"MUSEPA\x00\x01"
+_SECTION = struct.Struct("<4sQ")
+
+URI = b"U"[0]
+BLANK = b"B"[0]
+PLAIN = b"L"[0]
+TYPED = b"D"[0]
+LANGUAGE = b"G"[0]
+
+_INDEXES = {b"ISPO": "spo", b"IPOS": "pos", b"IOSP": "osp"}
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_terms(terms):
+    kinds = bytearray(len(terms))
+    lengths = array("I")
+    parts = []
+    for i, term in enumerate(terms):
+        extra = ""
+        if isinstance(term, Literal):
+            if term.language:
+                kinds[i], extra = LANGUAGE, term.language
+            elif term.datatype:
+                kinds[i], extra = TYPED, term.datatype
+            else:
+                kinds[i] = PLAIN
+        elif isinstance(term, BNode):
+            kinds[i] = BLANK
+        elif isinstance(term, URIRef):
+            kinds[i] = URI
+        else:
+            raise TypeError(f"Unable to write {type(term)} terms")
+        parts.append(term)
+        parts.append(extra)
+        lengths.append(len(term))
+        lengths.append(len(extra))
+    text = "".join(parts).encode("utf-8", "surrogatepass")
+    return struct.pack("<Q", len(terms)) + bytes(kinds) + lengths.tobytes() + text
+
+
+def _decode_terms(payload, swap):
+    count, = struct.unpack_from("<Q", payload)
+    kinds = payload[8:8 + count]
+    lengths = array("I")
+    lengths.frombytes(payload[8 + count:8 + count + 8 * count])
+    if swap:
+        lengths.byteswap()
+    text = payload[8 + 9 * count:].decode("utf-8", "surrogatepass")
+    offsets = list(accumulate(lengths, initial=0))
+    datatypes = {}
+    terms = []
+    append = terms.append
+    for i, kind in enumerate(kinds):
+        value = text[offsets[2 * i]:offsets[2 * i + 1]]
+        if kind == URI:
+            append(URIRef(value))
+        elif kind == PLAIN:
+            append(Literal(value))
+        elif kind == TYPED:
+            extra = text[offsets[2 * i + 1]:offsets[2 * i + 2]]
+            datatype = datatypes.get(extra)
+            if datatype is None:
+                datatype = datatypes[extra] = URIRef(extra)
+            append(Literal(value, datatype=datatype))
+        elif kind == LANGUAGE:
+            append(Literal(value, lang=text[offsets[2 * i + 1]:offsets[2 * i + 2]]))
+        elif kind == BLANK:
+            append(BNode(value))
+        else:
+            raise ValueError(f"Unknown term kind {kind}")
+    return terms
+
+
+def _write_section(file, tag, *payloads):
+    file.write(_SECTION.pack(tag, sum(len(p) * getattr(p, "itemsize", 1) for p in payloads)))
+    for payload in payloads:
+        file.write(payload if isinstance(payload, bytes) else payload.tobytes())
+
+
+def dump(graph, path):
+    """Writes a binary snapshot of 'graph' to 'path'. The file is replaced
+    only once the snapshot is complete. The graph must not change
+    meanwhile: for a CompactStore, the pending changes are merged first.
+
+    Returns
+    -------
+    dict
+        triples, terms, bytes and seconds taken
+    """
+    started = time.monotonic()
+    store = graph.store
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC + sys.byteorder[0].encode())
+        namespaces = {prefix: str(namespace) for prefix, namespace in graph.namespaces()}
+        _write_section(file, b"NSPC", json.dumps(namespaces).encode())
+        if isinstance(store, CompactStore):
+            terms, indexes = store.state()
+            _write_section(file, b"TERM", _encode_terms(terms))
+            for tag, name in _INDEXES.items():
+                keys, thirds = indexes[name]
+                _write_section(file, tag, keys, thirds)
+            triples = len(indexes["spo"][0])
+        else:
+            ids, terms, triples = {}, [], array("I")
+
+            def id(term):
+                i = ids.get(term)
+                if i is None:
+                    i = ids[term] = len(terms)
+                    terms.append(term)
+                return i
+
+            for s, p, o in graph:
+                triples.extend((id(s), id(p), id(o)))
+            _write_section(file, b"TERM", _encode_terms(terms))
+            _write_section(file, b"TRPL", triples)
+            triples = len(triples) // 3
+        size = file.tell()
+    os.replace(temporary, path)
+    report = {"triples": triples, "terms": len(terms), "bytes": size,
+              "seconds": round(time.monotonic() - started, 3)}
+    logger.info(f"Snapshot written to {path}: {report}")
+    return report
+
+
+def load(graph, path):
+    """Adds the triples of the snapshot in 'path' to 'graph', and binds its
+    namespaces. An empty CompactStore takes the snapshot of a CompactStore
+    as it is.
+
+    Returns
+    -------
+    dict
+        triples, terms, bytes and seconds taken
+
+    Raises
+    ------
+    ValueError
+        if the file is not a snapshot
+    """
+    started = time.monotonic()
+    with open(path, "rb") as file:
+        header = file.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a MUSEPA snapshot")
+        swap = header[len(MAGIC):] != sys.byteorder[0].encode()
+        sections = {}
+        while True:
+            head = file.read(_SECTION.size)
+            if not head:
+                break
+            tag, length = _SECTION.unpack(head)
+            sections[tag] = file.read(length)
+        size = file.tell()
+
+    for prefix, namespace in json.loads(sections[b"NSPC"]).items():
+        graph.bind(prefix, URIRef(namespace), override=True)
+    terms = _decode_terms(sections[b"TERM"], swap)
+
+    if b"TRPL" in sections:
+        triples = array("I")
+        triples.frombytes(sections[b"TRPL"])
+        if swap:
+            triples.byteswap()
+    else:
+        indexes = {}
+        for tag, name in _INDEXES.items():
+            payload = sections[tag]
+            length = len(payload) // 12
+            keys, thirds = array("Q"), array("I")
+            keys.frombytes(payload[:8 * length])
+            thirds.frombytes(payload[8 * length:])
+            if swap:
+                keys.byteswap()
+                thirds.byteswap()
+            indexes[name] = (keys, thirds)
+        if isinstance(graph.store, CompactStore) and not len(graph.store):
+            graph.store.load_state(terms, indexes)
+            triples = None
+        else:
+            keys, thirds = indexes["spo"]
+            triples = array("I")
+            for key, o in zip(keys, thirds):
+                triples.extend((key >> 32, key & 0xFFFFFFFF, o))
+    if triples is not None:
+        it = iter(triples)
+        graph.addN((terms[s], terms[p], terms[o], graph) for s, p, o in zip(it, it, it))
+        count = len(triples) // 3
+    else:
+        count = len(graph.store)
+    report = {"triples": count, "terms": len(terms), "bytes": size,
+              "seconds": round(time.monotonic() - started, 3)}
+    logger.info(f"Snapshot {path} loaded: {report}")
+    return report
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  sqlitestore.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import sqlite3
+import threading
+
+from functools import lru_cache
+from rdflib import URIRef, BNode, Literal
+from rdflib.store import Store, VALID_STORE
+
+# Bytes of the database file mapped in memory: the pages are read by the
+# operating system when they are touched, and shared with its page cache
+DEFAULT_MMAP_SIZE = 1 << 30
+
+# Terms kept decoded in memory
+DEFAULT_TERM_CACHE = 1 << 16
+
+# Rows fetched at once by the triples iterators
+FETCH_SIZE = 1024
+
+URI = "U"
+BLANK = "B"
+LITERAL = "L"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    datatype TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    UNIQUE (kind, value, datatype, lang));
+CREATE TABLE IF NOT EXISTS triples (
+    s INTEGER NOT NULL,
+    p INTEGER NOT NULL,
+    o INTEGER NOT NULL,
+    PRIMARY KEY (s, p, o)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s);
+CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p);
+CREATE TABLE IF NOT EXISTS namespaces (
+    prefix TEXT PRIMARY KEY,
+    uri TEXT NOT NULL UNIQUE);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(term):
+    # (kind, value, datatype, lang) of a term
+    if isinstance(term, Literal):
+        return LITERAL, str(term), str(term.datatype or ""), term.language or ""
+    elif isinstance(term, BNode):
+        return BLANK, str(term), "", ""
+    elif isinstance(term, URIRef):
+        return URI, str(term), "", ""
+    raise TypeError(f"Unable to store {type(term)} terms")
+
+
+class SQLiteStore(Store):
+    """rdflib store kept in a SQLite database file, so that it survives
+    restarts: opening it does not read the triples, whose pages are loaded
+    (memory-mapped) only when the queries touch them.
+
+    Terms are kept once in the 'terms' table, and the triples as ids in the
+    'triples' table, indexed as SPO, POS and OSP. The changes are written
+    to the file by commit, and undone by rollback.
+
+    Parameters
+    ----------
+    configuration : str, optional
+        path of the database file, created if it does not exist. If given,
+        the store is opened
+
+    identifier : rdflib.term.Identifier, optional
+        identifier of the store
+
+    mmap_size : int, optional
+        defaults to DEFAULT_MMAP_SIZE, bytes of the file mapped in memory
+
+    term_cache : int, optional
+        defaults to DEFAULT_TERM_CACHE, terms kept decoded in memory
+    """
+    context_aware = False
+    formula_aware = False
+    transaction_aware = True
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None,
+                 mmap_size=DEFAULT_MMAP_SIZE, term_cache=DEFAULT_TERM_CACHE):
+        self.identifier = identifier
+        self.mmap_size = mmap_size
+        self._connection = None
+        # ids of the terms, that never change once given
+        self._ids = {}
+        self._ids_size = term_cache
+        self._term = lru_cache(maxsize=term_cache)(self._load_term)
+        self._write_lock = threading.Lock()
+        super().__init__(configuration)
+
+    def open(self, configuration, create=True):
+        self._connection = sqlite3.connect(configuration, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        self._connection.executescript(_SCHEMA)
+        logger.info(f"SQLite store opened at {configuration}")
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=False):
+        if self._connection is None:
+            return
+        if commit_pending_transaction:
+            self._connection.commit()
+        else:
+            self._connection.rollback()
+        self._connection.close()
+        self._connection = None
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+        # ids given in the transaction are lost
+        self._ids.clear()
+        self._term.cache_clear()
+
+    # ---------------------------------------------------------- terms ---
+    def _load_term(self, id):
+        kind, value, datatype, lang = self._connection.execute(
+            "SELECT kind, value, datatype, lang FROM terms WHERE id = ?", (id,)).fetchone()
+        if kind == URI:
+            return URIRef(value)
+        elif kind == BLANK:
+            return BNode(value)
+        return Literal(value, datatype=datatype or None, lang=lang or None)
+
+    def _id(self, term, create=False):
+        id = self._ids.get(term)
+        if id is not None:
+            return id
+        columns = _columns(term)
+        row = self._connection.execute(
+            "SELECT id FROM terms WHERE kind = ? AND value = ? AND datatype = ? AND lang = ?",
+            columns).fetchone()
+        if row is not None:
+            id = row[0]
+        elif create:
+            id = self._connection.execute(
+                "INSERT INTO terms (kind, value, datatype, lang) VALUES (?, ?, ?, ?)",
+                columns).lastrowid
+        else:
+            return None
+        if len(self._ids) >= self._ids_size:
+            self._ids.clear()
+        self._ids[term] = id
+        return id
+
+    def _where(self, pattern):
+        # WHERE clause and parameters of a pattern. None if a term is not
+        # in the store, so that nothing can match
+        conditions, parameters = [], []
+        for column, term in zip("spo", pattern):
+            if term is not None:
+                id = self._id(term)
+                if id is None:
+                    return None
+                conditions.append(f"{column} = ?")
+                parameters.append(id)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+    # --------------------------------------------------------- triples ---
+    def add(self, triple, context=None, quoted=False):
+        with self._write_lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO triples (s, p, o) VALUES (?, ?, ?)",
+                tuple(self._id(term, create=True) for term in triple))
+
+    def addN(self, quads):
+        with self._write_lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO triples (s, p, o) VALUES (?, ?, ?)",
+                (tuple(self._id(term, create=True) for term in (s, p, o)) for s, p, o, _ in quads))
+
+    def remove(self, triple, context=None):
+        where = self._where(triple)
+        if where is None:
+            return
+        with self._write_lock:
+            self._connection.execute("DELETE FROM triples" + where[0], where[1])
+
+    def triples(self, triple_pattern, context=None):
+        where = self._where(triple_pattern)
+        if where is None:
+            return
+        cursor = self._connection.cursor()
+        try:
+            cursor.execute("SELECT s, p, o FROM triples" + where[0], where[1])
+            term = self._term
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    return
+                for s, p, o in rows:
+                    yield (term(s), term(p), term(o)), iter(())
+        finally:
+            cursor.close()
+
+    def __len__(self, context=None):
+        return self._connection.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    # ------------------------------------------------------ namespaces ---
+    def bind(self, prefix, namespace, override=True):
+        with self._write_lock:
+            if override:
+                self._connection.execute("DELETE FROM namespaces WHERE prefix = ? OR uri = ?",
+                                         (prefix, str(namespace)))
+            elif self._connection.execute("SELECT 1 FROM namespaces WHERE prefix = ? OR uri = ?",
+                                          (prefix, str(namespace))).fetchone():
+                return
+            self._connection.execute("INSERT INTO namespaces (prefix, uri) VALUES (?, ?)",
+                                     (prefix, str(namespace)))
+
+    def namespace(self, prefix):
+        row = self._connection.execute(
+            "SELECT uri FROM namespaces WHERE prefix = ?", (prefix,)).fetchone()
+        return URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self._connection.execute(
+            "SELECT prefix FROM namespaces WHERE uri = ?", (str(namespace),)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for prefix, uri in self._connection.execute("SELECT prefix, uri FROM namespaces").fetchall():
+            yield prefix, URIRef(uri)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  subscription.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import logging
+import json
+
+from collections import Counter, defaultdict
+from rdflib import URIRef, RDF
+from rdflib.paths import AlternativePath, InvPath, MulPath, SequencePath
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.algebra import translateUpdate
+from rdflib.plugins.sparql.parser import parseUpdate
+from rdflib.plugins.sparql.parserutils import CompValue
+from endpoint import parse_lock
+
+SPARQL = "sparql"
+
+# Wildcard component of a pattern: it matches every term
+ANY = None
+
+# Update operations that do not change any triple
+NEUTRAL_OPERATIONS = ["Create"]
+
+logger = logging.getLogger(__name__)
+
+
+def _path_predicates(path):
+    """IRIs of a property path, or None if it can match any predicate"""
+    if isinstance(path, URIRef):
+        return [path]
+    elif isinstance(path, (SequencePath, AlternativePath)):
+        predicates = [_path_predicates(arg) for arg in path.args]
+        if None in predicates:
+            return None
+        return [p for arg in predicates for p in arg]
+    elif isinstance(path, MulPath):
+        return _path_predicates(path.path)
+    elif isinstance(path, InvPath):
+        return _path_predicates(path.arg)
+    # variables, negated property sets
+    return None
+
+
+def _patterns(graph, triple):
+    """Builds the (graph, predicate, type) patterns of a triple. The graph is
+    kept only if it is an IRI, the type only if the predicate is rdf:type."""
+    _, predicate, obj = triple
+    if isinstance(predicate, URIRef):
+        if predicate == RDF.type and isinstance(obj, URIRef):
+            return [(graph, predicate, obj)]
+        return [(graph, predicate, ANY)]
+    predicates = _path_predicates(predicate)
+    if predicates is None:
+        return [(graph, ANY, ANY)]
+    return [(graph, p, ANY) for p in predicates]
+
+
+def _triples(triples):
+    # parse tree nodes keep the triples as flat lists
+    for triple in triples:
+        for i in range(0, len(triple) - 2, 3):
+            yield triple[i:i + 3]
+
+
+# CompValue.get does not return None on missing keys: dict.get is used
+def _walk(node, graph, patterns):
+    """Collects the patterns of all the triples in the algebra 'node'"""
+    if isinstance(node, CompValue):
+        if node.name == "Graph":
+            term = dict.get(node, "term")
+            graph = term if isinstance(term, URIRef) else ANY
+        elif node.name == "ServiceGraphPattern":
+            # the remote results can change regardless of the local updates
+            patterns.add((ANY, ANY, ANY))
+        for key, value in node.items():
+            if key == "triples" and isinstance(value, list):
+                for triple in _triples(value):
+                    patterns.update(_patterns(graph, triple))
+            elif not key.startswith("_"):
+                _walk(value, graph, patterns)
+    elif isinstance(node, (list, tuple)):
+        for item in node:
+            _walk(item, graph, patterns)
+
+
+def query_patterns(sparql, initNs=None):
+    """Extracts the triple patterns read by a SPARQL query.
+
+    Parameters
+    ----------
+    sparql : str
+        the query
+
+    initNs : dict, optional
+        prefixes that are not declared in the query
+
+    Returns
+    -------
+    set of tuples (graph, predicate, type)
+        one for each triple pattern; ANY stands for a variable, or for
+        anything that cannot be told in advance. A query that cannot be
+        parsed is summarized as {(ANY, ANY, ANY)}
+    """
+    try:
+        with parse_lock:
+            query = prepareQuery(sparql, initNs=initNs if initNs else {})
+    except Exception as e:
+        logger.warning(f"Unable to extract patterns from query: {e}")
+        return {(ANY, ANY, ANY)}
+    patterns = set()
+    _walk(query.algebra, ANY, patterns)
+    if dict.get(query.algebra, "datasetClause"):
+        # FROM and FROM NAMED change the graphs the patterns refer to
+        patterns = {(ANY, p, t) for (_, p, t) in patterns}
+    return patterns
+
+
+def update_patterns(content, format=SPARQL, initNs=None):
+    """Extracts the patterns of the triples touched by an update.
+
+    Parameters
+    ----------
+    content : str
+        the update
+
+    format : str, optional
+        defaults to 'sparql': other formats (ttl, n3...) are not analyzed
+
+    initNs : dict, optional
+        prefixes that are not declared in the update
+
+    Returns
+    -------
+    set of tuples (graph, predicate, type), or None
+        see query_patterns. None means that the update may have touched
+        any triple
+    """
+    if format.lower() != SPARQL:
+        return None
+    try:
+        with parse_lock:
+            update = translateUpdate(parseUpdate(content), initNs=initNs if initNs else {})
+    except Exception as e:
+        logger.warning(f"Unable to extract patterns from update: {e}")
+        return None
+    patterns = set()
+    for operation in update.algebra:
+        if operation.name in NEUTRAL_OPERATIONS:
+            continue
+        elif operation.name == "Modify":
+            graph = dict.get(operation, "withClause")
+            graph = graph if isinstance(graph, URIRef) else ANY
+            clauses = [dict.get(operation, "delete"), dict.get(operation, "insert")]
+        elif operation.name in ["InsertData", "DeleteData", "DeleteWhere"]:
+            graph = ANY
+            clauses = [operation]
+        else:
+            # LOAD, CLEAR, DROP, ADD, MOVE, COPY
+            return None
+        for clause in clauses:
+            if clause is None:
+                continue
+            for triple in _triples(dict.get(clause, "triples") or []):
+                patterns.update(_patterns(graph, triple))
+            for quad_graph, triples in (dict.get(clause, "quads") or {}).items():
+                quad_graph = quad_graph if isinstance(quad_graph, URIRef) else ANY
+                for triple in _triples(triples):
+                    patterns.update(_patterns(quad_graph, triple))
+    return patterns
+
+
+def _compatible(a, b):
+    return all(x is ANY or y is ANY or x == y for x, y in zip(a, b))
+
+
+class SubscriptionIndex():
+    """Index of the triple patterns read by the subscriptions, used to find
+    which subscriptions may be affected by an update, instead of
+    re-evaluating all of them."""
+    def __init__(self):
+        self._patterns = {}
+        self._by_predicate = defaultdict(set)
+        self._any_predicate = set()
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __contains__(self, alias):
+        return alias in self._patterns
+
+    def add(self, alias, sparql, initNs=None):
+        """Indexes the subscription 'alias', whose query is 'sparql'"""
+        self.remove(alias)
+        patterns = query_patterns(sparql, initNs=initNs)
+        self._patterns[alias] = patterns
+        for (_, predicate, _) in patterns:
+            if predicate is ANY:
+                self._any_predicate.add(alias)
+            else:
+                self._by_predicate[predicate].add(alias)
+        logger.debug(f"Subscription {alias} patterns: {patterns}")
+
+    def remove(self, alias):
+        patterns = self._patterns.pop(alias, set())
+        self._any_predicate.discard(alias)
+        for (_, predicate, _) in patterns:
+            if predicate is not ANY:
+                self._by_predicate[predicate].discard(alias)
+                if not self._by_predicate[predicate]:
+                    del self._by_predicate[predicate]
+
+    def affected(self, content, format=SPARQL, initNs=None):
+        """Finds the subscriptions that may be affected by an update.
+
+        Parameters
+        ----------
+        content : str
+            the update
+
+        format : str, optional
+            defaults to 'sparql', see update_patterns
+
+        initNs : dict, optional
+            prefixes that are not declared in the update
+
+        Returns
+        -------
+        set
+            aliases of the subscriptions to be re-evaluated
+        """
+        update = update_patterns(content, format=format, initNs=initNs)
+        if update is None:
+            return set(self._patterns)
+        result = set()
+        for pattern in update:
+            if pattern[1] is ANY:
+                candidates = self._patterns.keys()
+            else:
+                candidates = self._by_predicate.get(pattern[1], set()) | self._any_predicate
+            for alias in candidates:
+                if alias not in result and any(
+                        _compatible(pattern, p) for p in self._patterns[alias]):
+                    result.add(alias)
+        return result
+
+
+def result_bindings(result):
+    """Multiset of the bindings of a SPARQL JSON result.
+
+    Parameters
+    ----------
+    result : bytes or str
+        the SPARQL JSON result
+
+    Returns
+    -------
+    collections.Counter, or None
+        counts of the bindings, each one as sorted JSON text. None if the
+        result has no bindings to compare (e.g. ASK or not JSON)
+    """
+    try:
+        bindings = json.loads(result)["results"]["bindings"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return Counter(json.dumps(b, sort_keys=True) for b in bindings)
+
+
+def bindings_delta(old, new):
+    """Bindings added and removed between two results.
+
+    Parameters
+    ----------
+    old, new : collections.Counter
+        as returned by result_bindings
+
+    Returns
+    -------
+    collections.Counter
+        positive counts for the added bindings, negative for the removed
+        ones. Deltas of consecutive results can be summed up.
+    """
+    delta = Counter(new)
+    delta.subtract(old)
+    return Counter({b: count for b, count in delta.items() if count})
+
+
+def delta_bindings(delta):
+    """Splits a delta (see bindings_delta) in two lists of dictionaries: the
+    added bindings and the removed ones"""
+    added, removed = [], []
+    for binding, count in delta.items():
+        (added if count > 0 else removed).extend([json.loads(binding)] * abs(count))
+    return added, removed
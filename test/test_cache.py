@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_cache.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+from cache import ResultCache
+
+QUERY = "SELECT * WHERE {{ ?s ?p {} }}"
+
+
+class Test4ResultCache:
+    def test_hit(self):
+        cache = ResultCache()
+        assert cache.get(QUERY.format(1), 0) is None
+        cache.put(QUERY.format(1), 0, b"result")
+        assert cache.get("SELECT *\nWHERE { ?s ?p 1 }  # same", 0) == b"result"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_version(self):
+        cache = ResultCache()
+        cache.put(QUERY.format(1), 0, b"old")
+        assert cache.get(QUERY.format(1), 1) is None
+        assert cache.invalidations == 1
+        # computed before the last update
+        cache.put(QUERY.format(1), 0, b"old")
+        assert cache.get(QUERY.format(1), 1) is None
+
+    def test_eviction(self):
+        cache = ResultCache(size=2)
+        for i in range(2):
+            cache.put(QUERY.format(i), 0, str(i).encode())
+        cache.get(QUERY.format(0), 0)
+        cache.put(QUERY.format(2), 0, b"2")
+        assert cache.evictions == 1
+        assert cache.get(QUERY.format(1), 0) is None
+        assert cache.get(QUERY.format(0), 0) == b"0"
+
+    def test_disabled(self):
+        cache = ResultCache(size=0)
+        cache.put(QUERY.format(1), 0, b"result")
+        assert cache.get(QUERY.format(1), 0) is None
+        assert len(cache) == 0
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_canonical.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+from canonical import canonical_alias, normalize
+
+PREFIX = "PREFIX : <http://test.org/>\n"
+
+
+class Test4Canonical:
+    def test_normalize(self):
+        assert normalize("SELECT  *\n# comment\nWHERE { ?a ?b '#  x' }") == "SELECT * WHERE { ?a ?b '#  x' }"
+        assert normalize("ASK { <http://test.org/#a> ?b ?c }") == "ASK { <http://test.org/#a> ?b ?c }"
+
+    def test_layout(self):
+        assert canonical_alias("SELECT * WHERE {?a ?b ?c}") == \
+            canonical_alias("select *\nwhere { ?a ?b ?c . } # all")
+
+    def test_prefixes(self):
+        assert canonical_alias(PREFIX + "SELECT ?s WHERE { ?s a :Sensor ; :value ?v }") == \
+            canonical_alias("SELECT ?s WHERE { ?s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> "
+                            "<http://test.org/Sensor> . ?s <http://test.org/value> ?w }")
+
+    def test_projected_variables(self):
+        assert canonical_alias(PREFIX + "SELECT ?s WHERE { ?s :value ?v }") != \
+            canonical_alias(PREFIX + "SELECT ?v WHERE { ?v :value ?s }")
+        assert canonical_alias(PREFIX + "SELECT ?s ?v WHERE { ?s :value ?v }") != \
+            canonical_alias(PREFIX + "SELECT ?s WHERE { ?s :value ?v }")
+
+    def test_blank_nodes(self):
+        query = PREFIX + "SELECT ?s WHERE { ?s :value [ :unit ?u ] }"
+        assert canonical_alias(query) == canonical_alias(query + " # same")
+
+    def test_variables(self):
+        assert canonical_alias(PREFIX + "SELECT ?s WHERE { ?s :value ?v . ?v :unit ?u }") == \
+            canonical_alias(PREFIX + "SELECT ?s WHERE { ?s :value ?w . ?w :unit ?x }")
+
+    def test_comparisons(self):
+        # '<3&&?z>' is not an IRI: ?z is renamed, and it is not ?w
+        z = canonical_alias(PREFIX + "SELECT ?x WHERE{?x :p ?y;:q ?z FILTER(?y<3&&?z>5)}")
+        w = canonical_alias(PREFIX + "SELECT ?x WHERE{?x :p ?y;:q ?w FILTER(?y<3&&?z>5)}")
+        assert z != w
+        assert z == canonical_alias(PREFIX + "SELECT ?x WHERE { ?x :p ?a ; :q ?b FILTER (?a < 3 && ?b > 5) }")
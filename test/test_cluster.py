@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_cluster.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+import asyncio
+import json
+import multiprocessing
+import socket
+import musepa as front
+
+from aiocoap import Context, Message, GET, CONTENT, CHANGED, CREATED, DELETED, NOT_FOUND
+from multiprocessing import Pipe
+from threading import Thread
+from time import sleep
+from cCoap import coapCall
+from cluster import ClusterLink, cluster, relay, _work, UPDATED, SUBSCRIBED, ATTACHED, DETACHED
+from localsparql import LocalSPARQLServer
+
+MUSEPA_BASE_URL = "coap://127.0.0.1/{}"
+
+QUERY = "SELECT ?o WHERE { <http://test.org/s> <http://test.org/p> ?o }"
+
+
+@pytest.fixture(scope="module")
+def hub():
+    # a MUSEPA process of a cluster, whose other end is the test
+    connection, child = Pipe()
+    front.cluster_link = ClusterLink(child)
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=front.musepa, kwargs={"endpoint": "rdflib", "event_loop": loop})
+    thread.daemon = True
+    thread.start()
+    sleep(1)
+    yield connection
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(front.shutdown(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+    sleep(1)
+    front.cluster_link = None
+
+
+def received(connection):
+    assert connection.poll(5)
+    return connection.recv()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as probe:
+        probe.bind(("::", 0))
+        return probe.getsockname()[1]
+
+
+async def observed(address):
+    # observes 'address' and stops, from a client context to reuse
+    context = await Context.create_client_context()
+    request = context.request(Message(code=GET, uri=address, observe=0))
+    assert (await request.response).code == CONTENT
+    request.observation.cancel()
+    return context
+
+
+async def fetched(address, context):
+    return (await context.request(Message(code=GET, uri=address)).response).code
+
+
+async def unobserved(address, context):
+    response = await context.request(Message(code=GET, uri=address, observe=1)).response
+    await context.shutdown()
+    return response.code
+
+
+class Test4Cluster:
+    def test_shared_endpoint(self):
+        with pytest.raises(ValueError):
+            cluster(2, endpoint="rdflib")
+
+    def test_relay(self):
+        ends = [Pipe() for _ in range(3)]
+        thread = Thread(target=relay, args=([end for end, _ in ends],), daemon=True)
+        thread.start()
+        ends[0][1].send((UPDATED, None))
+        assert ends[1][1].recv() == (UPDATED, None)
+        assert ends[2][1].recv() == (UPDATED, None)
+        assert not ends[0][1].poll(0.1)
+        for _, end in ends:
+            end.close()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_announcements(self, hub):
+        response = coapCall(MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST", payload=QUERY)
+        assert response.code == CREATED
+        assert received(hub) == (SUBSCRIBED, response.payload.decode(), QUERY)
+
+        update = "INSERT DATA { <http://test.org/s> <http://test.org/p> 1 }"
+        assert coapCall(MUSEPA_BASE_URL.format("sparql/update"), verb="POST", payload=update).code == CHANGED
+        assert received(hub) == (UPDATED, [(update, "sparql")])
+
+    def test_mirrors(self, hub):
+        hub.send((SUBSCRIBED, "mirrored", QUERY))
+        hub.send((SUBSCRIBED, "dropped", QUERY))
+        sleep(0.2)
+        response = coapCall(MUSEPA_BASE_URL.format("mirrored"))
+        assert response.code == CONTENT
+        assert json.loads(response.payload)["results"]["bindings"][0]["o"]["value"] == "1"
+
+        # not observed: evaluated again only when asked
+        version = front.store_version
+        hub.send((UPDATED, None))
+        sleep(0.2)
+        assert front.store_version == version + 1
+        assert front.subscription_store["mirrored"][front.RESOURCE].encoded is None
+        # skipped, not merged into a pending re-evaluation
+        assert front.subscription_store["mirrored"][front.RESOURCE].saved == 0
+        assert coapCall(MUSEPA_BASE_URL.format("mirrored")).code == CONTENT
+
+        # its last client in another process left
+        hub.send((DETACHED, "dropped", 0))
+        sleep(0.2)
+        assert coapCall(MUSEPA_BASE_URL.format("dropped")).code == NOT_FOUND
+
+    def test_held_elsewhere(self, hub):
+        while hub.poll(0.2):
+            hub.recv()
+        hub.send((ATTACHED, "shared", QUERY, 0))
+        sleep(0.2)
+        address = MUSEPA_BASE_URL.format("shared")
+        loop = asyncio.new_event_loop()
+        try:
+            context = loop.run_until_complete(observed(address))
+            assert received(hub)[:3] == (ATTACHED, "shared", QUERY)
+            # the other process still has clients: the subscription stays
+            assert loop.run_until_complete(unobserved(address, context)) == CHANGED
+            assert received(hub)[:2] == (DETACHED, "shared")
+            assert "shared" in front.subscription_store
+        finally:
+            loop.close()
+
+        hub.send((DETACHED, "shared", 0))
+        sleep(0.2)
+        assert coapCall(address).code == NOT_FOUND
+
+
+@pytest.fixture
+def processes():
+    # two MUSEPA processes of a cluster over the same endpoint, on two ports
+    # so that the test chooses the process to talk to
+    context = multiprocessing.get_context("spawn")
+    with LocalSPARQLServer() as standin:
+        connections, workers, ports = [], [], []
+        for _ in range(2):
+            connection, child = context.Pipe()
+            port = free_port()
+            worker = context.Process(target=_work, args=(child, {
+                "a4": "127.0.0.1", "a6": "::", "port": port,
+                "endpoint": "fuseki", "params": standin.fuseki_uri}), daemon=True)
+            worker.start()
+            child.close()
+            connections.append(connection)
+            workers.append(worker)
+            ports.append(port)
+        thread = Thread(target=relay, args=(connections,), daemon=True)
+        thread.start()
+        sleep(3)
+        yield [f"coap://127.0.0.1:{port}/{{}}" for port in ports]
+        for worker in workers:
+            worker.terminate()
+            worker.join(5)
+        for connection in connections:
+            connection.close()
+        thread.join(5)
+
+
+class Test4ClusterProcesses:
+    def test_detach(self, processes):
+        first, second = processes
+        response = coapCall(first.format("sparql/subscription"), verb="POST", payload=QUERY)
+        assert response.code == CREATED
+        alias = response.payload.decode()
+        sleep(0.5)
+
+        loop = asyncio.new_event_loop()
+        try:
+            contexts = [loop.run_until_complete(observed(base.format(alias))) for base in processes]
+            sleep(0.5)
+            # the second process still has a client
+            assert loop.run_until_complete(unobserved(first.format(alias), contexts[0])) == CHANGED
+            sleep(0.5)
+            assert loop.run_until_complete(fetched(second.format(alias), contexts[1])) == CONTENT
+
+            # ... that leaves too, in the end
+            assert loop.run_until_complete(unobserved(second.format(alias), contexts[1])) == DELETED
+        finally:
+            loop.close()
+        sleep(0.5)
+        assert coapCall(first.format(alias)).code == NOT_FOUND
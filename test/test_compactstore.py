@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_compactstore.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import random
+import pytest
+
+from rdflib import Graph, URIRef, Literal
+from compactstore import CompactStore
+from endpoint import get_endpoint
+
+EX = "http://ex.org/"
+
+QUERIES = [
+    "SELECT ?a ?b WHERE { ?a <http://ex.org/p1> ?x . ?x <http://ex.org/p2> ?b . ?b <http://ex.org/p3> 5 }",
+    "SELECT ?a WHERE { ?a ?p ?a }",
+    "SELECT ?a ?c WHERE { ?a <http://ex.org/p0> ?b OPTIONAL { ?b <http://ex.org/p4> ?c } FILTER(?a != ?b) }",
+    "SELECT (COUNT(*) AS ?n) WHERE { ?a ?p ?o . ?o ?q ?z }",
+    "SELECT ?a WHERE { ?a <http://ex.org/p0>/<http://ex.org/p1> ?b }",
+    "SELECT ?x WHERE { VALUES ?x { <http://ex.org/5> <http://ex.org/6> } ?x ?p ?o }",
+    "SELECT * WHERE { ?a <http://ex.org/nothing> ?b }",
+    "SELECT ?a WHERE { ?a <http://ex.org/p1> [ <http://ex.org/p2> ?b ] }",
+]
+
+
+def term(i):
+    return URIRef(f"{EX}{i}")
+
+
+@pytest.fixture(scope="module")
+def graphs():
+    random.seed(1)
+    triples = sorted({
+        (term(random.randrange(100)), term(f"p{random.randrange(5)}"),
+         random.choice([term(random.randrange(100)), Literal(random.randrange(20))]))
+        for _ in range(3000)})
+    memory, compact = Graph(), Graph(store=CompactStore(delta_size=50))
+    for graph in (memory, compact):
+        for triple in triples:
+            graph.add(triple)
+    for triple in random.sample(triples, 500):
+        memory.remove(triple)
+        compact.remove(triple)
+    return memory, compact
+
+
+class Test4CompactStore:
+    def test_triples(self, graphs):
+        memory, compact = graphs
+        assert len(memory) == len(compact)
+        assert set(memory) == set(compact)
+        for pattern in [
+                (term(5), None, None), (None, term("p1"), None), (None, None, Literal(3)),
+                (term(5), term("p1"), None), (None, term("p2"), term(7)), (term(5), None, term(7))]:
+            assert set(memory.triples(pattern)) == set(compact.triples(pattern))
+
+    def test_queries(self, graphs):
+        memory, compact = graphs
+        for query in QUERIES:
+            assert sorted(map(tuple, memory.query(query))) == sorted(map(tuple, compact.query(query)))
+        assert compact.query("ASK { [] <http://ex.org/p1> [] }").askAnswer
+
+    def test_delta(self):
+        store = CompactStore(delta_size=4)
+        graph = Graph(store=store)
+        for i in range(10):
+            graph.add((term(i), term("p"), Literal(i)))
+        # merged in the sorted arrays, but the last changes
+        assert len(store._spo) + len(store._added) == 10
+        graph.remove((term(3), None, None))
+        graph.add((term(3), term("p"), Literal(3)))
+        graph.remove((None, term("p"), Literal(5)))
+        store.merge()
+        assert len(graph) == 9 and not store._added and not store._removed
+        assert (term(5), term("p"), Literal(5)) not in graph
+        assert list(store._spo.keys) == sorted(store._spo.keys)
+
+    def test_endpoint(self):
+        endpoint = get_endpoint("compact")
+        assert isinstance(endpoint.graph.store, CompactStore)
+        assert endpoint.update("INSERT DATA { <http://ex.org/a> <http://ex.org/b> 1 }")[1]
+        result, code = endpoint.query("SELECT ?o WHERE { <http://ex.org/a> ?p ?o }")
+        assert code and b'"1"' in result
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_encoding.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import json
+import pytest
+
+from encoding import cbor_dumps, encode_cbor, encode_csv, encode_tsv
+from encoding import EncodedResult, JSON, CBOR, CSV
+from prefix import Prefixes
+
+RESULT = {
+    "head": {"vars": ["s", "v", "l"]},
+    "results": {"bindings": [
+        {"s": {"type": "uri", "value": "http://test.org/a"},
+         "v": {"type": "literal", "value": "3", "datatype": "http://www.w3.org/2001/XMLSchema#integer"},
+         "l": {"type": "literal", "value": "a, \"b\"", "xml:lang": "en"}},
+        {"s": {"type": "bnode", "value": "b0"},
+         "v": {"type": "literal", "value": "1.5", "datatype": "http://www.w3.org/2001/XMLSchema#decimal"}}]}}
+
+
+class Test4Encoding:
+    def test_cbor_dumps(self):
+        # examples of RFC 8949, appendix A
+        assert cbor_dumps(0) == bytes.fromhex("00")
+        assert cbor_dumps(24) == bytes.fromhex("1818")
+        assert cbor_dumps(1000000) == bytes.fromhex("1a000f4240")
+        assert cbor_dumps(-1000) == bytes.fromhex("3903e7")
+        assert cbor_dumps(1.1) == bytes.fromhex("fb3ff199999999999a")
+        assert cbor_dumps([True, False, None]) == bytes.fromhex("83f5f4f6")
+        assert cbor_dumps({"a": 1, "b": [2, 3]}) == bytes.fromhex("a26161016162820203")
+        assert cbor_dumps("ü") == bytes.fromhex("62c3bc")
+
+    def test_encode_cbor(self):
+        assert encode_cbor(RESULT) == cbor_dumps({
+            "vars": ["s", "v", "l"],
+            "iris": ["http://test.org/a", "http://www.w3.org/2001/XMLSchema#decimal"],
+            "bindings": [[0, 3, ["a, \"b\"", "en"]], [["b0"], ["1.5", 1], None]]})
+        assert encode_cbor({"head": {}, "boolean": True}) == cbor_dumps({"boolean": True})
+
+    def test_encode_csv(self):
+        assert encode_csv(RESULT) == b's,v,l\r\nhttp://test.org/a,3,"a, ""b"""\r\n_:b0,1.5,\r\n'
+
+    def test_encode_tsv(self):
+        assert encode_tsv(RESULT, compact=lambda iri: iri.replace("http://test.org/", "t:")) == (
+            '?s\t?v\t?l\n'
+            't:a\t"3"^^<http://www.w3.org/2001/XMLSchema#integer>\t"a, \\"b\\""@en\n'
+            '_:b0\t"1.5"^^<http://www.w3.org/2001/XMLSchema#decimal>\t\n').encode()
+
+    def test_encoded_result(self):
+        prefixes = Prefixes(silent=True)
+        prefixes.addPrefix("t", "http://test.org/")
+        result = EncodedResult(json.dumps(RESULT).encode(), prefixes)
+        payload, tag = result.get(JSON)
+        assert json.loads(payload)["results"]["bindings"][0]["s"]["value"] == "t:a"
+        # encoded once
+        assert result.get(CBOR) is result.get(CBOR)
+        assert result.get(CSV)[0].startswith(b"s,v,l\r\nt:a,")
+        with pytest.raises(ValueError):
+            result.get(0)
+
+    def test_not_a_table(self):
+        # the JSON-LD of a CONSTRUCT query
+        construct = [{"@id": "http://test.org/a", "http://test.org/b": [{"@value": 1}]}]
+        for encoder in (encode_cbor, encode_csv, encode_tsv):
+            with pytest.raises(ValueError):
+                encoder(construct)
+        result = EncodedResult(json.dumps(construct).encode(), Prefixes(silent=True))
+        assert json.loads(result.get(JSON)[0]) == construct
+        with pytest.raises(ValueError):
+            result.get(CBOR)
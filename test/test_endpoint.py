@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_endpoint.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+import json
+import inspect
+import requests
+import socket
+import asyncio
+import threading
+import time
+
+from endpoint import RDFEndpoint, RDFLibEndpoint, HTTPEndpoint, Blazegraph, Fuseki, get_endpoint
+from endpoint import ENDPOINT_OPTIONS, BLAZEGRAPH, FUSEKI, ReadWriteLock
+from localsparql import LocalSPARQLServer
+
+PREFIXES = {"t": "http://test.org/"}
+
+
+class Test4RDFLibEndpoint:
+    def test_bound_prefixes(self):
+        endpoint = RDFLibEndpoint()
+        endpoint.bind_prefixes(PREFIXES)
+        assert endpoint.update("INSERT DATA { t:a t:b t:c }")[1]
+        result, code = endpoint.query("SELECT ?s WHERE { ?s t:b t:c }")
+        assert code
+        assert json.loads(result)["results"]["bindings"] == [{"s": {"type": "uri", "value": "http://test.org/a"}}]
+
+    def test_prepared(self):
+        endpoint = RDFLibEndpoint(prepared_size=1)
+        endpoint.bind_prefixes(PREFIXES)
+        for query in ["SELECT * WHERE { ?s t:b ?o }"] * 3 + ["ASK { ?s ?p ?o }"]:
+            assert endpoint.query(query)[1]
+        assert (endpoint.stats["prepared_hits"], endpoint.stats["prepared_misses"]) == (2, 2)
+        # the first query was evicted
+        assert endpoint.query("SELECT * WHERE { ?s t:b ?o }")[1]
+        assert endpoint.stats["prepared_misses"] == 3
+
+    def test_undeclared_prefixes(self):
+        endpoint = RDFLibEndpoint()
+        endpoint.bind_prefixes(PREFIXES)
+        assert endpoint.update("@prefix u: <http://upload.org/>. u:a u:b u:c.", "ttl")[1]
+        # the prefixes of the uploaded data are not given to the parser
+        assert not endpoint.query("SELECT ?s WHERE { ?s u:b u:c }")[1]
+        assert not endpoint.update("INSERT DATA { u:d u:e u:f }")[1]
+        assert endpoint.query("PREFIX u: <http://upload.org/> SELECT ?s WHERE { ?s u:b u:c }")[1]
+
+    def test_prepared_prefixes(self):
+        endpoint = RDFLibEndpoint()
+        endpoint.bind_prefixes(PREFIXES)
+        assert endpoint.update("INSERT DATA { t:a t:b t:c }")[1]
+        assert json.loads(endpoint.query("ASK { t:a t:b t:c }")[0])["boolean"]
+        # the same text, parsed again with the new prefixes
+        endpoint.bind_prefixes({"t": "http://other.org/"})
+        assert not json.loads(endpoint.query("ASK { t:a t:b t:c }")[0])["boolean"]
+        assert endpoint.stats["prepared_misses"] == 2
+
+    def test_update_many(self):
+        endpoint = RDFLibEndpoint()
+        endpoint.bind_prefixes(PREFIXES)
+        assert endpoint.update_many([
+            ("INSERT DATA { t:a t:b 1 }", "sparql"),
+            ("@prefix t: <http://test.org/>. t:c t:d 2.", "ttl")])[1]
+        assert len(endpoint.graph) == 2
+        # the second update fails: the first one is undone
+        assert not endpoint.update_many([
+            ("DELETE WHERE { ?s ?p ?o }", "sparql"),
+            ("INSERT DATA { t:e t:f", "sparql")])[1]
+        assert len(endpoint.graph) == 2
+
+    def test_workers_stats(self):
+        endpoint = RDFLibEndpoint(workers=2)
+
+        async def blocked_queries():
+            with endpoint._lock.write():
+                queries = [asyncio.ensure_future(endpoint.async_query("ASK { ?s ?p ?o }")) for _ in range(2)]
+                await asyncio.sleep(0.2)
+                assert endpoint.stats["queued"] == 2
+            return await asyncio.gather(*queries)
+
+        # a loop of its own: asyncio.run would unset the current one
+        loop = asyncio.new_event_loop()
+        try:
+            assert all(code for _, code in loop.run_until_complete(blocked_queries()))
+            stats = endpoint.stats
+            assert (stats["queued"], stats["max_queued"], stats["tasks"]) == (0, 2, 2)
+            assert stats["max_wait_time"] >= 0.2
+            assert stats["wait_time"] >= 0.4
+        finally:
+            loop.close()
+            endpoint.close()
+
+
+class Test4ReadWriteLock:
+    def test_concurrent_readers(self):
+        lock = ReadWriteLock()
+        # both readers must be inside at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=2)
+
+        def reader():
+            with lock.read():
+                barrier.wait()
+
+        threads = [threading.Thread(target=reader) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert not barrier.broken
+
+    def test_writer_excludes_readers(self):
+        lock = ReadWriteLock()
+        entered = threading.Event()
+
+        def reader():
+            with lock.read():
+                entered.set()
+
+        with lock.write():
+            thread = threading.Thread(target=reader)
+            thread.start()
+            assert not entered.wait(0.2)
+        assert entered.wait(2)
+        thread.join(5)
+
+    def test_waiting_writer_first(self):
+        lock = ReadWriteLock()
+        order = []
+
+        def writer():
+            with lock.write():
+                order.append("writer")
+
+        def reader():
+            with lock.read():
+                order.append("reader")
+
+        with lock.read():
+            waiting = threading.Thread(target=writer)
+            waiting.start()
+            time.sleep(0.1)
+            # a new reader queues behind the waiting writer
+            late = threading.Thread(target=reader)
+            late.start()
+            time.sleep(0.1)
+            assert order == []
+        waiting.join(5)
+        late.join(5)
+        assert order == ["writer", "reader"]
+
+
+class Test4RDFEndpoint:
+    def test_update_many(self):
+        class Recorder(RDFEndpoint):
+            def query(self, sparql):
+                pass
+
+            def update(self, content, format="sparql"):
+                self.content = content
+                return None, True
+
+        endpoint = Recorder()
+        assert endpoint.update_many([
+            ("INSERT DATA { <http://a> <http://b> 1 }", "sparql"),
+            ("<http://c> <http://d> <http://e>.", "ttl")])[1]
+        assert endpoint.content == (
+            "INSERT DATA { <http://a> <http://b> 1 } ;\n"
+            "INSERT DATA {\n<http://c> <http://d> <http://e> .\n}")
+        # not a string: the failure is reported, not raised
+        assert endpoint.update_many([(5, "sparql")]) == (None, False)
+
+
+class Test4EndpointOptions:
+    def test_constructors(self):
+        # the options checked by the command line are the ones of the constructors
+        for endpoint, options in ENDPOINT_OPTIONS.items():
+            constructor = HTTPEndpoint if endpoint in (BLAZEGRAPH, FUSEKI) else RDFLibEndpoint
+            assert set(options) <= set(inspect.signature(constructor).parameters)
+
+
+@pytest.fixture
+def standin():
+    with LocalSPARQLServer() as server:
+        yield server
+
+
+class Test4HTTPEndpoint:
+    def test_keep_alive(self, standin):
+        endpoint = Blazegraph(standin.blazegraph_uri, pool_size=2)
+        try:
+            session = endpoint.session
+            for _ in range(5):
+                assert endpoint.query("ASK { ?s ?p ?o }")[1]
+                assert endpoint.update("INSERT DATA { <http://a> <http://b> 1 }")[1]
+            assert endpoint.session is session
+            assert standin.connections == 1
+        finally:
+            endpoint.close()
+
+    def test_no_keep_alive(self, standin):
+        endpoint = Fuseki(standin.fuseki_uri, keep_alive=False)
+        try:
+            for _ in range(3):
+                assert endpoint.query("ASK { ?s ?p ?o }")[1]
+            assert standin.connections == 3
+        finally:
+            endpoint.close()
+
+    def test_timeout(self, standin):
+        endpoint = Fuseki(standin.fuseki_uri, timeout=0.2)
+        try:
+            assert endpoint.query("ASK { ?s ?p ?o }")[1]
+            standin.latency = 0.5
+            with pytest.raises(requests.exceptions.Timeout):
+                endpoint.query("ASK { ?s ?p ?o }")
+        finally:
+            standin.latency = 0
+            endpoint.close()
+
+    def test_unreachable(self):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        uri = f"http://127.0.0.1:{port}/bigdata/sparql"
+        endpoint = Blazegraph(uri, timeout=1)
+        try:
+            assert not endpoint.reachable()
+        finally:
+            endpoint.close()
+        with pytest.raises(ConnectionError):
+            get_endpoint(BLAZEGRAPH, uri, timeout=1)
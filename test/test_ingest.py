@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_ingest.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+from rdflib import Graph, BNode
+from rdflib.compare import isomorphic
+from ingest import TurtleChunker, parse_batches
+from endpoint import RDFLibEndpoint
+
+CONTENT = '''@prefix ex: <http://ex.org/> .
+# a comment. With a dot
+PREFIX foaf: <http://xmlns.com/foaf/0.1/>
+ex:a ex:p "x. y" ; ex:q _:b1 .
+_:b1 ex:r [ ex:s 1.5 ; ex:t ( 1 2 ) ] .
+ex:c ex:p """multi
+. line""" .
+@prefix ex: <http://other.org/> .
+ex:d foaf:name 'n' .
+ex:e ex:p _:b1.'''
+
+
+def pieces(text, size):
+    data = text.encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class Test4TurtleChunker:
+    def test_statements(self):
+        chunker = TurtleChunker()
+        statements = list(chunker.feed(CONTENT))
+        assert [s.strip().split()[0] for s in statements] == [
+            "@prefix", "#", "ex:a", "_:b1", "ex:c", "@prefix", "ex:d"]
+        assert "foaf:" in chunker.header and "http://other.org/" in chunker.header
+        # the last statement has no following blank
+        assert chunker.close().strip() == "ex:e ex:p _:b1."
+
+    def test_incomplete(self):
+        chunker = TurtleChunker()
+        assert list(chunker.feed('ex:a ex:p "not. ')) == []
+        assert list(chunker.feed('ended" . ex:b ex:p <http://a.')) == ['ex:a ex:p "not. ended" .']
+        assert list(chunker.feed('b> .\n')) == [" ex:b ex:p <http://a.b> ."]
+
+    def test_skolem(self):
+        chunker = TurtleChunker("urn:x:")
+        assert list(chunker.feed("_:a ex:p _:b1 .\n")) == ["<urn:x:a> ex:p <urn:x:b1> ."]
+
+
+class Test4ParseBatches:
+    def test_batches(self):
+        reference = Graph().parse(data=CONTENT, format="ttl")
+        for size in (1, 5, 64, 4096):
+            graph = Graph()
+            batches = list(parse_batches(pieces(CONTENT, size), "ttl", batch_size=1))
+            assert len(batches) > 1
+            for batch in batches:
+                for triple in batch:
+                    graph.add(triple)
+            assert isomorphic(graph, reference)
+
+    def test_blank_nodes(self):
+        content = "".join(f"<http://ex.org/s{i}> <http://ex.org/p> _:x .\n" for i in range(10))
+        objects = set()
+        for batch in parse_batches(pieces(content, 7), "ttl", batch_size=1):
+            objects.update(batch.objects())
+        assert len(objects) == 1 and isinstance(objects.pop(), BNode)
+
+    def test_ingest(self):
+        endpoint = RDFLibEndpoint()
+        assert endpoint.ingest(pieces(CONTENT, 3), "ttl") == (12, True)
+        assert len(endpoint.graph) == 12
+        triples, code = endpoint.ingest(pieces(CONTENT + "\nex:f ex:p .", 3), "ttl")
+        assert not code
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_localsparql.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+import json
+import requests
+
+from time import perf_counter
+from endpoint import get_endpoint, BLAZEGRAPH, FUSEKI
+from localsparql import LocalSPARQLServer
+
+COUNT = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+
+
+@pytest.fixture
+def server():
+    with LocalSPARQLServer() as server:
+        yield server
+
+
+def count(endpoint):
+    result, code = endpoint.query(COUNT)
+    assert code
+    return int(json.loads(result)["results"]["bindings"][0]["n"]["value"])
+
+
+class Test4LocalSPARQLServer:
+    @pytest.mark.parametrize("kind", [BLAZEGRAPH, FUSEKI])
+    def test_conventions(self, server, kind):
+        endpoint = get_endpoint(kind, server.blazegraph_uri if kind == BLAZEGRAPH else server.fuseki_uri)
+        try:
+            assert endpoint.update("INSERT DATA { <http://a> <http://b> 1 }")[1]
+            assert endpoint.update("<http://a> <http://b> 2 .", format="ttl")[1]
+            # streamed, in a chunked request
+            assert endpoint.ingest(iter([b"<http://c> <http://d> 3 .\n", b"<http://c> <http://d> 4 .\n"]), "n3") \
+                == (2, True)
+            assert count(endpoint) == 4
+            assert not endpoint.query("SELECT * WHERE ?s")[1]
+            assert not endpoint.update("INSERT garbage")[1]
+        finally:
+            endpoint.close()
+        assert server.requests[kind, "data"] == 2
+        assert server.requests[kind, "update"] == 2
+
+    def test_unknown(self, server):
+        assert requests.get(server.address + "/sparql").status_code == 404
+        assert requests.post(server.fuseki_uri + "/data", data="x", headers={"Content-Type": "text/csv"}).status_code \
+            == 400
+
+    def test_latency(self, server):
+        endpoint = get_endpoint(FUSEKI, server.fuseki_uri)
+        try:
+            server.latency = 0.1
+            started = perf_counter()
+            count(endpoint)
+            assert perf_counter() - started >= 0.1
+        finally:
+            endpoint.close()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+from metrics import Histogram, Metrics, FanOut
+
+
+class Test4Metrics:
+    def test_histogram(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        assert histogram.cumulative() == [(0.1, 2), (1.0, 3), (float("inf"), 4)]
+        assert histogram.quantile(0.5) == 0.1
+        assert histogram.quantile(0.75) == 1.0
+        assert histogram.quantile(1) is None
+        assert histogram.state["buckets"] == {"0.1": 2, "1.0": 3, "+Inf": 4}
+
+    def test_prometheus(self):
+        metrics = Metrics(buckets=(0.1,))
+        metrics.count("requests", resource="SparqlQuery", code="2.05")
+        metrics.count("requests", resource="SparqlQuery", code="2.05")
+        metrics.observe("request_seconds", 0.05, resource='a"b')
+        text = metrics.prometheus({"subscriptions": [({}, 3)]}).splitlines()
+        assert 'musepa_requests_total{code="2.05",resource="SparqlQuery"} 2' in text
+        assert 'musepa_request_seconds_bucket{resource="a\\"b",le="+Inf"} 1' in text
+        assert 'musepa_request_seconds_count{resource="a\\"b"} 1' in text
+        assert "musepa_subscriptions 3" in text
+
+    def test_forget(self):
+        metrics = Metrics()
+        metrics.observe("request_seconds", 0.01, resource="SubscriptionResource", subscription="a")
+        metrics.observe("request_seconds", 0.01, resource="SubscriptionResource", subscription="b")
+        metrics.forget(subscription="a")
+        assert [series["labels"]["subscription"] for series in metrics.state()["request_seconds"]] == ["b"]
+
+    def test_fanout(self):
+        metrics = Metrics()
+        fanout = FanOut(metrics, "fanout_seconds", 2)
+        fanout.done()
+        assert "fanout_seconds" not in metrics.histograms
+        fanout.done()
+        assert metrics.state()["fanout_seconds"][0]["count"] == 1
@@ -12,13 +12,16 @@ import pytest
 import logging
 import json
 import asyncio
+import musepa as front
 
-from aiocoap import CONTENT, CHANGED, CREATED, POST, DELETED
-from aiocoap import BAD_OPTION, BAD_REQUEST, Context, Message, GET
+from aiocoap import CONTENT, CHANGED, CREATED, POST, DELETED, VALID, CONTINUE
+from aiocoap import BAD_OPTION, BAD_REQUEST, NOT_ACCEPTABLE, Context, Message, GET
 from threading import Thread
-from musepa import musepa
+from musepa import musepa, shutdown, SubscriptionResource
 from cCoap import coapCall, coapUnobserve
-from endpoint import AVAILABLE_ENDPOINTS
+from endpoint import AVAILABLE_ENDPOINTS, BLAZEGRAPH, FUSEKI
+from localsparql import LocalSPARQLServer
+from encoding import CBOR, CSV
 from time import sleep
 
 MUSEPA_BASE_URL = "coap://127.0.0.1/{}"
@@ -32,9 +35,13 @@ logger = logging.getLogger(__name__)
 def musepa_fixture(request):
     logger.info("Starting MUSEPA...")
     loop = asyncio.new_event_loop()
-    if request.param == "fuseki":
+    standin = None
+    if request.param in (BLAZEGRAPH, FUSEKI):
+        # the HTTP endpoints run against a local stand-in of the servers
+        standin = LocalSPARQLServer().start()
+        params = standin.blazegraph_uri if request.param == BLAZEGRAPH else standin.fuseki_uri
         thread = Thread(
-            target=musepa, kwargs={"endpoint": request.param, "event_loop": loop, "params": "http://localhost:3030/musepa"})
+            target=musepa, kwargs={"endpoint": request.param, "event_loop": loop, "params": params})
     else:
         thread = Thread(
             target=musepa, kwargs={"endpoint": request.param, "event_loop": loop})
@@ -44,8 +51,12 @@ def musepa_fixture(request):
     sleep(1)
     yield thread
     logger.info("Teardown MUSEPA")
-    loop.stop()
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
     sleep(1)
+    if standin is not None:
+        standin.stop()
 
 
 class Test4musepa:
@@ -108,6 +119,167 @@ class Test4musepa:
             payload="SELECT (COUNT(?s) AS ?triples) WHERE { ?s ?p ?o }")
         assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 1
 
+    def test_query_cache(self):
+        count = "SELECT (COUNT(?s) AS ?triples) WHERE { ?s ?p ?o }"
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE {?a ?b ?c} WHERE {?a ?b ?c}").code == CHANGED
+        first = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        hits = json.loads(coapCall(MUSEPA_BASE_URL.format("sparql/query/cache")).payload.decode())["hits"]
+
+        # same query, different layout
+        second = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count.replace(" ", "  "))
+        assert second.payload == first.payload
+        stats = json.loads(coapCall(MUSEPA_BASE_URL.format("sparql/query/cache")).payload.decode())
+        assert stats["hits"] == hits + 1
+
+        # updates invalidate the cached results
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="prefix : <http://test.org/> INSERT DATA {:a :b :c}").code == CHANGED
+        check = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 1
+
+    def test_query_etag(self):
+        query = "SELECT * WHERE { ?s ?p ?o }"
+
+        async def revalidation():
+            ctx = await Context.create_client_context()
+            uri = MUSEPA_BASE_URL.format("sparql/query")
+            first = await ctx.request(Message(code=GET, uri=uri, payload=query.encode())).response
+            assert first.code == CONTENT and first.opt.etag is not None
+            assert first.opt.max_age == 0
+            second = await ctx.request(Message(
+                code=GET, uri=uri, payload=query.encode(), etags=[first.opt.etag])).response
+            assert second.code == VALID
+            assert second.payload == b''
+            assert second.opt.etag == first.opt.etag
+
+        asyncio.get_event_loop().run_until_complete(revalidation())
+
+    def test_query_accept(self):
+        query = "SELECT ?c WHERE { <http://test.org/accept> <http://test.org/p> ?c }"
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="INSERT DATA { <http://test.org/accept> <http://test.org/p> 1 }").code == CHANGED
+
+        async def negotiation():
+            ctx = await Context.create_client_context()
+            uri = MUSEPA_BASE_URL.format("sparql/query")
+            csv = await ctx.request(Message(code=GET, uri=uri, payload=query.encode(), accept=CSV)).response
+            assert csv.code == CONTENT and csv.opt.content_format == CSV
+            assert csv.payload == b"c\r\n1\r\n"
+            cbor = await ctx.request(Message(code=GET, uri=uri, payload=query.encode(), accept=CBOR)).response
+            assert cbor.code == CONTENT and cbor.opt.content_format == CBOR
+            unknown = await ctx.request(Message(code=GET, uri=uri, payload=query.encode(), accept=41)).response
+            assert unknown.code == NOT_ACCEPTABLE
+            # a graph, not a table of bindings, where the endpoint gives it
+            # in JSON (rdflib cannot)
+            construct = "CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }"
+            graph = await ctx.request(Message(code=GET, uri=uri, payload=construct.encode())).response
+            if graph.code == CONTENT:
+                graph = await ctx.request(
+                    Message(code=GET, uri=uri, payload=construct.encode(), accept=CBOR)).response
+                assert graph.code == NOT_ACCEPTABLE
+
+        asyncio.get_event_loop().run_until_complete(negotiation())
+
+    def test_query_batch(self):
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE WHERE {?a ?b ?c}").code == CHANGED
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="INSERT DATA { <http://test.org/a> <http://test.org/b> 1 }").code == CHANGED
+        queries = ["SELECT * WHERE { ?s ?p ?o }", "ASK { ?s ?p 2 }", "SELECT * WHERE"] * 20
+        response = coapCall(MUSEPA_BASE_URL.format("sparql/query/batch"), payload=json.dumps(queries))
+        assert response.code == CONTENT
+        # longer than a block
+        assert len(response.payload) > 1024
+        results = json.loads(response.payload.decode())
+        assert len(results) == len(queries)
+        assert results[0]["results"]["bindings"][0]["o"]["value"] == "1"
+        assert results[1]["boolean"] is False
+        assert results[2] is None
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/query/batch"), payload="SELECT").code == BAD_REQUEST
+
+    def test_update_batch(self):
+        count = "SELECT (COUNT(?s) AS ?triples) WHERE { ?s ?p ?o }"
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE WHERE {?a ?b ?c}").code == CHANGED
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update/batch"), verb="POST",
+            payload=json.dumps([
+                "INSERT DATA { <http://test.org/a> <http://test.org/b> 1 }",
+                {"format": "ttl", "content": "@prefix : <http://test.org/>. :c :d 2."}])).code == CHANGED
+        check = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 2
+
+        # all or nothing
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update/batch"), verb="POST",
+            payload=json.dumps(["DELETE WHERE {?a ?b ?c}", "INSERT DATA {"])).code == BAD_REQUEST
+        check = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 2
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update/batch"), verb="POST",
+            payload="INSERT DATA {}").code == BAD_REQUEST
+        for item in [{"content": 5}, {"content": None}, {"content": "INSERT DATA {}", "format": 1}]:
+            assert coapCall(
+                MUSEPA_BASE_URL.format("sparql/update/batch"), verb="POST",
+                payload=json.dumps([item])).code == BAD_REQUEST
+
+    def test_update_stream(self):
+        count = "SELECT (COUNT(?s) AS ?triples) WHERE { ?s ?p ?o }"
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE WHERE {?a ?b ?c}").code == CHANGED
+        # many blocks, a blank node used across all of them
+        content = "@prefix : <http://test.org/> .\n" + "".join(
+            f':s{i} :p "value {i}" ; :q _:shared .\n' for i in range(2000))
+        response = coapCall(
+            MUSEPA_BASE_URL.format("sparql/update?format=ttl"), verb="POST", payload=content)
+        assert response.code == CHANGED
+        check = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 4000
+        check = coapCall(
+            MUSEPA_BASE_URL.format("sparql/query"),
+            payload="SELECT DISTINCT ?o WHERE { ?s <http://test.org/q> ?o }")
+        assert len(json.loads(check.payload.decode())["results"]["bindings"]) == 1
+
+    def test_update_stream_tags(self):
+        count = "SELECT (COUNT(?s) AS ?triples) WHERE { ?s ?p ?o }"
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE WHERE {?a ?b ?c}").code == CHANGED
+        # two blocks each, interleaved
+        contents = {tag: ("@prefix : <http://test.org/> .\n" + "".join(
+            f':{tag}{i} :p "value {i}" .\n' for i in range(60))).encode() for tag in ("a", "b")}
+
+        async def uploads():
+            context = await Context.create_client_context()
+            codes = []
+            for number in range(2):
+                for tag, content in contents.items():
+                    request = Message(
+                        code=POST, uri=MUSEPA_BASE_URL.format("sparql/update?format=ttl"),
+                        payload=content[number * 1024:(number + 1) * 1024], block1=(number, number == 0, 6))
+                    # the same client: the uploads differ by their Request-Tag
+                    request.opt.request_tag = [tag.encode()]
+                    codes.append((await context.request(request, handle_blockwise=False).response).code)
+            await context.shutdown()
+            return codes
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(uploads()) == [CONTINUE, CONTINUE, CHANGED, CHANGED]
+        finally:
+            loop.close()
+        check = coapCall(MUSEPA_BASE_URL.format("sparql/query"), payload=count)
+        assert int(json.loads(check.payload.decode())["results"]["bindings"][0]["triples"]["value"]) == 120
+
 # -------------------  Subscription  POST & Observe  -------------------------#
 #
     def test_subscribe(self):
@@ -200,4 +372,168 @@ class Test4musepa:
 
     def test_Subscription_no_payload(self):
         logger.info("Test sparql POST Subscription No payload")
-        assert coapCall(MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST").code == BAD_OPTION
\ No newline at end of file
+        assert coapCall(MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST").code == BAD_OPTION
+
+    def test_subscribe_delta(self):
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/update"), verb="POST",
+            payload="DELETE WHERE {?a ?b ?c}").code == CHANGED
+        response = coapCall(
+            MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST",
+            payload="SELECT ?s WHERE { ?s <http://test.org/delta> ?o }")
+        assert response.code == CREATED
+        alias = response.payload.decode()
+
+        async def observation():
+            coap_context = await Context.create_client_context()
+            notifications = asyncio.Queue()
+            request = Message(
+                code=GET, uri=MUSEPA_BASE_URL.format(alias + "?mode=delta"), observe=0)
+            remote_request = coap_context.request(request)
+            remote_request.observation.register_callback(
+                lambda result: notifications.put_nowait(json.loads(result.payload.decode())))
+            first = json.loads((await remote_request.response).payload.decode())
+            # first observe response: full snapshot
+            assert first["snapshot"]["results"]["bindings"] == []
+
+            ctx = await Context.create_client_context()
+            deltas = []
+            for update in [
+                    "INSERT DATA {<http://a> <http://test.org/delta> <http://c>}",
+                    "DELETE DATA {<http://a> <http://test.org/delta> <http://c>}"]:
+                assert (await ctx.request(Message(
+                    code=POST, payload=update.encode(),
+                    uri=MUSEPA_BASE_URL.format("sparql/update"))).response).code == CHANGED
+                deltas.append(await asyncio.wait_for(notifications.get(), 5))
+            added, removed = deltas
+            remote_request.observation.cancel()
+
+            assert added["sequence"] == first["sequence"] + 1
+            assert added["added"] == [{"s": {"type": "uri", "value": "http://a"}}]
+            assert added["removed"] == []
+            assert removed["sequence"] == first["sequence"] + 2
+            assert removed["added"] == []
+            assert removed["removed"] == added["added"]
+            return coap_context
+
+        ctx = asyncio.get_event_loop().run_until_complete(observation())
+        assert coapUnobserve(MUSEPA_BASE_URL.format(alias), context=ctx).code == DELETED
+
+    def test_subscribe_etag(self):
+        response = coapCall(
+            MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST",
+            payload="SELECT ?s WHERE { ?s <http://test.org/etag> ?o }")
+        assert response.code == CREATED
+        alias = response.payload.decode()
+
+        async def reregistration():
+            coap_context = await Context.create_client_context()
+            uri = MUSEPA_BASE_URL.format(alias)
+            first = coap_context.request(Message(code=GET, uri=uri, observe=0))
+            tag = (await first.response).opt.etag
+            first.observation.cancel()
+            # the client already has the current result
+            again = coap_context.request(Message(code=GET, uri=uri, observe=0, etags=[tag]))
+            response = await again.response
+            again.observation.cancel()
+            assert response.code == VALID
+            assert response.payload == b''
+            return coap_context
+
+        ctx = asyncio.get_event_loop().run_until_complete(reregistration())
+        assert coapUnobserve(MUSEPA_BASE_URL.format(alias), context=ctx).code == DELETED
+
+    def test_subscribe_debounce(self, monkeypatch):
+        # the coalescing window, as set by musepa(debounce=..., max_latency=...)
+        monkeypatch.setattr(SubscriptionResource, "debounce", 0.3)
+        monkeypatch.setattr(SubscriptionResource, "maxLatency", 2.0)
+        update = "DELETE WHERE {{ <http://test.org/d> <http://test.org/debounce> ?o }} ; " \
+                 "INSERT DATA {{ <http://test.org/d> <http://test.org/debounce> {} }}"
+        assert coapCall(MUSEPA_BASE_URL.format("sparql/update"), verb="POST", payload=update.format(0)).code == CHANGED
+        response = coapCall(
+            MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST",
+            payload="SELECT ?o WHERE { <http://test.org/d> <http://test.org/debounce> ?o }")
+        assert response.code == CREATED
+        alias = response.payload.decode()
+
+        async def information(coap_context):
+            request = Message(code=GET, uri=MUSEPA_BASE_URL.format("sparql/subscription"), payload=alias.encode())
+            return json.loads((await coap_context.request(request).response).payload)
+
+        async def burst():
+            coap_context = await Context.create_client_context()
+            observation = coap_context.request(Message(code=GET, uri=MUSEPA_BASE_URL.format(alias), observe=0))
+            await observation.response
+            before = await information(coap_context)
+            notifications = []
+
+            async def observe():
+                async for notification in observation.observation:
+                    notifications.append(json.loads(notification.payload))
+
+            observer = asyncio.ensure_future(observe())
+            for value in range(1, 6):
+                request = Message(code=POST, uri=MUSEPA_BASE_URL.format("sparql/update"),
+                                  payload=update.format(value).encode())
+                assert (await coap_context.request(request).response).code == CHANGED
+            await asyncio.sleep(1)
+            after = await information(coap_context)
+            observation.observation.cancel()
+            observer.cancel()
+            await coap_context.shutdown()
+            return before, after, notifications
+
+        before, after, notifications = asyncio.get_event_loop().run_until_complete(burst())
+        # one re-evaluation, with the final state, for the whole burst
+        assert [n["results"]["bindings"][0]["o"]["value"] for n in notifications] == ["5"]
+        assert after["evaluations"] - before["evaluations"] == 1
+        assert after["saved"] - before["saved"] == 4
+
+    def test_unsubscribe_pending(self, monkeypatch):
+        monkeypatch.setattr(SubscriptionResource, "debounce", 30.0)
+        monkeypatch.setattr(SubscriptionResource, "maxLatency", 30.0)
+        response = coapCall(
+            MUSEPA_BASE_URL.format("sparql/subscription"), verb="POST",
+            payload="SELECT ?o WHERE { <http://test.org/pending> <http://test.org/p> ?o }")
+        assert response.code == CREATED
+        alias = response.payload.decode()
+
+        async def pending():
+            coap_context = await Context.create_client_context()
+            observation = coap_context.request(Message(code=GET, uri=MUSEPA_BASE_URL.format(alias), observe=0))
+            await observation.response
+            resource = front.subscription_store[alias][front.RESOURCE]
+            request = Message(code=POST, uri=MUSEPA_BASE_URL.format("sparql/update"),
+                              payload=b"INSERT DATA { <http://test.org/pending> <http://test.org/p> 1 }")
+            assert (await coap_context.request(request).response).code == CHANGED
+            timer = resource._timer
+            observation.observation.cancel()
+            unobserve = Message(code=GET, uri=MUSEPA_BASE_URL.format(alias), observe=1)
+            code = (await coap_context.request(unobserve).response).code
+            await coap_context.shutdown()
+            return code, timer
+
+        code, timer = asyncio.get_event_loop().run_until_complete(pending())
+        assert code == DELETED
+        # the re-evaluation, still waiting in the window, was dropped
+        assert timer is not None and timer.cancelled()
+
+# -------------------  Test Metrics  --------------------------------------#
+#
+    def test_metrics(self):
+        assert coapCall(
+            MUSEPA_BASE_URL.format("sparql/query"),
+            payload="SELECT * WHERE { ?s <http://test.org/metrics> ?o }").code == CONTENT
+        response = coapCall(MUSEPA_BASE_URL.format("metrics"))
+        assert response.code == CONTENT
+        state = json.loads(response.payload)
+        assert any(series["labels"] == {"resource": "SparqlQuery", "code": "2.05"} and series["value"] >= 1
+                   for series in state["requests"])
+        assert any(series["labels"]["operation"] == "query" and series["count"] >= 1
+                   for series in state["endpoint_seconds"])
+        assert "subscription_observers" in state
+        # the subscription tests updated their results
+        assert state["fanout_seconds"][0]["count"] >= 1
+
+        text = coapCall(MUSEPA_BASE_URL.format("metrics?format=prometheus")).payload.decode()
+        assert 'musepa_request_seconds_count{resource="SparqlQuery"}' in text
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_prefix.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import json
+
+from prefix import Prefixes, IRICompactor, FEW_PREFIXES
+
+PREFIXES = {
+    "t": "http://test.org/",
+    "ta": "http://test.org/a/",
+    "xsd": "http://www.w3.org/2001/XMLSchema#"}
+
+
+def binding(**terms):
+    return json.dumps({"head": {"vars": list(terms)}, "results": {"bindings": [terms]}}).encode()
+
+
+class Test4IRICompactor:
+    def test_iris(self):
+        compactor = IRICompactor(PREFIXES)
+        result = json.loads(compactor.apply(binding(
+            s={"type": "uri", "value": "http://test.org/s"},
+            o={"value": "http://test.org/a/o", "type": "uri"},
+            n={"type": "literal", "value": "1", "datatype": "http://www.w3.org/2001/XMLSchema#integer"})))
+        assert result["results"]["bindings"][0] == {
+            "s": {"type": "uri", "value": "t:s"},
+            "o": {"value": "ta:o", "type": "uri"},
+            "n": {"type": "literal", "value": "1", "datatype": "xsd:integer"}}
+
+    def test_literals(self):
+        compactor = IRICompactor(PREFIXES)
+        content = binding(l={"type": "literal", "value": "http://test.org/s \"type\": \"uri\", \"value\": \"http://test.org/s"})
+        assert compactor.apply(content) == content
+
+    def test_escaped(self):
+        compactor = IRICompactor(PREFIXES)
+        assert compactor.apply(b'{"s": {"type": "uri", "value": "http:\\/\\/test.org\\/s"}}') == \
+            b'{"s": {"type": "uri", "value": "t:s"}}'
+
+    def test_layouts(self):
+        compactor = IRICompactor(PREFIXES)
+        # the second literal has its value first: it is kept all the same
+        content = binding(
+            n={"type": "literal", "value": "1"},
+            l={"value": "http://test.org/s", "type": "literal"},
+            s={"type": "uri", "value": "http://test.org/s"})
+        assert json.loads(compactor.apply(content))["results"]["bindings"][0] == {
+            "n": {"type": "literal", "value": "1"},
+            "l": {"value": "http://test.org/s", "type": "literal"},
+            "s": {"type": "uri", "value": "t:s"}}
+
+    def test_many_prefixes(self):
+        prefixes = dict(PREFIXES, **{f"n{i}": f"http://test.org/n{i}/" for i in range(FEW_PREFIXES)})
+        content = binding(
+            s={"type": "uri", "value": "http://test.org/n1/s"},
+            o={"type": "uri", "value": "http://test.org/a/o"},
+            n={"type": "literal", "value": "1", "datatype": "http://www.w3.org/2001/XMLSchema#integer"})
+        assert json.loads(IRICompactor(prefixes).apply(content))["results"]["bindings"][0] == {
+            "s": {"type": "uri", "value": "n1:s"},
+            "o": {"type": "uri", "value": "ta:o"},
+            "n": {"type": "literal", "value": "1", "datatype": "xsd:integer"}}
+
+    def test_not_json(self):
+        compactor = IRICompactor(PREFIXES)
+        assert compactor.apply(b"<uri>http://test.org/a/o</uri>") == b"<uri>ta:o</uri>"
+
+    def test_json_ld(self):
+        compactor = IRICompactor(PREFIXES)
+        content = json.dumps([{"@id": "http://test.org/s", "http://test.org/a/p": [{"@id": "http://test.org/o"}]}])
+        assert json.loads(compactor.apply(content.encode())) == [{"@id": "t:s", "ta:p": [{"@id": "t:o"}]}]
+
+
+class Test4Prefixes:
+    def test_add_prefix(self):
+        prefixes = Prefixes(silent=True)
+        prefixes.addPrefix("t", "http://test.org/")
+        assert prefixes.sparql == "PREFIX t: <http://test.org/>\n"
+        assert prefixes.applyTo(binding(s={"type": "uri", "value": "http://test.org/s"})) == \
+            binding(s={"type": "uri", "value": "t:s"})
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_procpool.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import asyncio
+import json
+import pytest
+
+from rdflib import Graph
+from procpool import JournalStore, ReplicaPool
+from sqlitestore import SQLiteStore
+from endpoint import get_endpoint
+
+CONTENT = """@prefix ex: <http://ex.org/> .
+ex:a ex:p 1, "x"@en, _:b .
+_:b ex:q ex:a ."""
+
+SELECT = "SELECT ?s ?o WHERE { ?s ex:p ?o } ORDER BY ?o"
+COUNT = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+
+
+def count(result):
+    return int(json.loads(result)["results"]["bindings"][0]["n"]["value"])
+
+
+@pytest.fixture(params=["rdflib", "compact"])
+def endpoint(request):
+    endpoint = get_endpoint(request.param, processes=2)
+    yield endpoint
+    endpoint.close()
+
+
+class Test4JournalStore:
+    def test_rollback(self, tmp_path):
+        memory = Graph(store=JournalStore(Graph().store))
+        memory.parse(data=CONTENT, format="ttl")
+        memory.rollback()
+        # not undone by the store, so kept
+        assert len(memory.store.take()) > 4
+
+        sqlite = Graph(store=JournalStore(SQLiteStore(str(tmp_path / "store.sqlite"))))
+        sqlite.parse(data=CONTENT, format="ttl")
+        sqlite.commit()
+        sqlite.update("DELETE WHERE { ?s ?p ?o }")
+        sqlite.rollback()
+        assert all(op != "remove" for op, _ in sqlite.store.take())
+        sqlite.close()
+
+
+class Test4ReplicaPool:
+    def test_replicas(self, endpoint):
+        endpoint.bind_prefixes({"ex": "http://ex.org/"})
+        assert endpoint.update(CONTENT, format="ttl")[1]
+        reference = endpoint._query(SELECT)
+        assert endpoint.query(SELECT) == reference
+        assert endpoint.update("DELETE WHERE { ?s ex:q ?o }")[1]
+        assert not endpoint.update_many([
+            ("DELETE WHERE { ?s ex:p ?o }", "sparql"), ("INSERT DATA {", "sparql")])[1]
+        assert count(endpoint.query(COUNT)[0]) == 3
+
+        async def concurrently():
+            return await asyncio.gather(*(endpoint.async_query(SELECT) for _ in range(8)))
+        results = asyncio.run(concurrently())
+        assert all(result == reference for result in results)
+
+        stats = endpoint.stats["processes"]
+        assert len(stats) == 2 and all(process["alive"] for process in stats)
+        assert sum(process["queries"] for process in stats) == 10
+
+    def test_warm_start(self, tmp_path):
+        path = str(tmp_path / "store.sqlite")
+        endpoint = get_endpoint("rdflib", params=path)
+        assert endpoint.update(CONTENT, format="ttl")[1]
+        endpoint.close()
+
+        endpoint = get_endpoint("rdflib", params=path, processes=1)
+        assert count(endpoint.query(COUNT)[0]) == 4
+        endpoint.close()
+
+    def test_dead_replica(self):
+        pool = ReplicaPool(1)
+        assert not pool.submit("SELECT * WHERE {", "json").result()[1]
+        pool.replicas[0].process.kill()
+        pool.replicas[0].process.join()
+        pool.replicas[0]._reader.join(5)
+        with pytest.raises(ConnectionError):
+            pool.submit(COUNT, "json")
+        pool.close()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_snapshot.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+import asyncio
+import time
+import endpoint as endpoints
+
+from rdflib import Graph, URIRef
+from rdflib.compare import isomorphic
+from compactstore import CompactStore
+from endpoint import get_endpoint
+from snapshot import dump, load
+
+CONTENT = """@prefix ex: <http://ex.org/> .
+ex:a ex:p 1, "x"@en, "y"^^ex:t, "café", _:b .
+_:b ex:q ex:a, "multi\\nline" .
+ex:c a ex:C ."""
+
+STORES = {"memory": Graph, "compact": lambda: Graph(store=CompactStore())}
+
+
+class Test4Snapshot:
+    @pytest.mark.parametrize("source", STORES)
+    @pytest.mark.parametrize("target", STORES)
+    def test_round_trip(self, tmp_path, source, target):
+        path = str(tmp_path / "store.snapshot")
+        graph = STORES[source]()
+        graph.parse(data=CONTENT, format="ttl")
+        report = dump(graph, path)
+        assert report["triples"] == len(graph)
+
+        restored = STORES[target]()
+        assert load(restored, path)["triples"] == len(graph)
+        assert isomorphic(graph, restored)
+        assert restored.store.namespace("ex") == URIRef("http://ex.org/")
+        assert len(restored.query("SELECT ?o WHERE { <http://ex.org/a> ?p ?o }")) == 5
+
+    def test_not_a_snapshot(self, tmp_path):
+        path = tmp_path / "store.ttl"
+        path.write_text(CONTENT)
+        with pytest.raises(ValueError):
+            load(Graph(), str(path))
+
+    def test_endpoint(self, tmp_path):
+        path = str(tmp_path / "store.snapshot")
+        endpoint = get_endpoint("compact")
+        assert endpoint.update(CONTENT, format="ttl")[1]
+        assert endpoint.snapshot(path)["triples"] == 8
+
+        restored = get_endpoint("rdflib")
+        assert restored.restore(path)["triples"] == 8
+        assert restored.update("DELETE WHERE { ?s a ?o }")[1]
+        assert len(restored.graph) == 7
+
+    @pytest.mark.parametrize("store", ["rdflib", "compact"])
+    def test_async_endpoint(self, tmp_path, monkeypatch, store):
+        path = str(tmp_path / "store.snapshot")
+        endpoint = get_endpoint(store)
+        assert endpoint.update(CONTENT, format="ttl")[1]
+
+        def slow_dump(graph, path):
+            time.sleep(0.5)
+            return dump(graph, path)
+        monkeypatch.setattr(endpoints, "dump", slow_dump)
+
+        async def concurrent():
+            snapshot = asyncio.ensure_future(endpoint.async_snapshot(path))
+            await asyncio.sleep(0.1)
+            calls = [
+                asyncio.ensure_future(endpoint.async_query("ASK { ?s ?p ?o }")),
+                asyncio.ensure_future(endpoint.async_update("INSERT DATA { <http://ex.org/d> <http://ex.org/p> 2 }"))]
+            # the calls wait for the snapshot out of the loop
+            started = time.monotonic()
+            await asyncio.sleep(0.01)
+            assert time.monotonic() - started < 0.2
+            return await snapshot, await asyncio.gather(*calls)
+
+        # a loop of its own: asyncio.run would unset the current one
+        loop = asyncio.new_event_loop()
+        try:
+            report, calls = loop.run_until_complete(concurrent())
+        finally:
+            loop.close()
+        assert report["triples"] == 8
+        assert all(code for _, code in calls)
+        assert len(endpoint.graph) == 9
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_sqlitestore.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import json
+
+from rdflib import Graph, URIRef, Literal, BNode
+from sqlitestore import SQLiteStore
+from endpoint import get_endpoint
+
+CONTENT = """@prefix ex: <http://ex.org/> .
+ex:a ex:p 1, "x"@en, "y"^^ex:t, _:b .
+_:b ex:q ex:a ."""
+
+COUNT = "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+
+
+def count(endpoint):
+    result, code = endpoint.query(COUNT)
+    assert code
+    return int(json.loads(result)["results"]["bindings"][0]["n"]["value"])
+
+
+class Test4SQLiteStore:
+    def test_persistence(self, tmp_path):
+        path = str(tmp_path / "store.sqlite")
+        graph = Graph(store=SQLiteStore(path))
+        graph.parse(data=CONTENT, format="ttl")
+        graph.commit()
+        reference = set(graph)
+        graph.close()
+
+        graph = Graph(store=SQLiteStore(path))
+        assert set(graph) == reference
+        assert graph.store.namespace("ex") == URIRef("http://ex.org/")
+        a, p = URIRef("http://ex.org/a"), URIRef("http://ex.org/p")
+        objects = set(graph.objects(a, p))
+        assert {Literal(1), Literal("x", lang="en"), Literal("y", datatype=URIRef("http://ex.org/t"))} < objects
+        blank = (objects - {Literal(1), Literal("x", lang="en"), Literal("y", datatype=URIRef("http://ex.org/t"))}).pop()
+        assert isinstance(blank, BNode) and graph.value(blank, URIRef("http://ex.org/q")) == a
+        assert list(graph.triples((None, URIRef("http://ex.org/nothing"), None))) == []
+        graph.close()
+
+    def test_rollback(self, tmp_path):
+        graph = Graph(store=SQLiteStore(str(tmp_path / "store.sqlite")))
+        graph.parse(data=CONTENT, format="ttl")
+        graph.commit()
+        graph.update("DELETE WHERE { ?s <http://ex.org/q> ?o }")
+        assert len(graph) == 4
+        graph.rollback()
+        assert len(graph) == 5
+        graph.close()
+
+    def test_endpoint(self, tmp_path):
+        path = str(tmp_path / "store.sqlite")
+        endpoint = get_endpoint("rdflib", params=path)
+        assert endpoint.update(CONTENT, format="ttl")[1]
+        assert endpoint.update_many([
+            ("INSERT DATA { <http://ex.org/c> <http://ex.org/p> 2 }", "sparql"),
+            ("INSERT DATA {", "sparql")])[1] is False
+        assert not endpoint.update("INSERT DATA {")[1]
+        assert count(endpoint) == 5
+        endpoint.close()
+
+        # warm start: the triples are there
+        endpoint = get_endpoint("rdflib", params=path)
+        assert count(endpoint) == 5
+        endpoint.close()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_subscription.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+
+from subscription import SubscriptionIndex
+
+PREFIX = "PREFIX : <http://test.org/> "
+
+
+@pytest.fixture
+def index():
+    index = SubscriptionIndex()
+    index.add("typed", PREFIX + "SELECT * WHERE { ?s a :Sensor ; :value ?v }")
+    index.add("path", PREFIX + "SELECT * WHERE { ?s :partOf+/:name ?n }")
+    index.add("named", PREFIX + "SELECT * WHERE { GRAPH :g { ?s :state ?o } }")
+    index.add("all", "SELECT * WHERE { ?s ?p ?o }")
+    return index
+
+
+class Test4SubscriptionIndex:
+    def test_unrelated_predicate(self, index):
+        assert index.affected(PREFIX + "INSERT DATA { :a :other 1 }") == {"all"}
+
+    def test_predicate(self, index):
+        assert index.affected(PREFIX + "INSERT DATA { :a :value 1 }") == {"typed", "all"}
+        assert index.affected(PREFIX + "DELETE WHERE { ?a :name ?n }") == {"path", "all"}
+
+    def test_type(self, index):
+        assert index.affected(PREFIX + "INSERT DATA { :a a :Actuator }") == {"all"}
+        assert index.affected(PREFIX + "INSERT DATA { :a a :Sensor }") == {"typed", "all"}
+
+    def test_named_graph(self, index):
+        assert index.affected(PREFIX + "INSERT DATA { GRAPH :h { :a :state 1 } }") == {"all"}
+        assert index.affected(PREFIX + "INSERT DATA { GRAPH :g { :a :state 1 } }") == {"named", "all"}
+        assert index.affected(PREFIX + "INSERT DATA { :a :state 1 }") == {"named", "all"}
+
+    def test_everything(self, index):
+        everything = {"typed", "path", "named", "all"}
+        assert index.affected("DELETE WHERE { ?a ?b ?c }") == everything
+        assert index.affected("CLEAR ALL") == everything
+        assert index.affected("@prefix : <http://test.org/>. :a :b :c.", format="ttl") == everything
+
+    def test_remove(self, index):
+        index.remove("all")
+        assert "all" not in index
+        assert index.affected(PREFIX + "INSERT DATA { :a :other 1 }") == set()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_tracing.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+import pytest
+import asyncio
+import json
+import tracing
+
+from endpoint import in_context
+from tracing import SamplingTracer, JSONLinesExporter, NO_SPAN, summarize
+
+
+class Collector():
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span.state)
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    previous = tracing.set_tracer(SamplingTracer(collector, rate=1))
+    yield collector
+    tracing.set_tracer(previous)
+
+
+class Test4Tracing:
+    def test_default(self):
+        with tracing.trace("request") as span:
+            assert span is NO_SPAN
+            assert tracing.span("stage") is NO_SPAN
+            tracing.annotate(ignored=True)
+
+    def test_sampling(self):
+        collector = Collector()
+        previous = tracing.set_tracer(SamplingTracer(collector, rate=0))
+        try:
+            with tracing.trace("request"):
+                with tracing.span("stage"):
+                    pass
+        finally:
+            tracing.set_tracer(previous)
+        assert collector.spans == []
+
+    def test_children(self, collector):
+        def blocking():
+            with tracing.span("executor"):
+                pass
+
+        async def request():
+            with tracing.trace("request", method="GET") as span:
+                with tracing.span("stage"):
+                    tracing.annotate(size=3)
+                await asyncio.get_running_loop().run_in_executor(None, in_context(blocking))
+                span.set(code="2.05")
+
+        asyncio.run(request())
+        stage, executor, root = collector.spans
+        assert root["parent"] is None and root["attributes"] == {"method": "GET", "code": "2.05"}
+        assert stage["name"] == "stage" and stage["attributes"] == {"size": 3}
+        assert stage["parent"] == executor["parent"] == root["span"]
+        assert stage["trace"] == executor["trace"] == root["trace"]
+        # out of the trace, nothing is recorded
+        assert tracing.span("late") is NO_SPAN
+
+    def test_error(self, collector):
+        with pytest.raises(KeyError):
+            with tracing.trace("request"):
+                raise KeyError()
+        assert collector.spans[0]["attributes"] == {"error": "KeyError"}
+
+    def test_summarize(self, tmp_path):
+        path = str(tmp_path / "spans.jsonl")
+        exporter = JSONLinesExporter(path)
+        previous = tracing.set_tracer(SamplingTracer(exporter, rate=1))
+        try:
+            for _ in range(3):
+                with tracing.trace("request"):
+                    with tracing.span("stage"):
+                        pass
+        finally:
+            tracing.set_tracer(previous).close()
+        with open(path) as file:
+            assert len([json.loads(line) for line in file]) == 6
+        summary = summarize(path)
+        assert set(summary) == {("request", "request"), ("request", "stage")}
+        assert summary[("request", "stage")]["count"] == 3
+        assert summary[("request", "stage")]["max"] <= summary[("request", "request")]["max"]
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tracing.py
+#
+#  Copyright (c) 2020
+#  Francesco ANTONIAZZI     <francesco.antoniazzi@emse.fr>
+#  Jehad MELAD              <jehad.melad@etu.univ-st-etienne.fr>
+#
+
+"""Timings of the stages of the requests. A request is traced by
+
+    with tracing.trace("SparqlQuery", method="GET"):
+        with tracing.span("decode"):
+            ...
+
+The spans opened while a trace is running, in the same task or thread, or
+in the calls it hands to executors with their context (contextvars), are
+its children. By default, the tracer does nothing; set_tracer installs a
+SamplingTracer, that writes a fraction of the traces to an exporter, e.g.
+a JSONLinesExporter. The spans of a file can be summarized with
+
+    $ python tracing.py spans.jsonl
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from contextvars import ContextVar
+
+# Fraction of the requests traced by default by a SamplingTracer
+DEFAULT_SAMPLE_RATE = 0.1
+
+logger = logging.getLogger(__name__)
+
+# Span in which the code is running, None out of the sampled traces
+_current = ContextVar("span", default=None)
+
+
+class _NoSpan():
+    # What the spans are when nothing is traced
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span():
+    """A timed stage of a trace, made current while its 'with' block runs.
+    Attributes can be added with set."""
+    __slots__ = ("tracer", "name", "attributes", "trace", "id", "parent", "start", "duration", "_token",
+                 "_started")
+
+    def __init__(self, tracer, name, attributes, parent):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.id = tracer.new_id()
+        self.parent = parent.id if parent is not None else None
+        self.trace = parent.trace if parent is not None else self.id
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.export(self)
+        return False
+
+    @property
+    def state(self):
+        return {
+            "trace": self.trace,
+            "span": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes}
+
+
+class Tracer():
+    """Tracer that does nothing, the default"""
+    def trace(self, name, **attributes):
+        return NO_SPAN
+
+    def span(self, name, **attributes):
+        return NO_SPAN
+
+    def close(self):
+        pass
+
+
+class SamplingTracer(Tracer):
+    """Tracer of a fraction of the requests: each trace is kept with
+    probability 'rate', and then all its spans are given to the exporter
+    when they end.
+
+    Parameters
+    ----------
+    exporter : object with an 'export(span)' method, and optionally 'close'
+        e.g. JSONLinesExporter
+
+    rate : float, optional
+        defaults to DEFAULT_SAMPLE_RATE, between 0 and 1
+    """
+    def __init__(self, exporter, rate=DEFAULT_SAMPLE_RATE):
+        self.exporter = exporter
+        self.rate = rate
+        self._ids = itertools.count(1)
+        # ids unique among the processes writing to the same file
+        self._prefix = os.getpid() << 32
+
+    def new_id(self):
+        return self._prefix | next(self._ids)
+
+    def trace(self, name, **attributes):
+        parent = _current.get()
+        if parent is not None:
+            # already in a trace: a span of it
+            return Span(self, name, attributes, parent)
+        if random.random() >= self.rate:
+            return NO_SPAN
+        return Span(self, name, attributes, None)
+
+    def span(self, name, **attributes):
+        parent = _current.get()
+        if parent is None:
+            return NO_SPAN
+        return Span(self, name, attributes, parent)
+
+    def export(self, span):
+        try:
+            self.exporter.export(span)
+        except Exception as e:
+            logger.error(f"Unable to export the span {span.name}: {e}")
+
+    def close(self):
+        close = getattr(self.exporter, "close", None)
+        if close is not None:
+            close()
+
+
+class JSONLinesExporter():
+    """Writes the spans to 'path', one JSON object per line (see
+    Span.state), appending to the file if it exists. Each line is written
+    at once, so that the processes of a cluster can share the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.state, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_tracer = Tracer()
+
+
+def set_tracer(tracer):
+    """Installs 'tracer', and returns the previous one"""
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def trace(name, **attributes):
+    """Context manager of a traced request, a span of the running one if
+    any, see SamplingTracer.trace"""
+    return _tracer.trace(name, **attributes)
+
+
+def span(name, **attributes):
+    """Context manager of a stage of the running trace, if any"""
+    return _tracer.span(name, **attributes)
+
+
+def annotate(**attributes):
+    """Adds attributes to the current span, if any"""
+    current = _current.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def summarize(path):
+    """Count, mean and percentiles of the durations of the spans in a
+    JSONLinesExporter file, by trace name and span name.
+
+    Returns
+    -------
+    dict
+        {(trace name, span name): {"count", "mean", "p50", "p99", "max"}},
+        durations in seconds
+    """
+    spans = []
+    names = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            span = json.loads(line)
+            spans.append(span)
+            if span["parent"] is None:
+                names[span["trace"]] = span["name"]
+    durations = defaultdict(list)
+    for span in spans:
+        durations[(names.get(span["trace"], "?"), span["name"])].append(span["duration"])
+    summary = {}
+    for key, values in durations.items():
+        values.sort()
+        summary[key] = {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": values[len(values) // 2],
+            "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+            "max": values[-1]}
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summary of the spans written by MUSEPA --trace")
+    parser.add_argument("path", help="JSON lines file of the spans")
+    args = parser.parse_args()
+    print(f"{'trace':<24}{'span':<24}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for (trace_name, span_name), stats in sorted(summarize(args.path).items()):
+        print(f"{trace_name:<24}{span_name:<24}{stats['count']:>8}" + "".join(
+            f"{stats[key] * 1000:>10.3f}" for key in ("mean", "p50", "p99", "max")))